@@ -1,115 +1,279 @@
 import os
+import logging
+from typing import ClassVar
 from dotenv import load_dotenv
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
 from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from langchain_community.chat_models import ChatPerplexity
 
+from app.utils.rate_limiter import Provider, current_user_id, llm_rate_limiter
+
 
 load_dotenv()
 
-chat_model_anthropic_first = ChatAnthropic(
+logger = logging.getLogger(__name__)
+
+PROMPT_CACHE_KEY = "cache_prompt_prefix"
+
+
+def mark_as_cacheable_prefix(message: BaseMessage) -> BaseMessage:
+    """Mark a message that stays identical across calls (e.g. a large system prompt) for provider-side prompt caching.
+
+    Anthropic caches up to the marked message. OpenAI caches long prefixes automatically and ignores the mark.
+    Keep everything that changes between calls after the marked message.
+    """
+    message.additional_kwargs[PROMPT_CACHE_KEY] = True
+    return message
+
+
+class RateLimitedChatModel:
+    """Waits for the rate limiter of its own provider on every call.
+
+    A call that falls back to another provider is charged to the provider that served it.
+    """
+
+    rate_limit_provider: ClassVar[Provider]
+
+    async def _agenerate(self, *args, **kwargs):
+        async with llm_rate_limiter.limit(self.rate_limit_provider, current_user_id.get()):
+            return await super()._agenerate(*args, **kwargs)
+
+    async def _astream(self, *args, **kwargs):
+        async with llm_rate_limiter.limit(self.rate_limit_provider, current_user_id.get()):
+            async for chunk in super()._astream(*args, **kwargs):
+                yield chunk
+
+
+class RateLimitedChatOpenAI(RateLimitedChatModel, ChatOpenAI):
+    rate_limit_provider: ClassVar[Provider] = Provider.OPENAI
+
+
+class RateLimitedChatPerplexity(RateLimitedChatModel, ChatPerplexity):
+    rate_limit_provider: ClassVar[Provider] = Provider.PERPLEXITY
+
+
+class PromptCachingChatAnthropic(RateLimitedChatModel, ChatAnthropic):
+    """ChatAnthropic that sets cache_control breakpoints on marked system prompts.
+
+    With a marked system prompt, the tools and the system prompt are cached, and so is the conversation
+    up to the message before the last one, so that multi-turn loops only pay for their newest turn.
+    Prompts below the provider's minimum cacheable length are sent as usual without being cached.
+    """
+
+    rate_limit_provider: ClassVar[Provider] = Provider.ANTHROPIC
+
+    def _get_request_payload(self, input_, *, stop=None, **kwargs) -> dict:
+        payload = super()._get_request_payload(input_, stop=stop, **kwargs)
+
+        messages = self._convert_input(input_).to_messages()
+        if not any(
+            message.type == "system" and message.additional_kwargs.get(PROMPT_CACHE_KEY)
+            for message in messages
+        ):
+            return payload
+
+        system = payload.get("system")
+        if isinstance(system, str):
+            system = [{"type": "text", "text": system}]
+        if system:
+            system[-1] = {**system[-1], "cache_control": {"type": "ephemeral"}}
+            payload["system"] = system
+
+        formatted_messages = payload["messages"]
+        if len(formatted_messages) >= 2:
+            history = formatted_messages[-2]
+            content = history["content"]
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}] if content else []
+            if content:
+                content[-1] = {**content[-1], "cache_control": {"type": "ephemeral"}}
+                history["content"] = content
+
+        return payload
+
+
+class LLMUsageTracker(BaseCallbackHandler):
+    """Accumulates token usage per model, including prompt cache reads and writes."""
+
+    run_inline = True  # Only updates counters. No need to hop to a thread in async runs.
+
+    def __init__(self):
+        self.usage_by_model: dict[str, dict] = {}
+
+    def on_llm_end(self, response: LLMResult, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None)
+                if not usage:
+                    continue
+
+                metadata = message.response_metadata
+                model = metadata.get("model") or metadata.get("model_name") or "unknown"
+                input_token_details = usage.get("input_token_details") or {}
+                cache_read = input_token_details.get("cache_read") or 0
+                cache_creation = input_token_details.get("cache_creation") or 0
+
+                logger.info(
+                    f"LLM call {model}: input {usage['input_tokens']} (cache read {cache_read}, "
+                    f"cache write {cache_creation}), output {usage['output_tokens']}"
+                )
+
+                totals = self.usage_by_model.setdefault(
+                    model,
+                    {
+                        "calls": 0,
+                        "input_tokens": 0,
+                        "cache_read_tokens": 0,
+                        "cache_creation_tokens": 0,
+                        "output_tokens": 0,
+                    },
+                )
+                totals["calls"] += 1
+                totals["input_tokens"] += usage["input_tokens"]
+                totals["cache_read_tokens"] += cache_read
+                totals["cache_creation_tokens"] += cache_creation
+                totals["output_tokens"] += usage["output_tokens"]
+
+    def metrics(self) -> list[dict]:
+        return [
+            {
+                "model": model,
+                **totals,
+                "cache_read_ratio": (
+                    round(totals["cache_read_tokens"] / totals["input_tokens"], 4)
+                    if totals["input_tokens"]
+                    else 0.0
+                ),
+            }
+            for model, totals in self.usage_by_model.items()
+        ]
+
+
+llm_usage_tracker = LLMUsageTracker()
+
+chat_model_anthropic_first = PromptCachingChatAnthropic(
     model="claude-3-5-sonnet-latest",
     api_key=os.getenv("ANTHROPIC_API_KEY"),
+    callbacks=[llm_usage_tracker],
     temperature=0.5,
 ).with_fallbacks(
     [
-        ChatAnthropic(
+        PromptCachingChatAnthropic(
             model="claude-3-5-sonnet-latest",
             api_key=os.getenv("ANTHROPIC_API_KEY"),
+            callbacks=[llm_usage_tracker],
             temperature=0.1,  # lower the temperature
         ),
-        ChatOpenAI(
+        RateLimitedChatOpenAI(
             model_name="gpt-4o",
             temperature=0.1,
             api_key=os.getenv("OPENAI_API_KEY"),
+            callbacks=[llm_usage_tracker],
         ),  # try with gpt-4o
-        ChatOpenAI(
+        RateLimitedChatOpenAI(
             model_name="o3-mini",
             temperature=None,
             api_key=os.getenv("OPENAI_API_KEY"),
+            callbacks=[llm_usage_tracker],
         ),  # try with o3-mini
     ]
 )
 
-chat_model_openai_first = ChatOpenAI(
+chat_model_openai_first = RateLimitedChatOpenAI(
     model_name="gpt-4o",
     api_key=os.getenv("OPENAI_API_KEY"),
+    callbacks=[llm_usage_tracker],
     temperature=0.5,
 ).with_fallbacks(
     [
-        ChatOpenAI(
+        RateLimitedChatOpenAI(
             model_name="gpt-4o",
             temperature=0.1,
             api_key=os.getenv("OPENAI_API_KEY"),
+            callbacks=[llm_usage_tracker],
         ),  # lower the temperature
-        ChatAnthropic(
+        PromptCachingChatAnthropic(
             model="claude-3-5-sonnet-latest",
             api_key=os.getenv("ANTHROPIC_API_KEY"),
+            callbacks=[llm_usage_tracker],
             temperature=0.1,
         ),  # try with claude
-        ChatOpenAI(
+        RateLimitedChatOpenAI(
             model_name="o3-mini",
             temperature=None,
             api_key=os.getenv("OPENAI_API_KEY"),
+            callbacks=[llm_usage_tracker],
         ),  # try with o3-mini
     ]
 )
 
-reasoning_model = ChatOpenAI(
+reasoning_model = RateLimitedChatOpenAI(
     model_name="o3-mini",
     temperature=None,
     api_key=os.getenv("OPENAI_API_KEY"),
+    callbacks=[llm_usage_tracker],
 ).with_fallbacks(
     [
-        ChatOpenAI(
+        RateLimitedChatOpenAI(
             model_name="o3-mini",
             temperature=None,
             api_key=os.getenv("OPENAI_API_KEY"),
+            callbacks=[llm_usage_tracker],
         ),  # try one more time
     ]
 )
 
 
-perplexity_chat_model = ChatPerplexity(
+perplexity_chat_model = RateLimitedChatPerplexity(
     model="sonar",
     temperature=0.7,
     pplx_api_key=os.getenv("PPLX_API_KEY"),
 )  # no fallbacks are required since it doesn't have structured outputs
 
 
-small_model_anthropic_first = ChatAnthropic(
+small_model_anthropic_first = PromptCachingChatAnthropic(
     model_name="claude-3-5-haiku-latest",
     temperature=0.7,
     api_key=os.getenv("ANTHROPIC_API_KEY"),
+    callbacks=[llm_usage_tracker],
 ).with_fallbacks(
     [
-        ChatAnthropic(
+        PromptCachingChatAnthropic(
             model="claude-3-5-haiku-latest",
             api_key=os.getenv("ANTHROPIC_API_KEY"),
+            callbacks=[llm_usage_tracker],
             temperature=0.1,  # lower the temperature
         ),
-        ChatOpenAI(
+        RateLimitedChatOpenAI(
             model_name="gpt-4o-mini",
             temperature=0.1,
             api_key=os.getenv("OPENAI_API_KEY"),
+            callbacks=[llm_usage_tracker],
         ),  # try with gpt-4o mini
     ]
 )
 
-small_model_openai_first = ChatOpenAI(
+small_model_openai_first = RateLimitedChatOpenAI(
     model_name="gpt-4o-mini",
     temperature=None,
     api_key=os.getenv("OPENAI_API_KEY"),
+    callbacks=[llm_usage_tracker],
 ).with_fallbacks(
     [
-        ChatOpenAI(
+        RateLimitedChatOpenAI(
             model_name="gpt-4o-mini",
             temperature=0.1,
             api_key=os.getenv("OPENAI_API_KEY"),
+            callbacks=[llm_usage_tracker],
         ),  
-        ChatAnthropic(
+        PromptCachingChatAnthropic(
             model="claude-3-5-haiku-latest",
             api_key=os.getenv("ANTHROPIC_API_KEY"),
+            callbacks=[llm_usage_tracker],
             temperature=0.1,  
         ),
     ]
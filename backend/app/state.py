@@ -1,6 +1,36 @@
+import bisect
+import itertools
 from enum import Enum
-from typing import Annotated
-from pydantic import BaseModel, Field
+from datetime import datetime, timedelta
+from typing import Annotated, Any, Iterable
+from pydantic import BaseModel, Field, GetCoreSchemaHandler, PrivateAttr
+from pydantic_core import core_schema
+
+
+def parse_datetime(dt_str):
+    # Fast path for the full format. strptime is an order of magnitude slower.
+    if len(dt_str) > 5:
+        try:
+            return datetime.fromisoformat(dt_str)
+        except ValueError:
+            pass
+
+    formats = [
+        "%Y-%m-%d %H:%M",  # Localized Time
+        "%H:%M",
+    ]
+
+    for fmt in formats:
+        try:
+            return datetime.strptime(dt_str, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"Unable to parse datetime string: {dt_str}")
+
+
+# Process-wide, so that a version number is never reused, even by copies of a model
+_model_versions = itertools.count(1)
+
 
 # ===========================================
 #                Data Models
@@ -32,6 +62,65 @@ class ScheduleItemTime(BaseModel):
         description="Both full-date-and-time and time-only are allowed. e.g. 'YYYY-MM-DD HH:MM' or 'HH:MM'"
     )
 
+    # Parsed once when the strings are set. Private, so the wire format and the JSON schema are unchanged.
+    _start_datetime: datetime | None = PrivateAttr(default=None)
+    _end_datetime: datetime | None = PrivateAttr(default=None)
+    _version: int = PrivateAttr(default=0)
+
+    def model_post_init(self, __context: Any):
+        self._parse_times()
+
+    def __setattr__(self, name: str, value: Any):
+        super().__setattr__(name, value)
+        if name in ("start_time", "end_time"):
+            self._parse_times()
+        if name in type(self).model_fields:
+            self.__pydantic_private__["_version"] = next(_model_versions)
+
+    def _parse_times(self):
+        try:
+            start = parse_datetime(self.start_time)
+        except (ValueError, TypeError):
+            start = None
+        self._start_datetime = start if start and len(self.start_time) > 5 else None
+
+        self._end_datetime = None
+        if self.end_time is None or self._start_datetime is None:
+            return
+        try:
+            end = parse_datetime(self.end_time)
+        except (ValueError, TypeError):
+            return
+        if len(self.end_time) <= 5:  # Format: HH:MM
+            end = datetime.combine(self._start_datetime.date(), end.time())
+            if end < self._start_datetime:  # Past midnight
+                end += timedelta(days=1)
+        self._end_datetime = end
+
+    def parsed_times(self) -> tuple[datetime | None, datetime | None]:
+        """Cached (start, end) datetimes. None for the parts that are missing or couldn't be parsed."""
+        # Read the private dict directly. Attribute access to private fields goes through a slow __getattr__.
+        private = self.__pydantic_private__
+        return private["_start_datetime"], private["_end_datetime"]
+
+    @property
+    def start_datetime(self) -> datetime:
+        start = self.__pydantic_private__["_start_datetime"]
+        if start is None:
+            # Not a full date-and-time. Fall back to parsing it like before.
+            return parse_datetime(self.start_time)
+        return start
+
+    @property
+    def end_datetime(self) -> datetime | None:
+        """End as a full datetime. 'HH:MM' end times are placed on the start date. None if there is no end time."""
+        if self.end_time is None:
+            return None
+        end = self.__pydantic_private__["_end_datetime"]
+        if end is None:
+            return parse_datetime(self.end_time)
+        return end
+
 
 class ScheduleItem(BaseModel):
     id: int
@@ -44,6 +133,210 @@ class ScheduleItem(BaseModel):
         description="Detailed suggestions or tips for the schedule."
     )
 
+    # Rendered prompt lines by render options, each stored with the version it was rendered at
+    _version: int = PrivateAttr(default=0)
+    _rendered_lines: dict = PrivateAttr(default_factory=dict)
+
+    def __setattr__(self, name: str, value: Any):
+        super().__setattr__(name, value)
+        if name in type(self).model_fields:
+            self.__pydantic_private__["_version"] = next(_model_versions)
+
+    def version(self) -> tuple[int, int]:
+        """Changes whenever the item or its time is modified."""
+        return (
+            self.__pydantic_private__["_version"],
+            self.time.__pydantic_private__["_version"],
+        )
+
+
+class CandidateVenue(BaseModel):
+    name: str
+    activity_type: ScheduleItemType
+    address: str | None = Field(
+        description="Street address or area. Leave empty if it's not mentioned."
+    )
+    opening_hours: str | None = Field(
+        description="Opening hours or dates. Leave empty if they're not mentioned."
+    )
+    price: str | None = Field(
+        description="Price range or admission fee. Leave empty if it's not mentioned."
+    )
+    tips: str | None = Field(
+        description="Practical tips for the visit. Leave empty if there are none."
+    )
+
+
+class ScheduleList(list):
+    """Schedule items kept sorted by start time, with an id index.
+
+    Lookups by id and by position are O(log n) through bisect on the sort keys, and ordered iteration is free,
+    so call sites don't need to re-sort. It's still a list, so it serializes as a plain list through the
+    checkpointer and is rebuilt on validation.
+    Use upsert()/remove_id() to modify it. Positional mutations are not allowed because they'd break the order.
+    """
+
+    def __init__(self, items: Iterable[ScheduleItem] = ()):
+        super().__init__()
+        items_by_id = {}
+        for item in items:
+            items_by_id[item.id] = item  # Later items win like in upsert()
+        sorted_items = sorted(items_by_id.values(), key=self.sort_key)
+        super().extend(sorted_items)
+        self._keys = [self.sort_key(item) for item in sorted_items]
+        self._key_by_id = {item.id: key for item, key in zip(sorted_items, self._keys)}
+
+    @staticmethod
+    def sort_key(item: ScheduleItem):
+        # Unparsable start times go last
+        return (item.time.parsed_times()[0] or datetime.max, item.id)
+
+    def copy(self) -> "ScheduleList":
+        copied = ScheduleList.__new__(ScheduleList)
+        super(ScheduleList, copied).extend(self)
+        copied._keys = self._keys.copy()
+        copied._key_by_id = self._key_by_id.copy()
+        return copied
+
+    def __reduce__(self):
+        return (ScheduleList, (list(self),))
+
+    def _index_of_id(self, item_id: int) -> int | None:
+        key = self._key_by_id.get(item_id)
+        if key is None:
+            return None
+        return bisect.bisect_left(self._keys, key)
+
+    def get(self, item_id: int) -> ScheduleItem | None:
+        index = self._index_of_id(item_id)
+        return None if index is None else self[index]
+
+    def ids(self) -> set[int]:
+        return set(self._key_by_id)
+
+    def upsert(self, item: ScheduleItem):
+        self.remove_id(item.id)
+        key = self.sort_key(item)
+        index = bisect.bisect_right(self._keys, key)
+        self._keys.insert(index, key)
+        super().insert(index, item)
+        self._key_by_id[item.id] = key
+
+    def remove_id(self, item_id: int) -> ScheduleItem | None:
+        index = self._index_of_id(item_id)
+        if index is None:
+            return None
+        del self._key_by_id[item_id]
+        del self._keys[index]
+        return super().pop(index)
+
+    # list API that keeps the index in sync
+    def append(self, item: ScheduleItem):
+        self.upsert(item)
+
+    def extend(self, items: Iterable[ScheduleItem]):
+        for item in items:
+            self.upsert(item)
+
+    def pop(self, index: int = -1) -> ScheduleItem:
+        return self.remove_id(self[index].id)
+
+    def remove(self, item: ScheduleItem):
+        if self.remove_id(item.id) is None:
+            raise ValueError(f"Schedule item {item.id} is not in the list")
+
+    def clear(self):
+        super().clear()
+        self._keys.clear()
+        self._key_by_id.clear()
+
+    def _positional_mutation(self, *args, **kwargs):
+        raise TypeError(
+            "ScheduleList keeps its own order. Use upsert() or remove_id() instead."
+        )
+
+    insert = __setitem__ = __delitem__ = __iadd__ = __imul__ = _positional_mutation
+    sort = reverse = _positional_mutation
+
+    @classmethod
+    def __get_pydantic_core_schema__(
+        cls, source_type: Any, handler: GetCoreSchemaHandler
+    ) -> core_schema.CoreSchema:
+        list_schema = handler.generate_schema(list[ScheduleItem])
+
+        def validate(value, next_validator):
+            if isinstance(value, ScheduleList):
+                # Copy so that nodes can't mutate the value stored in the channel
+                return value.copy()
+            return cls(next_validator(value))
+
+        return core_schema.no_info_wrap_validator_function(
+            validate,
+            list_schema,
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda value, info: [item.model_dump(mode=info.mode) for item in value],
+                info_arg=True,
+            ),
+        )
+
+
+# ===========================================
+#              SCHEDULE ITEM IDS
+# ===========================================
+# The frontend numbers the user's fixed schedules down from 999. Generated schedule items never get these ids.
+FIXED_SCHEDULE_ID_RANGE = range(901, 1000)
+
+
+def is_fixed_schedule_id(item_id: int) -> bool:
+    return item_id in FIXED_SCHEDULE_ID_RANGE
+
+
+def allocate_schedule_ids(
+    last_id: int, count: int, schedule_items: list[ScheduleItem] = ()
+) -> list[int]:
+    """The next count ids after last_id, skipping the fixed schedule range and the ids used in schedule_items.
+
+    last_id only grows (see OverallState.last_schedule_item_id), so ids of removed items are never handed out again.
+    """
+    used_ids = (
+        schedule_items.ids()
+        if isinstance(schedule_items, ScheduleList)
+        else {item.id for item in schedule_items}
+    )
+    ids = []
+    next_id = last_id + 1
+    while len(ids) < count:
+        if next_id in FIXED_SCHEDULE_ID_RANGE:
+            next_id = FIXED_SCHEDULE_ID_RANGE.stop
+        if next_id not in used_ids:
+            ids.append(next_id)
+        next_id += 1
+    return ids
+
+
+def assign_new_schedule_ids(
+    new_items: list[ScheduleItem], schedule_items: list[ScheduleItem], last_id: int
+) -> int:
+    """Give allocated ids to the items of new_items that aren't in schedule_items yet, in place. Returns the new last id.
+
+    Models pick their own ids for the items they add, and the ones they pick may belong to items they didn't see.
+    """
+    existing_ids = (
+        schedule_items.ids()
+        if isinstance(schedule_items, ScheduleList)
+        else {item.id for item in schedule_items}
+    )
+    added_items = [
+        item
+        for item in new_items
+        if item.id not in existing_ids
+        and item.activity_type != ScheduleItemType.REMOVE
+    ]
+    ids = allocate_schedule_ids(last_id, len(added_items), schedule_items)
+    for item, item_id in zip(added_items, ids):
+        item.id = item_id
+    return max([last_id, *ids])
+
 
 # ===========================================
 #                REDUCER FUNCTIONS
@@ -57,21 +350,24 @@ def extend_list(original: list, new: list):
 
 def insert_schedules(original: list[ScheduleItem], new: list[ScheduleItem]):
     if len(new) == 1 and new[0] == "RESET_LIST":
-        return []
-    if len(new) > 0:
-        for new_item in new:
-            found = False
-            for i, original_item in enumerate(original):
-                if original_item.id == new_item.id:
-                    found = True
-                    if new_item.activity_type == ScheduleItemType.REMOVE:
-                        original.pop(i)
-                    else:
-                        original[i] = new_item
-                    break
-            if not found:
-                original.append(new_item)
-    return original
+        return ScheduleList()
+
+    # The channel holds a plain list after being restored from a checkpoint
+    schedules = (
+        original if isinstance(original, ScheduleList) else ScheduleList(original)
+    )
+    for new_item in new:
+        if isinstance(new_item, dict):
+            new_item = ScheduleItem.model_validate(new_item)
+        if new_item.activity_type == ScheduleItemType.REMOVE:
+            schedules.remove_id(new_item.id)
+        else:
+            schedules.upsert(new_item)
+    return schedules
+
+
+def keep_max(original: int, new: int):
+    return max(original or 0, new or 0)
 
 
 # ===========================================
@@ -112,7 +408,13 @@ class OverallState(InputState):
     internet_search_result_list: Annotated[list[dict], extend_list] = Field(
         default_factory=list
     )
+    # Deduplicated venues extracted from internet_search_result_list, most mentioned first
+    candidate_venue_list: list[CandidateVenue] = Field(default_factory=list)
 
-    schedule_list: Annotated[list[ScheduleItem], insert_schedules] = Field(
-        default_factory=list
+    schedule_list: Annotated[ScheduleList, insert_schedules] = Field(
+        default_factory=ScheduleList
     )
+    # The last id handed out by allocate_schedule_ids. Branches that run at the same time must split a range between them.
+    last_schedule_item_id: Annotated[int, keep_max] = Field(default=0)
+
+    validate_schedule_round: int = Field(default=0)
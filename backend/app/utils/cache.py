@@ -0,0 +1,213 @@
+import os
+import re
+import abc
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CACHE_TTL = timedelta(days=int(os.getenv("SEARCH_CACHE_TTL_DAYS", 7)))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 10000))
+TERMINAL_ROUTE_CACHE_TTL = timedelta(
+    days=int(os.getenv("TERMINAL_ROUTE_CACHE_TTL_DAYS", 30))
+)
+
+
+def normalize_text(text: str | None) -> str:
+    if not text:
+        return ""
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+# ===========================================
+#                 BACKENDS
+# ===========================================
+class CacheBackend(abc.ABC):
+    """Stores JSON-serializable values by key. Expiry and eviction are up to the backend."""
+
+    @abc.abstractmethod
+    async def get(self, namespace: str, key: str): ...
+
+    @abc.abstractmethod
+    async def set(self, namespace: str, key: str, value, ttl: timedelta): ...
+
+
+class InMemoryCacheBackend(CacheBackend):
+    """Per-process LRU cache with TTL."""
+
+    def __init__(self, max_entries: int = SEARCH_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple[str, str], tuple[float, object]] = OrderedDict()
+
+    async def get(self, namespace: str, key: str):
+        entry = self.entries.get((namespace, key))
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[(namespace, key)]
+            return None
+        self.entries.move_to_end((namespace, key))
+        return value
+
+    async def set(self, namespace: str, key: str, value, ttl: timedelta):
+        self.entries[(namespace, key)] = (time.monotonic() + ttl.total_seconds(), value)
+        self.entries.move_to_end((namespace, key))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class RedisCacheBackend(CacheBackend):
+    """Shared across workers. TTL is set per key and LRU eviction is left to Redis' maxmemory-policy (allkeys-lru)."""
+
+    KEY_PREFIX = "tour_assistant:cache:"
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    async def get(self, namespace: str, key: str):
+        value = await self.redis_client.get(f"{self.KEY_PREFIX}{namespace}:{key}")
+        if value is None:
+            return None
+        return json.loads(value)
+
+    async def set(self, namespace: str, key: str, value, ttl: timedelta):
+        await self.redis_client.setex(
+            f"{self.KEY_PREFIX}{namespace}:{key}", ttl, json.dumps(value)
+        )
+
+
+class MongoCacheBackend(CacheBackend):
+    """Persistent cache. Expired documents are removed by a TTL index and the least recently used ones are trimmed above max_entries."""
+
+    TRIM_EVERY_N_WRITES = 100
+
+    def __init__(
+        self,
+        mongodb_client,
+        db_name: str = "cache_db",
+        max_entries: int = SEARCH_CACHE_MAX_ENTRIES,
+    ):
+        self.db = mongodb_client[db_name]
+        self.max_entries = max_entries
+        self.writes_since_trim = 0
+        self.indexed_namespaces = set()
+
+    async def _collection(self, namespace: str):
+        collection = self.db[namespace]
+        if namespace not in self.indexed_namespaces:
+            await collection.create_index("expires_at", expireAfterSeconds=0)
+            await collection.create_index("accessed_at")
+            self.indexed_namespaces.add(namespace)
+        return collection
+
+    async def get(self, namespace: str, key: str):
+        collection = await self._collection(namespace)
+        now = datetime.now(timezone.utc)
+        doc = await collection.find_one_and_update(
+            {"_id": key, "expires_at": {"$gt": now}},
+            {"$set": {"accessed_at": now}},
+        )
+        if doc is None:
+            return None
+        return doc["value"]
+
+    async def set(self, namespace: str, key: str, value, ttl: timedelta):
+        collection = await self._collection(namespace)
+        now = datetime.now(timezone.utc)
+        await collection.update_one(
+            {"_id": key},
+            {"$set": {"value": value, "expires_at": now + ttl, "accessed_at": now}},
+            upsert=True,
+        )
+
+        self.writes_since_trim += 1
+        if self.writes_since_trim >= self.TRIM_EVERY_N_WRITES:
+            self.writes_since_trim = 0
+            await self._trim(collection)
+
+    async def _trim(self, collection):
+        overflow = await collection.estimated_document_count() - self.max_entries
+        if overflow <= 0:
+            return
+        cursor = collection.find({}, {"_id": 1}, sort=[("accessed_at", 1)], limit=overflow)
+        ids = [doc["_id"] async for doc in cursor]
+        await collection.delete_many({"_id": {"$in": ids}})
+
+
+def create_cache_backend(
+    backend_name: str, redis_client=None, mongodb_client=None
+) -> CacheBackend:
+    if backend_name == "redis":
+        return RedisCacheBackend(redis_client)
+    elif backend_name == "mongo":
+        return MongoCacheBackend(mongodb_client)
+    elif backend_name == "memory":
+        return InMemoryCacheBackend()
+    else:
+        raise ValueError(f"Invalid cache backend: {backend_name}")
+
+
+# ===========================================
+#                  CACHE
+# ===========================================
+class ResultCache:
+    """Namespaced cache in front of an expensive call. Backend errors are treated as misses."""
+
+    def __init__(self, namespace: str, ttl: timedelta, backend: CacheBackend = None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.backend = backend or InMemoryCacheBackend()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts: str | None) -> str:
+        normalized = "|".join(normalize_text(part) for part in parts)
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str):
+        try:
+            value = await self.backend.get(self.namespace, key)
+        except Exception as e:
+            logger.error(f"Cache get failed on {self.namespace}: {str(e)}")
+            value = None
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value):
+        try:
+            await self.backend.set(self.namespace, key, value, self.ttl)
+        except Exception as e:
+            logger.error(f"Cache set failed on {self.namespace}: {str(e)}")
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "namespace": self.namespace,
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+search_result_cache = ResultCache("internet_search", SEARCH_CACHE_TTL)
+terminal_route_cache = ResultCache("terminal_route", TERMINAL_ROUTE_CACHE_TTL)
+candidate_venue_cache = ResultCache("candidate_venues", SEARCH_CACHE_TTL)
+
+caches = [search_result_cache, terminal_route_cache, candidate_venue_cache]
+
+
+def configure_caches(backend: CacheBackend):
+    for cache in caches:
+        cache.backend = backend
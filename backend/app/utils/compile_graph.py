@@ -1,15 +1,820 @@
 import os
-from pymongo import AsyncMongoClient
+import asyncio
+import hashlib
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Sequence
+
+from pymongo import AsyncMongoClient, UpdateOne
+from pymongo.errors import OperationFailure
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+)
 from langgraph.checkpoint.mongodb.aio import AsyncMongoDBSaver
+from langgraph.checkpoint.mongodb.utils import dumps_metadata, loads_metadata
+from langgraph.checkpoint.serde.base import SerializerProtocol
+
+try:
+    import zstandard
+except ImportError:  # In requirements.txt, but only needed for CHECKPOINT_COMPRESSION=zstd
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+
+# Same database as AsyncMongoDBSaver's default
+CHECKPOINT_DB_NAME = "checkpointing_db"
+CHECKPOINT_BLOB_COLLECTION_NAME = "checkpoint_blobs"
+
+# Checkpoints of a thread are written at most this often, and only the latest one of each interval is kept. 0 writes through.
+CHECKPOINT_FLUSH_INTERVAL_SECONDS = float(
+    os.getenv("CHECKPOINT_FLUSH_INTERVAL_SECONDS", 1)
+)
+# Channel values of at least this size are stored once by content hash instead of in every checkpoint
+CHECKPOINT_BLOB_MIN_BYTES = int(os.getenv("CHECKPOINT_BLOB_MIN_BYTES", 4096))
+
+# none | zstd (needs the zstandard package). Compressed values stay readable after switching back to none.
+CHECKPOINT_COMPRESSION = os.getenv("CHECKPOINT_COMPRESSION", "none")
+CHECKPOINT_COMPRESSION_MIN_BYTES = int(
+    os.getenv("CHECKPOINT_COMPRESSION_MIN_BYTES", 512)
+)
+
+# Retention: the last N checkpoints of a thread, plus the final checkpoint of each of its generations
+CHECKPOINT_KEEP_LAST = int(os.getenv("CHECKPOINT_KEEP_LAST", 10))
+# Set in the metadata of the checkpoint a generation ended with, by amark_final()
+FINAL_METADATA_KEY = "final"
+# Every thread is pruned this often, besides right after its generation. 0 disables it.
+CHECKPOINT_PRUNE_INTERVAL_SECONDS = float(
+    os.getenv("CHECKPOINT_PRUNE_INTERVAL_SECONDS", 3600)
+)
+# Unreferenced blobs are deleted only this long after they were last written or referenced
+CHECKPOINT_BLOB_GRACE_SECONDS = 24 * 3600
+# A process trusts its blobs to be stored for this long, and writes them again after.
+# Being shorter than the grace period, a blob is never swept while a buffered checkpoint may still refer to it.
+BLOB_STORED_TRUST_SECONDS = CHECKPOINT_BLOB_GRACE_SECONDS / 2
+PRUNE_BATCH_SIZE = 1000
+
+ZSTD_TYPE_SUFFIX = "+zstd"
+
+MAX_CACHED_BLOBS = 1024
+MAX_CACHED_BLOB_HASHES = 65536
+
+BLOB_REF_KEY = "__checkpoint_blob__"
+_SMALL_VALUE = ""  # Memoized in place of a hash for values that stay in the checkpoint
+
+
+def create_mongodb_client() -> AsyncMongoClient:
+    return AsyncMongoClient(
+        os.getenv("MONGODB_URI_LANGGRAPH_CHECKPOINTER"),
+        maxPoolSize=MONGODB_MAX_POOL_SIZE,
+        minPoolSize=MONGODB_MIN_POOL_SIZE,
+    )
+
+
+def _is_blob_ref(value) -> bool:
+    return isinstance(value, dict) and len(value) == 1 and BLOB_REF_KEY in value
+
+
+def _lru_set(cache: OrderedDict, key, value, max_size: int):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def _blob_hashes(values) -> set[str]:
+    return {value[BLOB_REF_KEY] for value in values if _is_blob_ref(value)}
+
+
+class CompressedSerializer(SerializerProtocol):
+    """Wraps a serializer to compress typed values of at least min_bytes with zstd.
+
+    Compressed values are marked by a suffix on their type, so values written before or without compression
+    are read as they are.
+    """
+
+    def __init__(
+        self,
+        serde: SerializerProtocol,
+        compress: bool = True,
+        min_bytes: int = CHECKPOINT_COMPRESSION_MIN_BYTES,
+    ):
+        if compress and zstandard is None:
+            raise RuntimeError(
+                "CHECKPOINT_COMPRESSION=zstd needs the zstandard package: pip install zstandard"
+            )
+        self.serde = serde
+        self.compress = compress
+        self.min_bytes = min_bytes
+        self._compressor = zstandard.ZstdCompressor() if compress else None
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+    def dumps(self, obj: Any) -> bytes:
+        return self.serde.dumps(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return self.serde.loads(data)
+
+    def dumps_typed(self, obj: Any) -> tuple[str, bytes]:
+        type_, data = self.serde.dumps_typed(obj)
+        if not self.compress or len(data) < self.min_bytes:
+            return type_, data
+        return type_ + ZSTD_TYPE_SUFFIX, self._compressor.compress(data)
+
+    def loads_typed(self, data: tuple[str, bytes]) -> Any:
+        type_, data = data
+        if type_.endswith(ZSTD_TYPE_SUFFIX):
+            if self._decompressor is None:
+                raise RuntimeError(
+                    "Checkpoints are compressed with zstd, but the zstandard package isn't installed"
+                )
+            type_ = type_.removesuffix(ZSTD_TYPE_SUFFIX)
+            data = self._decompressor.decompress(data)
+        return self.serde.loads_typed((type_, data))
+
+
+def create_checkpoint_serializer(
+    serde: SerializerProtocol, compression: str = CHECKPOINT_COMPRESSION
+) -> CompressedSerializer:
+    if compression == "none":
+        return CompressedSerializer(serde, compress=False)
+    elif compression == "zstd":
+        return CompressedSerializer(serde)
+    else:
+        raise ValueError(f"Invalid checkpoint compression: {compression}")
+
+
+class CoalescingCheckpointSaver(BaseCheckpointSaver):
+    """Wraps a checkpointer to write less, and less often.
+
+    Checkpoints put within flush_interval of each other are coalesced: only the latest checkpoint of a thread
+    and the writes against it are written, and it takes over the parent of the ones it replaced. Reading a thread
+    flushes it first. Call aflush() before shutting down.
+
+    Channel values, pending sends, writes and the writes in the metadata of at least blob_min_bytes are stored once
+    in blob_collection by content hash, and only a reference is kept in their place. Channels whose version didn't
+    change are not serialized again.
+
+    aprune() and asweep_blobs() delete the checkpoints the retention policy doesn't keep and the blobs left unreferenced.
+    They work on the collections of the wrapped AsyncMongoDBSaver.
+    """
+
+    def __init__(
+        self,
+        checkpointer: BaseCheckpointSaver,
+        blob_collection,
+        flush_interval: float = CHECKPOINT_FLUSH_INTERVAL_SECONDS,
+        blob_min_bytes: int = CHECKPOINT_BLOB_MIN_BYTES,
+    ):
+        super().__init__(serde=checkpointer.serde)
+        self.checkpointer = checkpointer
+        self.blob_collection = blob_collection
+        self.flush_interval = flush_interval
+        self.blob_min_bytes = blob_min_bytes
+
+        # By (thread_id, checkpoint_ns)
+        self._pending_checkpoints: dict[tuple[str, str], tuple] = {}
+        self._pending_writes: dict[tuple[str, str], list[tuple]] = {}
+        self._flush_tasks: dict[tuple[str, str], asyncio.Task] = {}
+        self._flush_locks: dict[tuple[str, str], asyncio.Lock] = {}
+
+        self._blob_hash_by_version: OrderedDict[tuple, str] = OrderedDict()
+        # When each blob was last written by this process for a thread, in time.monotonic(). By (thread_id, hash).
+        self._stored_blob_hashes: OrderedDict[tuple[str, str], float] = OrderedDict()
+        self._blob_cache: OrderedDict[str, tuple[str, bytes]] = OrderedDict()
+
+    @property
+    def config_specs(self) -> list:
+        return self.checkpointer.config_specs
+
+    def get_next_version(self, current, channel):
+        return self.checkpointer.get_next_version(current, channel)
+
+    # ------------------------------ Writes ------------------------------
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        key = (thread_id, checkpoint_ns)
+
+        # Reducers like extend_list mutate channel values in place. The buffered checkpoint keeps its own copies.
+        checkpoint = {
+            **checkpoint,
+            "channel_values": {
+                channel: (
+                    value.copy() if isinstance(value, (list, dict, set)) else value
+                )
+                for channel, value in checkpoint["channel_values"].items()
+            },
+        }
+
+        replaced = self._pending_checkpoints.get(key)
+        if replaced is not None:
+            # The replaced checkpoint is never written, so this one points to its parent
+            config = replaced[0]
+            new_versions = {**replaced[3], **new_versions}
+        self._pending_checkpoints[key] = (config, checkpoint, metadata, new_versions)
+        # Writes against older checkpoints are only needed to resume from those checkpoints
+        self._pending_writes.pop(key, None)
+
+        await self._schedule_flush(key)
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+    ) -> None:
+        key = (
+            config["configurable"]["thread_id"],
+            config["configurable"]["checkpoint_ns"],
+        )
+        self._pending_writes.setdefault(key, []).append((config, writes, task_id))
+        await self._schedule_flush(key)
+
+    async def _schedule_flush(self, key: tuple[str, str]):
+        if self.flush_interval <= 0:
+            await self._flush(key)
+        elif key not in self._flush_tasks:
+            self._flush_tasks[key] = asyncio.create_task(self._flush_later(key))
 
-async def compile_graph_with_async_checkpointer(graph, graph_name):
+    async def _flush_later(self, key: tuple[str, str]):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_tasks.pop(key, None)
+        try:
+            await self._flush(key)
+        except Exception as e:
+            logger.error(
+                f"Failed to write the checkpoint of {key}: {str(e)}. Retrying in {self.flush_interval}s."
+            )
+            if key not in self._flush_tasks:
+                self._flush_tasks[key] = asyncio.create_task(self._flush_later(key))
+
+    async def _flush(self, key: tuple[str, str]):
+        async with self._flush_locks.setdefault(key, asyncio.Lock()):
+            unwritten_checkpoint = self._pending_checkpoints.pop(key, None)
+            unwritten_writes = self._pending_writes.pop(key, [])
+            try:
+                await self._write(key, unwritten_checkpoint, unwritten_writes)
+            except BaseException:
+                self._restore_pending(key, unwritten_checkpoint, unwritten_writes)
+                raise
+
+    def _restore_pending(
+        self,
+        key: tuple[str, str],
+        checkpoint: tuple | None,
+        writes: list[tuple],
+    ):
+        """Put back what a failed flush didn't write, so that the next flush writes it."""
+        newer = self._pending_checkpoints.get(key)
+        if newer is None:
+            if checkpoint is not None:
+                self._pending_checkpoints[key] = checkpoint
+            if writes:
+                self._pending_writes[key] = writes + self._pending_writes.get(key, [])
+        elif checkpoint is not None:
+            # Replaced while it was being written, like in aput. The newer one points to the unwritten one.
+            self._pending_checkpoints[key] = (
+                checkpoint[0],
+                newer[1],
+                newer[2],
+                {**checkpoint[3], **newer[3]},
+            )
+
+    async def _write(
+        self,
+        key: tuple[str, str],
+        pending_checkpoint: tuple | None,
+        pending_writes: list[tuple],
+    ):
+        new_blobs = {}
+        if pending_checkpoint is not None:
+            config, checkpoint, metadata, new_versions = pending_checkpoint
+            # The writes in the metadata hold the outputs of the step, like the whole state a subgraph returns
+            if metadata.get("writes"):
+                metadata = {
+                    **metadata,
+                    "writes": self._blob_ref(
+                        key[0], metadata["writes"], None, new_blobs
+                    )
+                    or metadata["writes"],
+                }
+            pending_checkpoint = (
+                config,
+                self._externalize_checkpoint(key, checkpoint, new_blobs),
+                metadata,
+                new_versions,
+            )
+        # Send packets in the writes carry a copy of the state
+        pending_writes = [
+            (
+                config,
+                [
+                    (
+                        channel,
+                        self._blob_ref(key[0], value, None, new_blobs) or value,
+                    )
+                    for channel, value in writes
+                ],
+                task_id,
+            )
+            for config, writes, task_id in pending_writes
+        ]
+
+        # Blobs go first, so that nothing refers to a blob that isn't stored yet
+        await self._store_blobs(key[0], new_blobs)
+        if pending_checkpoint is not None:
+            await self.checkpointer.aput(*pending_checkpoint)
+        await asyncio.gather(
+            *(
+                self.checkpointer.aput_writes(config, writes, task_id)
+                for config, writes, task_id in pending_writes
+            )
+        )
+
+    async def aflush(self, thread_id: str | None = None):
+        """Write the pending checkpoints of a thread, or of every thread."""
+        keys = {*self._pending_checkpoints, *self._pending_writes}
+        for key in keys:
+            if thread_id is None or key[0] == thread_id:
+                task = self._flush_tasks.pop(key, None)
+                if task is not None:
+                    task.cancel()
+                await self._flush(key)
+
+    # ------------------------------ Blobs ------------------------------
+    def _blob_ref(
+        self, thread_id: str, value, version_key: tuple | None, new_blobs: dict
+    ):
+        """A reference to the blob of value, or None if the value is small enough to stay in the checkpoint."""
+        blob_hash = (
+            self._blob_hash_by_version.get(version_key) if version_key else None
+        )
+        if blob_hash is None or (
+            blob_hash and not self._is_blob_stored(thread_id, blob_hash)
+        ):
+            type_, data = self.serde.dumps_typed(value)
+            blob_hash = (
+                hashlib.sha256(type_.encode() + data).hexdigest()
+                if len(data) >= self.blob_min_bytes
+                else _SMALL_VALUE
+            )
+            if blob_hash and not self._is_blob_stored(thread_id, blob_hash):
+                new_blobs[blob_hash] = (type_, data)
+            if version_key:
+                _lru_set(
+                    self._blob_hash_by_version,
+                    version_key,
+                    blob_hash,
+                    MAX_CACHED_BLOB_HASHES,
+                )
+        return {BLOB_REF_KEY: blob_hash} if blob_hash else None
+
+    def _is_blob_stored(self, thread_id: str, blob_hash: str) -> bool:
+        stored_at = self._stored_blob_hashes.get((thread_id, blob_hash))
+        return (
+            stored_at is not None
+            and time.monotonic() - stored_at < BLOB_STORED_TRUST_SECONDS
+        )
+
+    def _externalize_checkpoint(
+        self, key: tuple[str, str], checkpoint: Checkpoint, new_blobs: dict
+    ) -> Checkpoint:
+        channel_values = {}
+        for channel, value in checkpoint["channel_values"].items():
+            version = checkpoint["channel_versions"].get(channel)
+            version_key = (*key, channel, version) if version is not None else None
+            channel_values[channel] = (
+                self._blob_ref(key[0], value, version_key, new_blobs) or value
+            )
+        checkpoint = {**checkpoint, "channel_values": channel_values}
+        if checkpoint.get("pending_sends"):
+            checkpoint["pending_sends"] = (
+                self._blob_ref(key[0], checkpoint["pending_sends"], None, new_blobs)
+                or checkpoint["pending_sends"]
+            )
+        return checkpoint
+
+    async def _store_blobs(self, thread_id: str, new_blobs: dict):
+        if not new_blobs:
+            return
+        now = datetime.now(timezone.utc)
+        await self.blob_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": blob_hash},
+                    {
+                        "$setOnInsert": {
+                            "type": type_,
+                            "value": data,
+                            "created_at": now,
+                        },
+                        # Keeps the blob from being swept while it's in use
+                        "$set": {"last_used_at": now},
+                        # Only the threads that refer to a blob are read to sweep it
+                        "$addToSet": {"thread_ids": thread_id},
+                    },
+                    upsert=True,
+                )
+                for blob_hash, (type_, data) in new_blobs.items()
+            ],
+            ordered=False,
+        )
+        stored_at = time.monotonic()
+        for blob_hash, blob in new_blobs.items():
+            _lru_set(
+                self._stored_blob_hashes,
+                (thread_id, blob_hash),
+                stored_at,
+                MAX_CACHED_BLOB_HASHES,
+            )
+            _lru_set(self._blob_cache, blob_hash, blob, MAX_CACHED_BLOBS)
+
+    async def _load_tuple(self, checkpoint_tuple: CheckpointTuple) -> CheckpointTuple:
+        """Replace the blob references in a checkpoint tuple with their values."""
+        checkpoint = checkpoint_tuple.checkpoint
+        metadata = checkpoint_tuple.metadata or {}
+        values = [
+            *checkpoint["channel_values"].values(),
+            checkpoint.get("pending_sends"),
+            metadata.get("writes"),
+            *(value for _, _, value in checkpoint_tuple.pending_writes or ()),
+        ]
+        if not any(_is_blob_ref(value) for value in values):
+            return checkpoint_tuple
+
+        missing = {
+            value[BLOB_REF_KEY]
+            for value in values
+            if _is_blob_ref(value) and value[BLOB_REF_KEY] not in self._blob_cache
+        }
+        if missing:
+            async for doc in self.blob_collection.find({"_id": {"$in": list(missing)}}):
+                _lru_set(
+                    self._blob_cache,
+                    doc["_id"],
+                    (doc["type"], doc["value"]),
+                    MAX_CACHED_BLOBS,
+                )
+
+        def load(value):
+            if not _is_blob_ref(value):
+                return value
+            blob = self._blob_cache.get(value[BLOB_REF_KEY])
+            if blob is None:
+                raise KeyError(f"Checkpoint blob {value[BLOB_REF_KEY]} is missing")
+            # Deserialized on every read, since nodes may mutate the values they get
+            return self.serde.loads_typed(blob)
+
+        checkpoint = {
+            **checkpoint,
+            "channel_values": {
+                channel: load(value)
+                for channel, value in checkpoint["channel_values"].items()
+            },
+        }
+        if "pending_sends" in checkpoint:
+            checkpoint["pending_sends"] = load(checkpoint["pending_sends"])
+        if "writes" in metadata:
+            metadata = {**metadata, "writes": load(metadata["writes"])}
+        return checkpoint_tuple._replace(
+            checkpoint=checkpoint,
+            metadata=metadata,
+            pending_writes=[
+                (task_id, channel, load(value))
+                for task_id, channel, value in checkpoint_tuple.pending_writes or ()
+            ],
+        )
+
+    # ------------------------------ Reads ------------------------------
+    async def aget_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        await self._flush(
+            (
+                config["configurable"]["thread_id"],
+                config["configurable"].get("checkpoint_ns", ""),
+            )
+        )
+        checkpoint_tuple = await self.checkpointer.aget_tuple(config)
+        if checkpoint_tuple is None:
+            return None
+        return await self._load_tuple(checkpoint_tuple)
+
+    async def alist(
+        self,
+        config: RunnableConfig | None,
+        *,
+        filter: dict[str, Any] | None = None,
+        before: RunnableConfig | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        await self.aflush(config["configurable"].get("thread_id") if config else None)
+        async for checkpoint_tuple in self.checkpointer.alist(
+            config, filter=filter, before=before, limit=limit
+        ):
+            yield await self._load_tuple(checkpoint_tuple)
+
+    # ------------------------------ Retention ------------------------------
+    async def create_indexes(self):
+        """Indexes for reading the latest checkpoint of a thread, and for sweeping blobs."""
+        indexes = [
+            (
+                self.checkpointer.checkpoint_collection,
+                [("thread_id", 1), ("checkpoint_ns", 1), ("checkpoint_id", -1)],
+            ),
+            (
+                self.checkpointer.writes_collection,
+                [("thread_id", 1), ("checkpoint_ns", 1), ("checkpoint_id", 1)],
+            ),
+            (self.blob_collection, [("last_used_at", 1)]),
+            (self.blob_collection, [("thread_ids", 1), ("last_used_at", 1)]),
+        ]
+        for collection, keys in indexes:
+            try:
+                await collection.create_index(keys)
+            except OperationFailure as e:
+                logger.warning(f"Failed to create the index {keys}: {str(e)}")
+
+    async def amark_final(self, thread_id: str):
+        """Write the pending checkpoints of a thread and mark its latest one as the final one of a generation.
+
+        aprune() keeps the final checkpoints however many checkpoints come after them.
+        """
+        await self.aflush(thread_id)
+        async for doc in self.checkpointer.checkpoint_collection.find(
+            {"thread_id": thread_id, "checkpoint_ns": ""},
+            projection={"_id": 0, "checkpoint_id": 1},
+            sort=[("checkpoint_id", -1)],
+            limit=1,
+        ):
+            await self.checkpointer.checkpoint_collection.update_one(
+                {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": "",
+                    "checkpoint_id": doc["checkpoint_id"],
+                },
+                {"$set": {f"metadata.{FINAL_METADATA_KEY}": dumps_metadata(True)}},
+            )
+
+    async def aprune(
+        self, thread_id: str | None = None, keep_last: int = CHECKPOINT_KEEP_LAST
+    ) -> int:
+        """Delete the checkpoints of a thread, or of every thread, that the retention policy doesn't keep.
+
+        Kept are the last keep_last checkpoints of the root namespace and of the latest subgraph run, the final
+        checkpoint of every generation, and the last checkpoint of every older subgraph run. The writes against the
+        deleted checkpoints are deleted with them. Returns the number of deleted checkpoints.
+        """
+        if thread_id is None:
+            thread_ids = await self.checkpointer.checkpoint_collection.distinct(
+                "thread_id"
+            )
+        else:
+            thread_ids = [thread_id]
+
+        pruned_count = 0
+        for thread_id in thread_ids:
+            pruned_count += await self._prune_thread(thread_id, max(keep_last, 1))
+        return pruned_count
+
+    async def _prune_thread(self, thread_id: str, keep_last: int) -> int:
+        docs_by_ns: dict[str, list[dict]] = {}
+        async for doc in self.checkpointer.checkpoint_collection.find(
+            {"thread_id": thread_id},
+            projection={
+                "_id": 0,
+                "checkpoint_ns": 1,
+                "checkpoint_id": 1,
+                f"metadata.{FINAL_METADATA_KEY}": 1,
+            },
+        ):
+            docs_by_ns.setdefault(doc["checkpoint_ns"], []).append(doc)
+        for docs in docs_by_ns.values():
+            docs.sort(key=lambda doc: doc["checkpoint_id"], reverse=True)
+
+        # Every generation runs the subgraph in a new namespace
+        subgraph_namespaces = sorted(
+            (ns for ns in docs_by_ns if ns),
+            key=lambda ns: docs_by_ns[ns][0]["checkpoint_id"],
+        )
+        latest_namespaces = {"", *subgraph_namespaces[-1:]}
+        final = dumps_metadata(True)
+
+        pruned_count = 0
+        for checkpoint_ns, docs in docs_by_ns.items():
+            if checkpoint_ns in latest_namespaces:
+                kept = {doc["checkpoint_id"] for doc in docs[:keep_last]}
+                kept |= {
+                    doc["checkpoint_id"]
+                    for doc in docs
+                    if doc.get("metadata", {}).get(FINAL_METADATA_KEY) == final
+                }
+            else:
+                kept = {docs[0]["checkpoint_id"]}
+
+            pruned = [
+                doc["checkpoint_id"] for doc in docs if doc["checkpoint_id"] not in kept
+            ]
+            for i in range(0, len(pruned), PRUNE_BATCH_SIZE):
+                query = {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": {"$in": pruned[i : i + PRUNE_BATCH_SIZE]},
+                }
+                await self.checkpointer.checkpoint_collection.delete_many(query)
+                await self.checkpointer.writes_collection.delete_many(query)
+            pruned_count += len(pruned)
+        return pruned_count
+
+    async def asweep_blobs(
+        self,
+        thread_id: str | None = None,
+        grace_seconds: float = CHECKPOINT_BLOB_GRACE_SECONDS,
+    ) -> int:
+        """Delete the blobs that no checkpoint or write refers to anymore. Returns the number of deleted blobs.
+
+        Each blob lists the threads that refer to it. Only the checkpoints of thread_id are read, or of every thread
+        that refers to a blob unused for grace_seconds. A thread that no longer refers to a blob is taken off its
+        list, and a blob no thread refers to is deleted. Blobs written or referenced within grace_seconds are kept,
+        since the checkpoints that refer to them may not be written yet.
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace_seconds)
+        if thread_id is None:
+            thread_ids = await self.blob_collection.distinct(
+                "thread_ids", {"last_used_at": {"$lt": cutoff}}
+            )
+        else:
+            thread_ids = [thread_id]
+
+        for thread_id in thread_ids:
+            await self._sweep_thread_blobs(thread_id, cutoff)
+
+        unreferenced = [
+            doc["_id"]
+            async for doc in self.blob_collection.find(
+                {"last_used_at": {"$lt": cutoff}, "thread_ids": {"$size": 0}},
+                projection={"_id": 1},
+            )
+        ]
+        for i in range(0, len(unreferenced), PRUNE_BATCH_SIZE):
+            await self.blob_collection.delete_many(
+                {
+                    "_id": {"$in": unreferenced[i : i + PRUNE_BATCH_SIZE]},
+                    # Unless it was referenced again in the meantime
+                    "last_used_at": {"$lt": cutoff},
+                    "thread_ids": {"$size": 0},
+                }
+            )
+        return len(unreferenced)
+
+    async def _sweep_thread_blobs(self, thread_id: str, cutoff: datetime):
+        candidates = [
+            doc["_id"]
+            async for doc in self.blob_collection.find(
+                {"thread_ids": thread_id, "last_used_at": {"$lt": cutoff}},
+                projection={"_id": 1},
+            )
+        ]
+        if not candidates:
+            return
+
+        referenced = set()
+        async for doc in self.checkpointer.checkpoint_collection.find(
+            {"thread_id": thread_id},
+            projection={"type": 1, "checkpoint": 1, "metadata.writes": 1},
+        ):
+            checkpoint = self.serde.loads_typed((doc["type"], doc["checkpoint"]))
+            referenced |= _blob_hashes(
+                [
+                    *checkpoint["channel_values"].values(),
+                    checkpoint.get("pending_sends"),
+                    loads_metadata(doc.get("metadata", {})).get("writes"),
+                ]
+            )
+        async for doc in self.checkpointer.writes_collection.find(
+            {"thread_id": thread_id}, projection={"type": 1, "value": 1}
+        ):
+            referenced |= _blob_hashes(
+                [self.serde.loads_typed((doc["type"], doc["value"]))]
+            )
+
+        released = [blob_hash for blob_hash in candidates if blob_hash not in referenced]
+        for i in range(0, len(released), PRUNE_BATCH_SIZE):
+            await self.blob_collection.update_many(
+                {
+                    "_id": {"$in": released[i : i + PRUNE_BATCH_SIZE]},
+                    "last_used_at": {"$lt": cutoff},
+                },
+                {"$pull": {"thread_ids": thread_id}},
+            )
+        # Still in use. Not read again for this thread until the grace period is over.
+        kept = [blob_hash for blob_hash in candidates if blob_hash in referenced]
+        now = datetime.now(timezone.utc)
+        for i in range(0, len(kept), PRUNE_BATCH_SIZE):
+            await self.blob_collection.update_many(
+                {"_id": {"$in": kept[i : i + PRUNE_BATCH_SIZE]}},
+                {"$set": {"last_used_at": now}},
+            )
+
+
+async def compile_graph_with_async_checkpointer(graph, graph_name, checkpointer=None):
     # This function must be async for AsyncMongoClient
-    mongodb_client = AsyncMongoClient(os.getenv("MONGODB_URI_LANGGRAPH_CHECKPOINTER"))
-    checkpointer = AsyncMongoDBSaver(mongodb_client)
+    if checkpointer is None:
+        checkpointer = AsyncMongoDBSaver(create_mongodb_client())
 
     graph = graph.compile(checkpointer=checkpointer)
 
     # with open(f"./app/workflows/diagrams/{graph_name}.png", "wb") as f:
     #     f.write(graph.get_graph(xray=0).draw_mermaid_png())
 
-    return graph
\ No newline at end of file
+    return graph
+
+
+class GraphRegistry:
+    """Compiled graphs and the Mongo checkpointer shared by the whole process.
+
+    Graphs are compiled once on startup against a single pooled client instead of
+    building a new client and recompiling on every request.
+    """
+
+    def __init__(self):
+        self.mongodb_client: AsyncMongoClient | None = None
+        self.checkpointer: CoalescingCheckpointSaver | None = None
+        self.compiled_graphs = {}
+        self._prune_task: asyncio.Task | None = None
+
+    async def start(self, graphs: dict):
+        self.mongodb_client = create_mongodb_client()
+        mongodb_saver = AsyncMongoDBSaver(
+            self.mongodb_client, db_name=CHECKPOINT_DB_NAME
+        )
+        # Raises on startup if CHECKPOINT_COMPRESSION is invalid or its package isn't installed
+        mongodb_saver.serde = create_checkpoint_serializer(mongodb_saver.serde)
+        self.checkpointer = CoalescingCheckpointSaver(
+            mongodb_saver,
+            self.mongodb_client[CHECKPOINT_DB_NAME][CHECKPOINT_BLOB_COLLECTION_NAME],
+        )
+        await self.checkpointer.create_indexes()
+        if CHECKPOINT_PRUNE_INTERVAL_SECONDS > 0:
+            self._prune_task = asyncio.create_task(self._prune_periodically())
+        for graph_name, graph in graphs.items():
+            self.compiled_graphs[graph_name] = (
+                await compile_graph_with_async_checkpointer(
+                    graph, graph_name, self.checkpointer
+                )
+            )
+
+    def get(self, graph_name: str):
+        if graph_name not in self.compiled_graphs:
+            raise RuntimeError(
+                f"Graph '{graph_name}' is not compiled. Was GraphRegistry.start() called?"
+            )
+        return self.compiled_graphs[graph_name]
+
+    async def _prune_periodically(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_PRUNE_INTERVAL_SECONDS)
+            try:
+                pruned_count = await self.checkpointer.aprune()
+                swept_count = await self.checkpointer.asweep_blobs()
+                logger.info(
+                    f"Pruned {pruned_count} checkpoints and {swept_count} checkpoint blobs"
+                )
+            except Exception as e:
+                logger.error(f"Failed to prune the checkpoints: {str(e)}")
+
+    async def close(self):
+        self.compiled_graphs = {}
+        if self._prune_task is not None:
+            self._prune_task.cancel()
+            self._prune_task = None
+        if self.checkpointer is not None:
+            await self.checkpointer.aflush()
+        self.checkpointer = None
+        if self.mongodb_client is not None:
+            await self.mongodb_client.close()
+            self.mongodb_client = None
+
+
+graph_registry = GraphRegistry()
@@ -0,0 +1,213 @@
+import os
+import json
+import uuid
+import asyncio
+import logging
+from datetime import timedelta
+
+logger = logging.getLogger(__name__)
+
+# Key prefix of the in-progress marker. /graph_state tells the user to wait while it exists.
+GENERATION_LEASE_KEY_PREFIX = "tour_assistant:ids_in_progress:"
+GENERATION_EVENT_LOG_KEY_PREFIX = "tour_assistant:generation_events:"
+# Counts the generations of a thread. Bumped by a new generation and by a reset.
+GENERATION_EPOCH_KEY_PREFIX = "tour_assistant:generation_epoch:"
+# Workers stop the generation of the thread ids published here
+GENERATION_CANCEL_CHANNEL = "tour_assistant:generation_cancel"
+
+# A generation holds its lease while it runs and renews it every third of this.
+# If its worker dies, another connection can resume the generation once the lease expires.
+GENERATION_LEASE_SECONDS = int(os.getenv("GENERATION_LEASE_SECONDS", 30))
+# Events kept per thread for replaying them to reconnecting clients
+GENERATION_EVENT_LOG_MAX_LEN = int(os.getenv("GENERATION_EVENT_LOG_MAX_LEN", 2000))
+GENERATION_EVENT_LOG_TTL = timedelta(hours=1)
+FOLLOW_BLOCK_MILLISECONDS = 5000
+RELEASE_POLL_SECONDS = 0.1
+
+# Only deletes or extends the lease if it's still held by the same generation
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+_RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+# Only logs the events of the thread's current generation
+_ADD_SCRIPT = """
+if (redis.call("get", KEYS[2]) or "0") ~= ARGV[1] then
+    return false
+end
+local event_id = redis.call("xadd", KEYS[1], "MAXLEN", "~", ARGV[2], "*", "epoch", ARGV[1], ARGV[3], ARGV[4])
+redis.call("expire", KEYS[1], ARGV[5])
+return event_id
+"""
+
+
+class GenerationSuperseded(Exception):
+    """Raised when a generation logs an event after the thread was reset or a new generation started."""
+
+
+class GenerationLease:
+    """Marks a thread's generation as running, in one worker at a time.
+
+    The lease expires unless it's renewed, so a crashed worker doesn't block the thread for long. If it's lost
+    anyway, e.g. expired or revoked, its owner task is cancelled, since another generation may run the thread now.
+    The owner is also cancelled by stop(), when the thread is reset.
+    """
+
+    def __init__(self, redis_client, thread_id: str, token: str):
+        self.redis_client = redis_client
+        self.key = f"{GENERATION_LEASE_KEY_PREFIX}{thread_id}"
+        self.token = token
+        # The task that runs the generation
+        self.owner: asyncio.Task | None = None
+        # Whether the owner was cancelled because of the lease, rather than by its caller
+        self.stopped = False
+        self._renew_task: asyncio.Task | None = None
+
+    @classmethod
+    async def acquire(cls, redis_client, thread_id: str) -> "GenerationLease | None":
+        """The lease of the thread, or None if another generation holds it."""
+        lease = cls(redis_client, thread_id, uuid.uuid4().hex)
+        if not await redis_client.set(
+            lease.key, lease.token, nx=True, ex=GENERATION_LEASE_SECONDS
+        ):
+            return None
+        lease._renew_task = asyncio.create_task(lease._renew_periodically())
+        return lease
+
+    @classmethod
+    async def is_held(cls, redis_client, thread_id: str) -> bool:
+        return bool(
+            await redis_client.exists(f"{GENERATION_LEASE_KEY_PREFIX}{thread_id}")
+        )
+
+    @classmethod
+    async def wait_released(
+        cls, redis_client, thread_id: str, timeout: float = GENERATION_LEASE_SECONDS
+    ) -> bool:
+        """Wait until no generation holds the lease of the thread. False if one still does after timeout seconds."""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while await cls.is_held(redis_client, thread_id):
+            if asyncio.get_running_loop().time() >= deadline:
+                return False
+            await asyncio.sleep(RELEASE_POLL_SECONDS)
+        return True
+
+    @classmethod
+    async def revoke(cls, redis_client, thread_id: str):
+        """Delete the lease of the thread, whoever holds it. Its generation stops when it next renews it."""
+        await redis_client.delete(f"{GENERATION_LEASE_KEY_PREFIX}{thread_id}")
+
+    def stop(self):
+        """Cancel the owner task."""
+        self.stopped = True
+        if self.owner is not None:
+            self.owner.cancel()
+
+    async def _renew_periodically(self):
+        while True:
+            await asyncio.sleep(GENERATION_LEASE_SECONDS / 3)
+            try:
+                if not await self.redis_client.eval(
+                    _RENEW_SCRIPT, 1, self.key, self.token, GENERATION_LEASE_SECONDS
+                ):
+                    logger.error(f"Lost the generation lease {self.key}")
+                    self.stop()
+                    return
+            except Exception as e:
+                logger.error(
+                    f"Failed to renew the generation lease {self.key}: {str(e)}"
+                )
+
+    async def release(self):
+        if self._renew_task is not None:
+            self._renew_task.cancel()
+        await self.redis_client.eval(_RELEASE_SCRIPT, 1, self.key, self.token)
+
+
+class GenerationEventLog:
+    """Bounded per-thread log of the events a generation sends to the client, in a Redis stream.
+
+    Each event is tagged with the epoch of its generation, and only the current generation of a thread can log
+    events, so that one that was reset or replaced can't mix its events into the next one's.
+    """
+
+    START = "0"
+
+    def __init__(self, redis_client, max_len: int = GENERATION_EVENT_LOG_MAX_LEN):
+        self.redis_client = redis_client
+        self.max_len = max_len
+
+    def key(self, thread_id: str) -> str:
+        return f"{GENERATION_EVENT_LOG_KEY_PREFIX}{thread_id}"
+
+    def epoch_key(self, thread_id: str) -> str:
+        return f"{GENERATION_EPOCH_KEY_PREFIX}{thread_id}"
+
+    async def epoch(self, thread_id: str) -> int:
+        """The epoch of the thread's current generation."""
+        return int(await self.redis_client.get(self.epoch_key(thread_id)) or 0)
+
+    async def next_epoch(self, thread_id: str) -> int:
+        """Supersede the thread's current generation. Its events are no longer logged."""
+        return await self.redis_client.incr(self.epoch_key(thread_id))
+
+    async def reset(self, thread_id: str):
+        """Start the log of a new generation."""
+        await self.redis_client.delete(self.key(thread_id))
+
+    async def append(self, thread_id: str, epoch: int, event: dict) -> str:
+        return await self._add(thread_id, epoch, "event", json.dumps(event))
+
+    async def end(self, thread_id: str, epoch: int) -> str:
+        """Mark the generation as finished, so that followers stop."""
+        return await self._add(thread_id, epoch, "end", "1")
+
+    async def _add(self, thread_id: str, epoch: int, field: str, value: str) -> str:
+        event_id = await self.redis_client.eval(
+            _ADD_SCRIPT,
+            2,
+            self.key(thread_id),
+            self.epoch_key(thread_id),
+            epoch,
+            self.max_len,
+            field,
+            value,
+            int(GENERATION_EVENT_LOG_TTL.total_seconds()),
+        )
+        if event_id is None:
+            raise GenerationSuperseded(
+                f"Generation {epoch} of user ID {thread_id} was superseded"
+            )
+        return event_id
+
+    async def is_unfinished(self, thread_id: str) -> bool:
+        """Whether a generation logged events but stopped before it ended, e.g. with its worker."""
+        last = await self.redis_client.xrevrange(self.key(thread_id), count=1)
+        return bool(last) and "end" not in last[0][1]
+
+    async def read(
+        self, thread_id: str, after_id: str = START, block: int | None = None
+    ) -> list[tuple[str, int, dict | None]]:
+        """Entries after after_id as (event_id, epoch, event). The event is None for the end of a generation.
+
+        Event ids are stream ids, which increase. If block is given, waits up to that many milliseconds for an entry.
+        """
+        response = await self.redis_client.xread(
+            {self.key(thread_id): after_id}, block=block
+        )
+        return [
+            (
+                event_id,
+                int(fields["epoch"]),
+                None if "end" in fields else json.loads(fields["event"]),
+            )
+            for _, entries in response or []
+            for event_id, fields in entries
+        ]
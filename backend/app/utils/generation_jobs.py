@@ -0,0 +1,402 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import timedelta
+from typing import AsyncIterator, Callable
+from varname import nameof as n
+
+from app.state import Stage
+from app.utils.compile_graph import graph_registry
+from app.utils.schedule_projection import latest_schedules
+from app.utils.generation_events import (
+    FOLLOW_BLOCK_MILLISECONDS,
+    GENERATION_CANCEL_CHANNEL,
+    GENERATION_LEASE_KEY_PREFIX,
+    GenerationEventLog,
+    GenerationLease,
+    GenerationSuperseded,
+)
+from app.utils.utils import run_in_background
+from app.workflows.generate_schedule_graph import (
+    add_fixed_schedules,
+    fill_schedule_loop,
+    add_terminal_schedules,
+    fill_terminal_transportation_schedule,
+    validate_full_schedule_loop,
+    fill_schedule_reflection,
+    fill_schedule_day,
+    cancel_background_tasks,
+)
+
+logger = logging.getLogger(__name__)
+
+GENERATION_QUEUE_KEY = "tour_assistant:generation_queue"
+# Marks a user's job as queued, so that it isn't queued twice
+GENERATION_QUEUED_KEY_PREFIX = "tour_assistant:generation_queued:"
+GENERATION_QUEUED_TTL = timedelta(minutes=30)
+
+# Workers run in the API process. Set to 0 to run them only in worker processes (python worker.py).
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", 4))
+# Admission control: new generations are refused while this many are waiting for a worker
+GENERATION_QUEUE_MAX_LEN = int(os.getenv("GENERATION_QUEUE_MAX_LEN", 20))
+DEQUEUE_TIMEOUT_SECONDS = 5
+
+# Queues a generation unless one is queued or running. A new generation gets the next epoch and a new event log.
+# Returns the epoch, -1 if one is queued or running, or -2 if the queue is full.
+_ENQUEUE_SCRIPT = """
+if redis.call("exists", KEYS[1]) == 1 or not redis.call("set", KEYS[2], "1", "NX", "EX", ARGV[1]) then
+    return -1
+end
+if redis.call("llen", KEYS[5]) >= tonumber(ARGV[2]) then
+    redis.call("del", KEYS[2])
+    return -2
+end
+if ARGV[3] == "1" then
+    return tonumber(redis.call("get", KEYS[3]) or "0")
+end
+redis.call("del", KEYS[4])
+return redis.call("incr", KEYS[3])
+"""
+
+
+class GenerationQueueFull(Exception):
+    """Raised when the workers are saturated and the queue is at GENERATION_QUEUE_MAX_LEN."""
+
+
+def get_generation_events(stream_mode: str, data: dict) -> list[dict]:
+    """What subscribers are sent for a chunk of the graph stream."""
+    if stream_mode == "custom":
+        return [{**data, "data_type": "reasoning_steps"}]
+
+    update_dict = (
+        data.get(n(add_fixed_schedules))
+        or data.get(n(add_terminal_schedules))
+        or data.get(n(fill_schedule_loop))
+        or data.get(n(fill_schedule_reflection))
+        or data.get(n(fill_schedule_day))
+        or data.get(n(fill_terminal_transportation_schedule))
+        or data.get(n(validate_full_schedule_loop))
+    )
+    if not update_dict:
+        return []
+    # Some updates of these nodes don't touch the schedule
+    return [
+        {**schedule.model_dump(), "data_type": "schedule"}
+        for schedule in update_dict.get("schedule_list", [])
+    ]
+
+
+class GenerationJobQueue:
+    """Generations waiting for a worker, in a Redis list shared by the API and worker processes.
+
+    A user has at most one generation queued or running. Its events are read from the GenerationEventLog.
+    Jobs carry the epoch of their generation, and a job of a superseded generation is skipped.
+    """
+
+    def __init__(
+        self,
+        redis_client,
+        event_log: GenerationEventLog,
+        max_len: int = GENERATION_QUEUE_MAX_LEN,
+    ):
+        self.redis_client = redis_client
+        self.event_log = event_log
+        self.max_len = max_len
+
+    def _queued_key(self, thread_id: str) -> str:
+        return f"{GENERATION_QUEUED_KEY_PREFIX}{thread_id}"
+
+    @staticmethod
+    def _job(thread_id: str, resume: bool, epoch: int) -> str:
+        return json.dumps({"thread_id": thread_id, "resume": resume, "epoch": epoch})
+
+    async def enqueue(self, thread_id: str, resume: bool = False) -> bool:
+        """Queue a generation, or with resume, the continuation of an unfinished one from its checkpoint.
+
+        Returns False if the user's generation is already queued or running, including one that is being stopped
+        and hasn't released its lease yet. Raises GenerationQueueFull if the workers are saturated.
+        """
+        # Atomic, so that the lease can't be taken between checking it and queueing the job.
+        # Subscribers that connect before a worker picks a new job up don't see the end of the last one.
+        epoch = await self.redis_client.eval(
+            _ENQUEUE_SCRIPT,
+            5,
+            f"{GENERATION_LEASE_KEY_PREFIX}{thread_id}",
+            self._queued_key(thread_id),
+            self.event_log.epoch_key(thread_id),
+            self.event_log.key(thread_id),
+            GENERATION_QUEUE_KEY,
+            int(GENERATION_QUEUED_TTL.total_seconds()),
+            self.max_len,
+            "1" if resume else "0",
+        )
+        if epoch == -1:
+            return False
+        if epoch == -2:
+            raise GenerationQueueFull(
+                f"{self.max_len} generations are waiting for a worker"
+            )
+        await self.redis_client.lpush(
+            GENERATION_QUEUE_KEY, self._job(thread_id, resume, epoch)
+        )
+        return True
+
+    async def dequeue(self, timeout: int = DEQUEUE_TIMEOUT_SECONDS) -> dict | None:
+        """The oldest job, or None if there's none within timeout seconds."""
+        popped = await self.redis_client.brpop([GENERATION_QUEUE_KEY], timeout=timeout)
+        return json.loads(popped[1]) if popped else None
+
+    async def clear_queued(self, thread_id: str):
+        await self.redis_client.delete(self._queued_key(thread_id))
+
+    async def reset(self, thread_id: str):
+        """Drop the user's queued job and its events, and stop the running generation.
+
+        Returns once the generation stopped and wrote its last checkpoint, so that it doesn't overwrite the state
+        that comes after the reset.
+        """
+        epoch = await self.event_log.epoch(thread_id)
+        for resume in [False, True]:
+            await self.redis_client.lrem(
+                GENERATION_QUEUE_KEY, 0, self._job(thread_id, resume, epoch)
+            )
+        # Its events aren't logged anymore, and a worker that already dequeued its job skips it
+        await self.event_log.next_epoch(thread_id)
+        await self.clear_queued(thread_id)
+
+        if await GenerationLease.is_held(self.redis_client, thread_id):
+            await self.redis_client.publish(GENERATION_CANCEL_CHANNEL, thread_id)
+            if not await GenerationLease.wait_released(self.redis_client, thread_id):
+                # Its worker doesn't respond. It stops when it next renews the lease.
+                logger.error(
+                    f"The generation of user ID {thread_id} didn't stop. Revoking its lease."
+                )
+                await GenerationLease.revoke(self.redis_client, thread_id)
+        await self.event_log.reset(thread_id)
+
+    async def is_queued(self, thread_id: str) -> bool:
+        return bool(await self.redis_client.exists(self._queued_key(thread_id)))
+
+    async def is_pending(self, thread_id: str) -> bool:
+        """Whether the user's generation is queued, running, or was cut off and can be resumed."""
+        return (
+            await self.is_queued(thread_id)
+            or await GenerationLease.is_held(self.redis_client, thread_id)
+            or await self.event_log.is_unfinished(thread_id)
+        )
+
+    async def depth(self) -> int:
+        return await self.redis_client.llen(GENERATION_QUEUE_KEY)
+
+    async def follow(
+        self, thread_id: str, after_id: str = GenerationEventLog.START
+    ) -> AsyncIterator[tuple[str, dict]]:
+        """Events of the user's current generation after after_id as (event_id, event), until it ends.
+
+        Event ids are "<epoch>:<stream id>". An id of an earlier generation replays the current one from its start.
+        If its worker died, the generation is queued again to continue from its checkpoint. Stops if nothing is
+        queued, running or unfinished, or once the generation is superseded.
+        """
+        epoch = await self.event_log.epoch(thread_id)
+        after_epoch, _, after_stream_id = after_id.rpartition(":")
+        stream_id = (
+            after_stream_id if after_epoch == str(epoch) else GenerationEventLog.START
+        )
+
+        while True:
+            entries = await self.event_log.read(
+                thread_id, stream_id, block=FOLLOW_BLOCK_MILLISECONDS
+            )
+            for stream_id, event_epoch, event in entries:
+                if event_epoch > epoch:
+                    return
+                if event_epoch < epoch:
+                    continue
+                if event is None:
+                    return
+                yield f"{epoch}:{stream_id}", event
+            if entries or await self.is_queued(thread_id):
+                continue
+            if await self.event_log.epoch(thread_id) != epoch:
+                return
+            if await GenerationLease.is_held(self.redis_client, thread_id):
+                continue
+            if not await self.event_log.is_unfinished(thread_id):
+                return
+            logger.critical(
+                f"Queueing the unfinished generation of user ID {thread_id}"
+            )
+            try:
+                await self.enqueue(thread_id, resume=True)
+            except GenerationQueueFull:
+                pass  # Tried again after the next wait
+
+
+class GenerationWorkerPool:
+    """Async workers that run the queued generations with the entry graph and log their events.
+
+    Runs in the API process, or in separate worker processes with the same Redis and MongoDB, so that API nodes
+    and generation workers scale independently.
+    """
+
+    def __init__(
+        self,
+        job_queue: GenerationJobQueue,
+        num_workers: int = GENERATION_WORKERS,
+    ):
+        self.job_queue = job_queue
+        self.num_workers = num_workers
+        self.busy_workers = 0
+        self._tasks: list[asyncio.Task] = []
+        # Leases of the generations running in this process, by thread_id
+        self._leases: dict[str, GenerationLease] = {}
+
+    def start(self, get_workflow: Callable):
+        for i in range(self.num_workers):
+            self._tasks.append(
+                asyncio.create_task(
+                    self._work(get_workflow), name=f"generation_worker_{i}"
+                )
+            )
+        if self.num_workers:
+            self._tasks.append(
+                asyncio.create_task(
+                    self._stop_cancelled(), name="generation_cancellations"
+                )
+            )
+
+    async def close(self):
+        # A generation cut off here stays unfinished. Its subscribers queue it again for another worker.
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def wait(self):
+        await asyncio.gather(*self._tasks)
+
+    def metrics(self) -> dict:
+        return {"workers": self.num_workers, "busy_workers": self.busy_workers}
+
+    async def _stop_cancelled(self):
+        """Stop the generations that GenerationJobQueue.reset() cancels."""
+        while True:
+            try:
+                async with self.job_queue.redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(GENERATION_CANCEL_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        lease = self._leases.get(message["data"])
+                        if lease is not None:
+                            lease.stop()
+            except Exception as e:
+                # Until it's back, reset() revokes the leases instead, and generations stop when they renew them
+                logger.error(f"Failed to listen for generation cancellations: {str(e)}")
+                await asyncio.sleep(DEQUEUE_TIMEOUT_SECONDS)
+
+    async def _work(self, get_workflow: Callable):
+        while True:
+            try:
+                job = await self.job_queue.dequeue()
+            except Exception as e:
+                logger.error(f"Failed to dequeue a generation: {str(e)}")
+                await asyncio.sleep(DEQUEUE_TIMEOUT_SECONDS)
+                continue
+            if job is None:
+                continue
+            self.busy_workers += 1
+            try:
+                await self.run(
+                    get_workflow(), job["thread_id"], job["resume"], job.get("epoch")
+                )
+            except Exception as e:
+                logger.error(
+                    f"Generation of user ID {job['thread_id']} failed: {str(e)}"
+                )
+            finally:
+                self.busy_workers -= 1
+
+    async def run(
+        self, workflow, thread_id: str, resume: bool = False, epoch: int | None = None
+    ):
+        event_log = self.job_queue.event_log
+        lease = await GenerationLease.acquire(self.job_queue.redis_client, thread_id)
+        await self.job_queue.clear_queued(thread_id)
+        if lease is None:
+            return  # Another worker runs it
+        current_epoch = await event_log.epoch(thread_id)
+        if epoch is not None and epoch != current_epoch:
+            # Reset after it was queued
+            await lease.release()
+            return
+
+        self._leases[thread_id] = lease
+        lease.owner = asyncio.create_task(
+            self._generate(workflow, thread_id, resume, current_epoch),
+            name=f"generate_schedule:{thread_id}",
+        )
+        try:
+            await lease.owner
+        except asyncio.CancelledError:
+            if not lease.stopped:
+                raise
+            # Another worker may run it, or the state was reset. Its events are no longer ours to end.
+            logger.error(
+                f"Stopped the generation of user ID {thread_id}, which lost its lease or was reset"
+            )
+        except GenerationSuperseded:
+            logger.error(
+                f"Stopped the generation of user ID {thread_id}, which was superseded"
+            )
+        finally:
+            self._leases.pop(thread_id, None)
+            cancel_background_tasks(thread_id)
+            try:
+                # Checkpoints are written in batches. Write the last one now for the other workers, marked so that
+                # pruning keeps it. Before releasing the lease, since a reset waits for it to write over it.
+                await graph_registry.checkpointer.amark_final(thread_id)
+            finally:
+                await lease.release()
+            await latest_schedules.refresh(workflow, thread_id)
+            run_in_background(
+                graph_registry.checkpointer.aprune(thread_id),
+                name="prune_checkpoints",
+            )
+
+    async def _generate(self, workflow, thread_id: str, resume: bool, epoch: int):
+        event_log = self.job_queue.event_log
+        logger.critical(f"Generating the schedule of user ID {thread_id}")
+
+        config = {
+            "recursion_limit": int(os.environ.get("RECURSION_LIMIT")),
+            "configurable": {
+                "thread_id": thread_id,
+            },
+        }
+        if resume:
+            if not (await workflow.aget_state(config)).next:
+                await event_log.end(thread_id, epoch)
+                return
+            # Continue from the last checkpoint, so that the LLM calls it finished aren't made again
+            graph_input = None
+        else:
+            graph_input = {"current_stage": Stage.FIRST_GENERATION}
+
+        try:
+            async for graph_namespace, stream_mode, data in workflow.astream(
+                graph_input,
+                stream_mode=["custom", "updates"],
+                config=config,
+                subgraphs=True,
+            ):
+                for event in get_generation_events(stream_mode, data):
+                    await event_log.append(thread_id, epoch, event)
+        except GenerationSuperseded:
+            raise
+        except Exception:
+            # Not resumed after an error. Only a stopped worker leaves the generation unfinished.
+            await event_log.end(thread_id, epoch)
+            raise
+        await event_log.end(thread_id, epoch)
@@ -0,0 +1,210 @@
+import os
+import time
+import asyncio
+from enum import Enum
+from collections import deque
+from contextvars import ContextVar
+from contextlib import asynccontextmanager, contextmanager
+
+
+class Provider(str, Enum):
+    ANTHROPIC = "anthropic"
+    OPENAI = "openai"
+    PERPLEXITY = "perplexity"
+
+
+# (max concurrent calls, requests per minute) for each provider. Can be overridden with env variables,
+# e.g. ANTHROPIC_MAX_CONCURRENCY=20, ANTHROPIC_REQUESTS_PER_MINUTE=50
+DEFAULT_PROVIDER_LIMITS = {
+    Provider.ANTHROPIC: (20, 50),
+    Provider.OPENAI: (20, 500),
+    Provider.PERPLEXITY: (10, 50),
+}
+
+ANONYMOUS_USER = "anonymous"
+
+# The user the model calls of the current task are made for. Set with LLMRateLimiter.for_user().
+current_user_id: ContextVar[str | None] = ContextVar("current_user_id", default=None)
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second
+        )
+        self.updated_at = now
+
+    def try_acquire(self) -> float:
+        """Take a token if there is one. Otherwise return the seconds to wait until the next token."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate_per_second
+
+
+class ProviderLimiter:
+    """Caps in-flight calls and request rate for a single provider.
+
+    Waiters are queued per user and served round-robin, so a user who fans out many calls at once
+    can't starve the others. The limits apply per process: with several workers, divide the provider's limits
+    by the number of workers.
+    """
+
+    def __init__(self, provider: Provider, max_concurrency: int, requests_per_minute: int):
+        self.provider = provider
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(
+            rate_per_second=requests_per_minute / 60,
+            capacity=max(1, min(max_concurrency, requests_per_minute)),
+        )
+        self.in_flight = 0
+        self.waiters: dict[str, deque[asyncio.Future]] = {}  # insertion order is the round-robin order
+        self._dispatch_handle: asyncio.TimerHandle | None = None
+
+        self.total_acquired = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(q) for q in self.waiters.values())
+
+    async def acquire(self, user_id: str | None = None):
+        user_id = user_id or ANONYMOUS_USER
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(user_id, deque()).append(future)
+        enqueued_at = time.monotonic()
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted right before the cancellation
+                self.release()
+            else:
+                self._remove_waiter(user_id, future)
+            raise
+
+        wait_seconds = time.monotonic() - enqueued_at
+        self.total_acquired += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def limit(self, user_id: str | None = None):
+        await self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def metrics(self) -> dict:
+        return {
+            "provider": self.provider.value,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self.queue_depth,
+            "queued_users": len(self.waiters),
+            "total_acquired": self.total_acquired,
+            "avg_wait_seconds": (
+                round(self.total_wait_seconds / self.total_acquired, 4)
+                if self.total_acquired
+                else 0.0
+            ),
+            "max_wait_seconds": round(self.max_wait_seconds, 4),
+        }
+
+    def _remove_waiter(self, user_id: str, future: asyncio.Future):
+        queue = self.waiters.get(user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            pass
+        if not queue:
+            del self.waiters[user_id]
+
+    def _dispatch(self):
+        while self.in_flight < self.max_concurrency and self.waiters:
+            if self._dispatch_handle is not None:
+                # Already waiting for the bucket to refill
+                return
+
+            retry_after = self.bucket.try_acquire()
+            if retry_after > 0:
+                self._dispatch_handle = asyncio.get_running_loop().call_later(
+                    retry_after, self._on_bucket_refilled
+                )
+                return
+
+            # Serve the user at the front, then move them to the back of the rotation
+            user_id = next(iter(self.waiters))
+            queue = self.waiters.pop(user_id)
+            future = queue.popleft()
+            if queue:
+                self.waiters[user_id] = queue
+
+            if future.done():
+                # Cancelled while waiting. Give the token back, without going over the burst capacity.
+                self.bucket.tokens = min(self.bucket.capacity, self.bucket.tokens + 1)
+                continue
+
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _on_bucket_refilled(self):
+        self._dispatch_handle = None
+        self._dispatch()
+
+
+class LLMRateLimiter:
+    """Process-wide limiter shared by every node that calls an LLM or search provider.
+
+    The models of app.llms wait for the limiter of their own provider on every call, fallbacks included.
+    Nodes only say which user the calls are for with for_user().
+    """
+
+    def __init__(self):
+        self.limiters: dict[Provider, ProviderLimiter] = {}
+        for provider, (max_concurrency, requests_per_minute) in DEFAULT_PROVIDER_LIMITS.items():
+            prefix = provider.value.upper()
+            self.limiters[provider] = ProviderLimiter(
+                provider,
+                max_concurrency=int(
+                    os.getenv(f"{prefix}_MAX_CONCURRENCY", max_concurrency)
+                ),
+                requests_per_minute=int(
+                    os.getenv(f"{prefix}_REQUESTS_PER_MINUTE", requests_per_minute)
+                ),
+            )
+
+    def limit(self, provider: Provider, user_id: str | None = None):
+        return self.limiters[provider].limit(user_id)
+
+    @contextmanager
+    def for_user(self, user_id: str | None):
+        token = current_user_id.set(user_id)
+        try:
+            yield
+        finally:
+            current_user_id.reset(token)
+
+    def metrics(self) -> list[dict]:
+        return [limiter.metrics() for limiter in self.limiters.values()]
+
+
+llm_rate_limiter = LLMRateLimiter()
@@ -0,0 +1,103 @@
+import logging
+from datetime import datetime, timezone
+
+from pydantic_core import to_jsonable_python
+from pymongo.errors import DuplicateKeyError
+from langgraph.types import StateSnapshot
+
+from app.state import InputState
+
+logger = logging.getLogger(__name__)
+
+# What the frontend shows: the user, the trip and its schedule
+PROJECTED_FIELDS = [*InputState.model_fields, "schedule_list"]
+
+
+def project_state(values: dict) -> dict:
+    """The JSON-able part of a thread's state that the frontend reads."""
+    return {
+        field: to_jsonable_python(values[field])
+        for field in PROJECTED_FIELDS
+        if field in values
+    }
+
+
+class LatestScheduleStore:
+    """Denormalized latest schedule of each thread, so that it's read with one lookup instead of deserializing
+    the whole checkpoint.
+
+    Refreshed from the checkpointer after a generation and after each update of the state. A snapshot never
+    overwrites one of a later checkpoint. Errors are logged and treated as misses, since the checkpointer
+    remains the source of truth.
+    """
+
+    def __init__(
+        self,
+        db_name: str = "checkpointing_db",
+        collection_name: str = "latest_schedules",
+    ):
+        self.db_name = db_name
+        self.collection_name = collection_name
+        self.collection = None
+
+    def start(self, mongodb_client):
+        self.collection = mongodb_client[self.db_name][self.collection_name]
+
+    async def get(self, thread_id: str) -> dict | None:
+        if self.collection is None:
+            return None
+        try:
+            doc = await self.collection.find_one({"_id": thread_id}, {"state": 1})
+        except Exception as e:
+            logger.error(
+                f"Failed to read the latest schedule of {thread_id}: {str(e)}"
+            )
+            return None
+        return doc["state"] if doc else None
+
+    async def set(self, thread_id: str, snapshot: StateSnapshot):
+        checkpoint_id = snapshot.config["configurable"].get("checkpoint_id")
+        if self.collection is None or not snapshot.values or not checkpoint_id:
+            return
+        try:
+            await self.collection.update_one(
+                {"_id": thread_id, "checkpoint_id": {"$lt": checkpoint_id}},
+                {
+                    "$set": {
+                        "state": project_state(snapshot.values),
+                        "checkpoint_id": checkpoint_id,
+                        "updated_at": datetime.now(timezone.utc),
+                    }
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            pass  # Already has a later snapshot
+        except Exception as e:
+            logger.error(
+                f"Failed to write the latest schedule of {thread_id}: {str(e)}"
+            )
+
+    async def refresh(self, compiled_graph, thread_id: str):
+        """Project the latest checkpoint of a thread. If it can't be read, the stale projection is dropped."""
+        config = {"configurable": {"thread_id": thread_id}}
+        try:
+            snapshot = await compiled_graph.aget_state(config)
+        except Exception as e:
+            logger.error(f"Failed to read the state of {thread_id}: {str(e)}")
+            await self.delete(thread_id)
+            return
+        await self.set(thread_id, snapshot)
+
+    async def delete(self, thread_id: str):
+        if self.collection is None:
+            return
+        try:
+            await self.collection.delete_one({"_id": thread_id})
+        except Exception as e:
+            logger.error(
+                f"Failed to delete the latest schedule of {thread_id}: {str(e)}"
+            )
+
+
+latest_schedules = LatestScheduleStore()
@@ -0,0 +1,242 @@
+from enum import Enum
+from datetime import datetime, timedelta
+from pydantic import BaseModel
+
+from app.state import (
+    ScheduleItem,
+    ScheduleItemType,
+    ScheduleList,
+    is_fixed_schedule_id,
+    parse_datetime,
+)
+from app.utils.cache import normalize_text
+from app.utils.utils import (
+    MEAL_WINDOWS,
+    get_daily_windows,
+    get_schedule_item_interval,
+    get_schedule_items_near,
+)
+
+MOVING_TYPES = {ScheduleItemType.TRANSPORT, ScheduleItemType.WALK}
+ACCOMMODATION_WORDS = {"accommodation", "hotel", "hostel", "airbnb", "lodging"}
+
+# A meal time only counts if at least this much of it is within the trip and the user's day
+MIN_MEAL_WINDOW = timedelta(hours=1)
+
+
+class ScheduleRule(str, Enum):
+    MEALS = "meals"
+    TRANSPORTATION = "transportation"
+    RETURN_TO_ACCOMMODATION = "return_to_accommodation"
+    DUPLICATES = "duplicates"
+
+
+class ScheduleViolation(BaseModel):
+    rule: ScheduleRule
+    message: str
+    window_start: datetime
+    window_end: datetime
+    item_ids: list[int] = []
+
+
+def _same_place(a: str | None, b: str | None) -> bool:
+    a, b = normalize_text(a), normalize_text(b)
+    if not a or not b:
+        return True  # Can't tell. Don't report it.
+    return a == b or a in b or b in a
+
+
+def _is_at_accommodation(item: ScheduleItem, accommodation_location: str) -> bool:
+    accommodation = normalize_text(accommodation_location)
+    for text in (item.location, item.title):
+        text = normalize_text(text)
+        if accommodation and accommodation in text:
+            return True
+        if ACCOMMODATION_WORDS & set(text.split()):
+            return True
+    return False
+
+
+def validate_schedule(
+    schedule_items: list[ScheduleItem],
+    trip_accommodation_location: str,
+    trip_start_of_day_at: str,
+    trip_end_of_day_at: str,
+) -> list[ScheduleViolation]:
+    """Check the mechanical rules of a filled schedule. Runs in linear time without calling an LLM.
+
+    The schedule must start and end with the terminals. Returns an empty list if all rules are met.
+    """
+    if not isinstance(schedule_items, ScheduleList):
+        schedule_items = ScheduleList(schedule_items)
+    items = [
+        item for item in schedule_items if item.time.parsed_times()[0] is not None
+    ]
+    if (
+        len(items) < 2
+        or items[0].activity_type != ScheduleItemType.TERMINAL
+        or items[-1].activity_type != ScheduleItemType.TERMINAL
+    ):
+        return []
+
+    intervals = {item.id: get_schedule_item_interval(item) for item in items}
+    arrival, departure = intervals[items[0].id][0], intervals[items[-1].id][1]
+    windows = get_daily_windows(
+        arrival,
+        departure,
+        parse_datetime(trip_start_of_day_at).time(),
+        parse_datetime(trip_end_of_day_at).time(),
+    )
+
+    # Items of each day, by the daily window their start falls in
+    items_by_window: list[list[ScheduleItem]] = [[] for _ in windows]
+    window_index = 0
+    for item in items:
+        start = intervals[item.id][0]
+        while window_index < len(windows) and windows[window_index][1] <= start:
+            window_index += 1
+        if window_index < len(windows) and windows[window_index][0] <= start:
+            items_by_window[window_index].append(item)
+
+    fixed_intervals = [intervals[item.id] for item in items if is_fixed_schedule_id(item.id)]
+
+    return [
+        *_check_meals(windows, items_by_window, fixed_intervals),
+        *_check_transportation(items, intervals),
+        *_check_return_to_accommodation(
+            windows, items_by_window, arrival, departure, trip_accommodation_location
+        ),
+        *_check_duplicates(items, intervals, trip_accommodation_location),
+    ]
+
+
+def _check_meals(windows, items_by_window, fixed_intervals):
+    violations = []
+    for (window_start, window_end), day_items in zip(windows, items_by_window):
+        expected = 0
+        for meal_start, meal_end in MEAL_WINDOWS:
+            meal_start = datetime.combine(window_start.date(), meal_start)
+            meal_end = datetime.combine(window_start.date(), meal_end)
+            # Meal times before arrival, after departure, or outside the user's day are not expected
+            if (
+                min(meal_end, window_end) - max(meal_start, window_start)
+                < MIN_MEAL_WINDOW
+            ):
+                continue
+            # Neither are the ones the user's own schedules overlap with
+            if any(
+                start < meal_end and meal_start < end for start, end in fixed_intervals
+            ):
+                continue
+            expected += 1
+
+        meals = [
+            item for item in day_items if item.activity_type == ScheduleItemType.MEAL
+        ]
+        if len(meals) < expected:
+            violations.append(
+                ScheduleViolation(
+                    rule=ScheduleRule.MEALS,
+                    message=f"{window_start.date()} has {len(meals)} meal(s), but {expected} are expected.",
+                    window_start=window_start,
+                    window_end=window_end,
+                    item_ids=[item.id for item in meals],
+                )
+            )
+    return violations
+
+
+def _check_transportation(items, intervals):
+    violations = []
+    previous = None
+    moved = False
+    for item in items:
+        if item.activity_type in MOVING_TYPES:
+            moved = True
+            continue
+
+        if (
+            previous is not None
+            and not moved
+            and intervals[previous.id][0].date() == intervals[item.id][0].date()
+            and not _same_place(previous.location, item.location)
+        ):
+            violations.append(
+                ScheduleViolation(
+                    rule=ScheduleRule.TRANSPORTATION,
+                    message=f"No transportation between '{previous.title}' at {previous.location} and '{item.title}' at {item.location}.",
+                    window_start=intervals[previous.id][0],
+                    window_end=intervals[item.id][1],
+                    item_ids=[previous.id, item.id],
+                )
+            )
+        previous = item
+        moved = False
+    return violations
+
+
+def _check_return_to_accommodation(
+    windows, items_by_window, arrival, departure, trip_accommodation_location
+):
+    violations = []
+    for (window_start, window_end), day_items in zip(windows, items_by_window):
+        # Not required on arrival and departure days
+        if window_start.date() in (arrival.date(), departure.date()) or not day_items:
+            continue
+
+        last_item = day_items[-1]
+        if not _is_at_accommodation(last_item, trip_accommodation_location):
+            violations.append(
+                ScheduleViolation(
+                    rule=ScheduleRule.RETURN_TO_ACCOMMODATION,
+                    message=f"{window_start.date()} ends with '{last_item.title}' at {last_item.location}, not at the accommodation.",
+                    window_start=min(last_item.time.parsed_times()[0], window_end),
+                    window_end=window_end,
+                    item_ids=[last_item.id],
+                )
+            )
+    return violations
+
+
+def _check_duplicates(items, intervals, accommodation_location):
+    violations = []
+    seen: dict[tuple[ScheduleItemType, str], ScheduleItem] = {}
+    for item in items:
+        # Only venues count. Breakfast at the hotel or going back to it every day is not a duplicate.
+        if (
+            item.activity_type in MOVING_TYPES
+            or item.activity_type
+            in (ScheduleItemType.TERMINAL, ScheduleItemType.OTHER)
+            or _is_at_accommodation(item, accommodation_location)
+        ):
+            continue
+        key = (item.activity_type, normalize_text(item.title))
+        if key not in seen:
+            seen[key] = item
+            continue
+
+        original = seen[key]
+        violations.append(
+            ScheduleViolation(
+                rule=ScheduleRule.DUPLICATES,
+                message=f"'{item.title}' is scheduled twice.",
+                window_start=intervals[item.id][0],
+                window_end=intervals[item.id][1],
+                item_ids=[original.id, item.id],
+            )
+        )
+    return violations
+
+
+def get_items_around_violations(
+    schedule_items: list[ScheduleItem],
+    violations: list[ScheduleViolation],
+    margin: timedelta = timedelta(hours=1),
+) -> list[ScheduleItem]:
+    """Schedule items near the violations: within margin of their windows, or referenced by them."""
+    return get_schedule_items_near(
+        schedule_items,
+        [(v.window_start, v.window_end) for v in violations],
+        margin,
+        include_ids={item_id for v in violations for item_id in v.item_ids},
+    )
@@ -0,0 +1,304 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Callable
+
+import numpy as np
+
+from app.utils.cache import normalize_text
+from app.utils.utils import run_in_background
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "data/semantic_query_cache")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.75))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 5000))
+HASHING_EMBEDDING_DIM = 256
+
+# Words that don't change what a travel search query is about
+STOPWORDS = {
+    "a", "an", "the", "in", "at", "on", "of", "to", "for", "and", "or", "with", "near",
+    "best", "top", "good", "great", "popular", "famous", "most", "must", "visit", "see",
+    "places", "place", "things", "do", "what", "where", "which", "are", "is",
+}
+# Words that change the results while barely changing the similarity, after folding plurals
+QUALIFIERS = {
+    "cheap", "budget", "affordable", "free", "luxury", "expensive", "halal", "vegan", "vegetarian",
+    "kosher", "gluten", "kid", "children", "family", "night", "late", "rooftop", "indoor", "outdoor",
+    "rainy", "weekend", "morning", "breakfast", "brunch", "lunch", "dinner",
+    "spring", "summer", "autumn", "fall", "winter",
+    "january", "february", "march", "april", "may", "june", "july", "august", "september",
+    "october", "november", "december",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+}
+
+
+def _fold_plural(word: str) -> str:
+    return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+
+
+def query_keywords(text: str) -> frozenset[str]:
+    """The words that make up what a query is about, with plurals folded into the singular."""
+    return frozenset(
+        _fold_plural(word) for word in normalize_text(text).split() if word not in STOPWORDS
+    )
+
+
+def query_qualifiers(text: str) -> frozenset[str]:
+    """Keywords that narrow a query down: place names, dates and numbers, and QUALIFIERS.
+
+    Place names are the capitalized words. The first word is capitalized either way, so it only counts if it's
+    a qualifier.
+    """
+    qualifiers = set()
+    for i, word in enumerate(re.findall(r"[^\W_]+", text)):
+        keyword = _fold_plural(word.lower())
+        if keyword in STOPWORDS:
+            continue
+        if keyword in QUALIFIERS or keyword.isdigit() or (i > 0 and word[0].isupper()):
+            qualifiers.add(keyword)
+    return frozenset(qualifiers)
+
+
+def hashing_embedding(text: str) -> np.ndarray:
+    """Local, offline embedding: hashed bag of words and character trigrams, L2-normalized.
+
+    Good enough to catch reworded queries like "top museums in Paris" vs "best Paris museums to visit".
+    Swap in a real embedding model through SemanticQueryCache(embedding_function=...).
+    """
+    vector = np.zeros(HASHING_EMBEDDING_DIM, dtype=np.float32)
+    words = [w for w in normalize_text(text).split() if w not in STOPWORDS]
+    for word in words:
+        # Trigrams make plural/singular and small typos land close to each other
+        padded = f"<{word}>"
+        features = [(word, 1.0)] + [
+            (padded[i : i + 3], 0.5) for i in range(len(padded) - 2)
+        ]
+        for feature, weight in features:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % HASHING_EMBEDDING_DIM
+            vector[index] += weight
+
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class SemanticQueryCache:
+    """Maps query embeddings to stored internet search results, so reworded queries reuse prior results.
+
+    Rows live in a float32 matrix and lookups are a single matrix-vector product (cosine similarity on
+    normalized vectors). Results are only reused within the same scope (trip location and date window), and
+    only if each query has the qualifiers of the other among its keywords, since one qualifying word ("cheap",
+    "Hongdae", "March") changes the results while barely changing the similarity. The least recently used row
+    is evicted above max_entries.
+    """
+
+    SAVE_EVERY_N_ADDS = 20
+
+    def __init__(
+        self,
+        embedding_function: Callable[[str], np.ndarray] = hashing_embedding,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+        persist_path: str | None = SEMANTIC_CACHE_PATH,
+    ):
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+
+        self.vectors: np.ndarray | None = None  # (n, dim) float32
+        self.last_used_at = np.zeros(0, dtype=np.float64)
+        self.scopes: list[str] = []
+        self.keywords: list[frozenset[str]] = []
+        self.qualifiers: list[frozenset[str]] = []
+        self.entries: list[dict] = []
+
+        self.hits = 0
+        self.misses = 0
+        self.adds_since_save = 0
+        self._save_task: asyncio.Task | None = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _embed(self, query: str) -> np.ndarray:
+        return np.asarray(self.embedding_function(query), dtype=np.float32)
+
+    def lookup(self, query: str, scope: str) -> dict | None:
+        """Return the stored entry of the most similar query in the same scope, if it's above the threshold."""
+        if not self.entries:
+            self.misses += 1
+            return None
+
+        similarities = self.vectors @ self._embed(query)
+        keywords = query_keywords(query)
+        qualifiers = query_qualifiers(query)
+        comparable = np.fromiter(
+            (
+                entry_scope == scope
+                and qualifiers <= entry_keywords
+                and entry_qualifiers <= keywords
+                for entry_scope, entry_keywords, entry_qualifiers in zip(
+                    self.scopes, self.keywords, self.qualifiers
+                )
+            ),
+            dtype=bool,
+            count=len(self.scopes),
+        )
+        similarities = np.where(comparable, similarities, -1.0)
+        best = int(np.argmax(similarities))
+
+        if similarities[best] < self.threshold:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.last_used_at[best] = time.time()
+        return {**self.entries[best], "similarity": float(similarities[best])}
+
+    def add(self, query: str, scope: str, entry: dict):
+        vector = self._embed(query)
+        if self.vectors is None or self.vectors.shape[1] != vector.shape[0]:
+            self.clear()
+            self.vectors = np.zeros((0, vector.shape[0]), dtype=np.float32)
+
+        if len(self.entries) >= self.max_entries:
+            self._remove(int(np.argmin(self.last_used_at)))
+
+        self.vectors = np.vstack([self.vectors, vector[None, :]])
+        self.last_used_at = np.append(self.last_used_at, time.time())
+        self.scopes.append(scope)
+        self.keywords.append(query_keywords(query))
+        self.qualifiers.append(query_qualifiers(query))
+        self.entries.append(entry)
+
+        self.adds_since_save += 1
+        if (
+            self.persist_path
+            and self.adds_since_save >= self.SAVE_EVERY_N_ADDS
+            and (self._save_task is None or self._save_task.done())
+        ):
+            # Written in a thread, so that the event loop isn't blocked by serializing the entries
+            self._save_task = run_in_background(
+                self.asave(), name="save_semantic_query_cache"
+            )
+
+    def _remove(self, index: int):
+        self.vectors = np.delete(self.vectors, index, axis=0)
+        self.last_used_at = np.delete(self.last_used_at, index)
+        del self.scopes[index]
+        del self.keywords[index]
+        del self.qualifiers[index]
+        del self.entries[index]
+
+    def clear(self):
+        self.vectors = None
+        self.last_used_at = np.zeros(0, dtype=np.float64)
+        self.scopes = []
+        self.keywords = []
+        self.qualifiers = []
+        self.entries = []
+
+    def _snapshot(self) -> tuple:
+        # Copies, so that the files can be written while the cache keeps changing
+        return (
+            self.vectors,
+            self.last_used_at.copy(),
+            list(self.scopes),
+            [sorted(keywords) for keywords in self.keywords],
+            [sorted(qualifiers) for qualifiers in self.qualifiers],
+            list(self.entries),
+        )
+
+    def _write(self, snapshot: tuple):
+        vectors, last_used_at, scopes, keywords, qualifiers, entries = snapshot
+        os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+
+        # Write to temp files first so that a crash mid-save doesn't corrupt the index
+        np.savez(
+            f"{self.persist_path}.tmp.npz",
+            vectors=vectors,
+            last_used_at=last_used_at,
+        )
+        with open(f"{self.persist_path}.tmp.json", "w") as f:
+            json.dump(
+                {
+                    "scopes": scopes,
+                    "keywords": keywords,
+                    "qualifiers": qualifiers,
+                    "entries": entries,
+                },
+                f,
+            )
+        os.replace(f"{self.persist_path}.tmp.npz", f"{self.persist_path}.npz")
+        os.replace(f"{self.persist_path}.tmp.json", f"{self.persist_path}.json")
+
+    def save(self):
+        if not self.persist_path or self.vectors is None:
+            return
+        self._write(self._snapshot())
+        self.adds_since_save = 0
+
+    async def asave(self):
+        if not self.persist_path or self.vectors is None:
+            return
+        snapshot = self._snapshot()
+        self.adds_since_save = 0
+        await asyncio.to_thread(self._write, snapshot)
+
+    def load(self):
+        if not self.persist_path or not os.path.exists(f"{self.persist_path}.npz"):
+            return
+        try:
+            with np.load(f"{self.persist_path}.npz") as data:
+                vectors = data["vectors"].astype(np.float32)
+                last_used_at = data["last_used_at"]
+            with open(f"{self.persist_path}.json") as f:
+                metadata = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load semantic query cache: {str(e)}")
+            return
+
+        if len(metadata["entries"]) != vectors.shape[0]:
+            logger.error("Semantic query cache files are out of sync. Ignoring them.")
+            return
+        self.vectors = vectors
+        self.last_used_at = last_used_at
+        self.scopes = metadata["scopes"]
+        self.entries = metadata["entries"]
+        if "keywords" in metadata:
+            self.keywords = [frozenset(keywords) for keywords in metadata["keywords"]]
+        else:
+            # Saved before keywords were stored
+            self.keywords = [
+                query_keywords(entry.get("query", "")) for entry in self.entries
+            ]
+        if "qualifiers" in metadata:
+            self.qualifiers = [
+                frozenset(qualifiers) for qualifiers in metadata["qualifiers"]
+            ]
+        else:
+            self.qualifiers = [
+                query_qualifiers(entry.get("query", "")) for entry in self.entries
+            ]
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "namespace": "semantic_query",
+            "backend": "numpy",
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+semantic_query_cache = SemanticQueryCache()
@@ -1,7 +1,21 @@
-from datetime import datetime, timedelta
+import asyncio
+import logging
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from datetime import datetime, timedelta, time
+from typing import Coroutine
 from langchain_core.messages import SystemMessage, AnyMessage, HumanMessage, AIMessage
 
-from app.state import ScheduleItem, ScheduleItemType
+from app.state import (
+    CandidateVenue,
+    ScheduleItem,
+    ScheduleItemType,
+    ScheduleItemTime,
+    ScheduleList,
+    is_fixed_schedule_id,
+    parse_datetime,
+)
+from app.utils.cache import normalize_text
 from app.llms import (
     chat_model_anthropic_first,
     chat_model_openai_first,
@@ -10,6 +24,29 @@ from app.llms import (
     small_model_anthropic_first,
 )
 
+logger = logging.getLogger(__name__)
+
+# Keep strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks: set[asyncio.Task] = set()
+
+
+def run_in_background(coro: Coroutine, name: str = None) -> asyncio.Task:
+    """Schedule a coroutine off the critical path. Errors are logged instead of raised."""
+
+    async def _run():
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Background task {name or ''} failed: {str(e)}")
+
+    task = asyncio.create_task(_run(), name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
 def convert_messages_to_string(messages: AnyMessage) -> str:
     return (
         "\n".join(
@@ -22,6 +59,60 @@ def convert_messages_to_string(messages: AnyMessage) -> str:
     )
 
 
+def render_schedule_item_line(
+    item: ScheduleItem,
+    include_ids: bool,
+    include_description: bool,
+    include_suggestion: bool,
+) -> str:
+    """A single line of convert_schedule_items_to_string.
+
+    Lines are cached on the item and only re-rendered after the item changes, so rendering the
+    whole schedule on every loop iteration mostly reuses strings that are already built.
+    """
+    options = (include_ids, include_description, include_suggestion)
+    version = item.version()
+    rendered_lines = item.__pydantic_private__["_rendered_lines"]
+    cached = rendered_lines.get(options)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    content = (
+        f"- {item.id} | {item.time.start_time}"
+        if include_ids
+        else f"- {item.time.start_time}"
+    )
+
+    if item.time.end_time:
+        start_dt, end_dt = item.time.parsed_times()
+        if (
+            start_dt
+            and end_dt
+            and len(item.time.end_time) > 5
+            and end_dt.date() == start_dt.date()
+        ):
+            # Exclude date info if they are the same
+            content += f" ~ {end_dt.hour:02d}:{end_dt.minute:02d}"
+        else:
+            content += f" ~ {item.time.end_time}"
+
+    content += f" | {item.activity_type.value} | {item.title} | {item.location}"
+
+    if include_description and item.description:
+        content += f" | {item.description}"
+
+    if include_suggestion and item.suggestion:
+        content += f" | {item.suggestion}"
+
+    if is_fixed_schedule_id(item.id):
+        content += (
+            "  (This is a fixed schedule that the user provided. Don't modify it.)"
+        )
+
+    rendered_lines[options] = (version, content)
+    return content
+
+
 def convert_schedule_items_to_string(
     schedule_items: list[ScheduleItem],
     include_ids: bool,
@@ -33,7 +124,8 @@ def convert_schedule_items_to_string(
     if not schedule_items:
         return "No schedule items are arranged yet."
 
-    schedule_items = sorted(schedule_items, key=lambda x: x.time.start_time)
+    if not isinstance(schedule_items, ScheduleList):  # ScheduleList is already sorted
+        schedule_items = sorted(schedule_items, key=ScheduleList.sort_key)
 
     result = []
 
@@ -43,66 +135,324 @@ def convert_schedule_items_to_string(
         )  # Only include field names at top to save tokens.
 
     for item in schedule_items:
-        content = (
-            f"- {item.id} | {item.time.start_time}"
-            if include_ids
-            else f"- {item.time.start_time}"
+        result.append(
+            render_schedule_item_line(
+                item, include_ids, include_description, include_suggestion
+            )
         )
 
-        if item.time.end_time:
-            if item.time.end_time.split(" ")[0] == item.time.start_time.split(" ")[0]:
-                # Exclude date info if they are the same
-                content += f" ~ {item.time.end_time.split(' ')[1]}"
-            else:
-                content += f" ~ {item.time.end_time}"
+    return "\n".join(result).strip()
 
-        content += f" | {item.activity_type.value} | {item.title} | {item.location}"
 
-        if include_description and item.description:
-            content += f" | {item.description}"
+# ===========================================
+#          SEARCH RESULT COMPRESSION
+# ===========================================
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text. Good enough for budgeting a prompt.
+    return len(text) // 4 + 1
+
+
+def venue_key(name: str) -> str:
+    key = normalize_text(name)
+    return key[4:] if key.startswith("the ") else key
+
+
+def deduplicate_candidate_venues(
+    venue_lists: list[list[dict] | None],
+) -> list[CandidateVenue]:
+    """Merge venues mentioned by several search results into one, ordered by the number of results mentioning them.
+
+    Missing fields are filled in from the other mentions and distinct tips are combined.
+    """
+    merged: dict[str, dict] = {}
+    mentions: dict[str, int] = {}
+    for venues in venue_lists:
+        keys_in_result = set()
+        for venue in venues or []:
+            key = venue_key(venue["name"])
+            if not key:
+                continue
+            if key not in keys_in_result:
+                keys_in_result.add(key)
+                mentions[key] = mentions.get(key, 0) + 1
+            if key not in merged:
+                merged[key] = dict(venue)
+                continue
+
+            existing = merged[key]
+            for field in ("address", "opening_hours", "price"):
+                if not existing.get(field) and venue.get(field):
+                    existing[field] = venue[field]
+            if venue.get("tips") and normalize_text(venue["tips"]) not in normalize_text(
+                existing.get("tips")
+            ):
+                existing["tips"] = (
+                    f"{existing['tips']}; {venue['tips']}"
+                    if existing.get("tips")
+                    else venue["tips"]
+                )
+
+    # sorted() is stable, so venues mentioned equally often keep the order they were found in
+    ranked_keys = sorted(merged, key=lambda key: -mentions[key])
+    return [CandidateVenue.model_validate(merged[key]) for key in ranked_keys]
+
+
+def render_candidate_venue(venue: CandidateVenue) -> str:
+    content = f"- {venue.name} [{venue.activity_type.value}]"
+    if venue.address:
+        content += f" | Address: {venue.address}"
+    if venue.opening_hours:
+        content += f" | Hours: {venue.opening_hours}"
+    if venue.price:
+        content += f" | Price: {venue.price}"
+    if venue.tips:
+        content += f" | Tips: {venue.tips}"
+    return content
+
+
+def convert_search_results_to_string(
+    internet_search_result_list: list[dict], token_budget: int
+) -> str:
+    """Raw text of the search results that no venues could be extracted from, kept within token_budget.
+
+    The extracted venues are handed out per fill iteration through the trip's VenueIndex instead.
+    Each result gets an even share of what's left of the budget.
+    """
+    sections = []
+    remaining_budget = token_budget
+
+    raw_results = [r for r in internet_search_result_list if r.get("venues") is None]
+    for i, r in enumerate(raw_results):
+        share = remaining_budget // (len(raw_results) - i)
+        text = f"# {i+1}.\n\nSearch Query: {r['query']}\n\nResult:\n{r['query_result'].replace("---", "")}"
+        if estimate_tokens(text) > share:
+            # Cut at a line break so that a half sentence doesn't end the result
+            text = text[: share * 4].rsplit("\n", 1)[0]
+        if not text:
+            continue
+        sections.append(text)
+        remaining_budget -= estimate_tokens(text)
 
-        if include_suggestion and item.suggestion:
-            content += f" | {item.suggestion}"
+    return "\n\n\n".join(sections)
 
-        if item.id > 900:
-            content += (
-                "  (This is a fixed schedule that the user provided. Don't modify it.)"
-            )
 
-        result.append(content)
+# ===========================================
+#              INTERVAL ENGINE
+# ===========================================
+# Breakfast, lunch, and dinner
+MEAL_WINDOWS = [
+    (time(7, 0), time(10, 0)),
+    (time(11, 30), time(14, 0)),
+    (time(17, 30), time(21, 0)),
+]
 
-    return "\n".join(result).strip()
 
+def get_schedule_item_interval(item: ScheduleItem) -> tuple[datetime, datetime]:
+    # Uses the datetimes parsed once on ScheduleItemTime
+    start, end = item.time.parsed_times()
+    if start is None or (end is None and item.time.end_time is not None):
+        start, end = item.time.start_datetime, item.time.end_datetime
+    # If end_time is not provided, set it to the same as start_time.
+    return start, end if end is not None else start
 
-def parse_datetime(dt_str):
-    formats = [
-        "%Y-%m-%d %H:%M",  # Localized Time
-        "%H:%M",
-    ]
 
-    for fmt in formats:
-        try:
-            return datetime.strptime(dt_str, fmt)
-        except ValueError:
+def get_schedule_items_near(
+    schedule_items: list[ScheduleItem],
+    windows: list[tuple[datetime, datetime]],
+    margin: timedelta,
+    include_ids: set[int] = frozenset(),
+) -> list[ScheduleItem]:
+    """Schedule items overlapping any of the windows widened by margin, plus the items in include_ids. Order is kept."""
+    windows = [(start - margin, end + margin) for start, end in windows]
+    result = []
+    for item in schedule_items:
+        if item.id in include_ids:
+            result.append(item)
+            continue
+        if item.time.parsed_times()[0] is None:
+            continue
+        start, end = get_schedule_item_interval(item)
+        if any(
+            # Zero-length items (terminals) count if they are inside the window
+            (start < window_end and window_start < end)
+            or window_start <= start < window_end
+            for window_start, window_end in windows
+        ):
+            result.append(item)
+    return result
+
+
+def merge_intervals(
+    intervals: list[tuple[datetime, datetime]],
+) -> list[tuple[datetime, datetime]]:
+    """Sort and merge overlapping intervals. Zero-length intervals are kept so that they still split free time."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start < merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+@lru_cache(maxsize=256)
+def parse_time_of_day(value: str) -> time:
+    # The same few 'HH:MM' strings are parsed on every loop iteration
+    return parse_datetime(value).time()
+
+
+def get_daily_windows(
+    overall_start: datetime,
+    overall_end: datetime,
+    start_of_day: time,
+    end_of_day: time,
+) -> list[tuple[datetime, datetime]]:
+    """The user's active hours for each day, clipped to [overall_start, overall_end]."""
+    windows = []
+    current_date = overall_start.date() - timedelta(days=1)  # The previous night may run past midnight
+    while current_date <= overall_end.date():
+        window_start = datetime.combine(current_date, start_of_day)
+        window_end = datetime.combine(current_date, end_of_day)
+        if window_end <= window_start:  # The day ends past midnight
+            window_end += timedelta(days=1)
+
+        window_start, window_end = max(window_start, overall_start), min(
+            window_end, overall_end
+        )
+        if window_start < window_end:
+            windows.append((window_start, window_end))
+        current_date += timedelta(days=1)
+    return windows
+
+
+def _seconds_past_grid(dt: datetime, granularity: timedelta) -> int:
+    seconds_of_day = dt.hour * 3600 + dt.minute * 60 + dt.second
+    return seconds_of_day % int(granularity.total_seconds())
+
+
+def ceil_to_granularity(dt: datetime, granularity: timedelta) -> datetime:
+    remainder = _seconds_past_grid(dt, granularity)
+    return dt + (granularity - timedelta(seconds=remainder)) if remainder else dt
+
+
+def floor_to_granularity(dt: datetime, granularity: timedelta) -> datetime:
+    remainder = _seconds_past_grid(dt, granularity)
+    return dt - timedelta(seconds=remainder) if remainder else dt
+
+
+@lru_cache(maxsize=4096)
+def _free_intervals_in_window(
+    window_start: datetime,
+    window_end: datetime,
+    busy_intervals: tuple[tuple[datetime, datetime], ...],
+    granularity: timedelta,
+) -> tuple[tuple[datetime, datetime], ...]:
+    """Free gaps of a single window, snapped to the grid.
+
+    Cached by the busy intervals that overlap the window, so a loop iteration only recomputes
+    the days that its new schedule items touched.
+    """
+    free_intervals = []
+    cursor = window_start
+    for busy_start, busy_end in busy_intervals:
+        if busy_start > cursor:
+            free_intervals.append((cursor, busy_start))
+        if busy_end > cursor:
+            cursor = busy_end
+    if cursor < window_end:
+        free_intervals.append((cursor, window_end))
+
+    # Snap to the grid and lump together gaps that touch each other
+    snapped = []
+    for start, end in free_intervals:
+        if end - start < granularity:  # Too short to hold a slot wherever the grid falls
+            continue
+        start = ceil_to_granularity(start, granularity)
+        end = floor_to_granularity(end, granularity)
+        if end - start < granularity:
             continue
-    raise ValueError(f"Unable to parse datetime string: {dt_str}")
+        if snapped and start <= snapped[-1][1]:
+            snapped[-1] = (snapped[-1][0], max(snapped[-1][1], end))
+        else:
+            snapped.append((start, end))
+    return tuple(snapped)
+
+
+def find_free_intervals(
+    busy_intervals: list[tuple[datetime, datetime]],
+    windows: list[tuple[datetime, datetime]],
+    granularity: timedelta = timedelta(minutes=30),
+) -> list[tuple[datetime, datetime]]:
+    """Sweep the windows against merged busy intervals and return free gaps snapped to the granularity grid.
+
+    Runs in O(n log n) for sorting and merging, plus a binary search per window.
+    """
+    busy_intervals = merge_intervals(busy_intervals)
+    # Merged intervals don't overlap, so both their starts and their ends are sorted
+    busy_starts = [start for start, _ in busy_intervals]
+    busy_ends = [end for _, end in busy_intervals]
+    free_intervals = []
+
+    for window_start, window_end in windows:
+        # The busy intervals that overlap this window
+        first = bisect_right(busy_ends, window_start)
+        last = bisect_left(busy_starts, window_end, lo=first)
+
+        for start, end in _free_intervals_in_window(
+            window_start, window_end, tuple(busy_intervals[first:last]), granularity
+        ):
+            # Gaps of adjacent windows can touch when a day ends right where the next one starts
+            if free_intervals and start <= free_intervals[-1][1]:
+                free_intervals[-1] = (
+                    free_intervals[-1][0],
+                    max(free_intervals[-1][1], end),
+                )
+            else:
+                free_intervals.append((start, end))
+    return free_intervals
+
+
+@lru_cache(maxsize=4096)
+def _render_free_slots_of_date(
+    date: str, slots: tuple[tuple[datetime, datetime], ...]
+) -> str:
+    return (
+        f"- {date}: "
+        + ", ".join(
+            f"{start.hour:02d}:{start.minute:02d} ~ {end.hour:02d}:{end.minute:02d}"
+            for start, end in slots
+        )
+        + "\n"
+    )
 
 
 def calculate_empty_slots(
     schedule_items: list[ScheduleItem],
     trip_start_of_day_at: str,
     trip_end_of_day_at: str,
+    slot_minutes: int = 30,
 ) -> str:
+    return format_empty_slots(
+        find_empty_slots(
+            schedule_items, trip_start_of_day_at, trip_end_of_day_at, slot_minutes
+        )
+    )
+
+
+def find_empty_slots(
+    schedule_items: list[ScheduleItem],
+    trip_start_of_day_at: str,
+    trip_end_of_day_at: str,
+    slot_minutes: int = 30,
+) -> list[tuple[datetime, datetime]] | None:
+    """Free (start, end) slots between the terminals within the user's daily hours. None if there are none."""
     if not schedule_items:
         print("\n\nWarning: Schedule_items is not provided.\n\n")
         return None
 
-    start_of_day_hour, start_of_day_minute = [
-        int(x) for x in trip_start_of_day_at.split(":")
-    ]
-    end_of_day_hour, end_of_day_minute = [int(x) for x in trip_end_of_day_at.split(":")]
-
-    schedule_items.sort(key=lambda x: (x.time.start_time))
+    if not isinstance(schedule_items, ScheduleList):  # ScheduleList is already sorted
+        schedule_items = sorted(schedule_items, key=ScheduleList.sort_key)
 
     if (
         schedule_items[0].activity_type != ScheduleItemType.TERMINAL
@@ -111,121 +461,67 @@ def calculate_empty_slots(
         print("\n\nWarning: First and last items must be terminals.\n\n")
         return None
 
-    intervals = []
+    intervals = [get_schedule_item_interval(item) for item in schedule_items]
+    overall_start, overall_end = intervals[0][0], intervals[-1][1]
 
-    for item in schedule_items:
-        # Parse the start_time string.
-        start = parse_datetime(item.time.start_time)
-        # If end_time is not provided, set it to the same as start_time.
-        if item.time.end_time is None:
-            end = start
-        else:
-            end = parse_datetime(item.time.end_time)
+    windows = get_daily_windows(
+        overall_start,
+        overall_end,
+        parse_time_of_day(trip_start_of_day_at),
+        parse_time_of_day(trip_end_of_day_at),
+    )
+    merged_slots = find_free_intervals(
+        intervals, windows, timedelta(minutes=slot_minutes)
+    )
 
-        intervals.append((start, end))
+    if not merged_slots:
+        print("calculate_empty_slots: No free slots are available.")
+        return None
 
-    # Now create a list of all 30-minute slots between overall_start and overall_end.
-    free_slots = []
-    overall_start, overall_end = intervals[0][0], intervals[-1][1]
-    slot_duration = timedelta(minutes=30)
-
-    # Round up to the next half hour for the start time
-    minutes = overall_start.minute
-    if minutes > 30:
-        adjusted_start = overall_start.replace(
-            minute=0, second=0, microsecond=0
-        ) + timedelta(hours=1)
-    elif minutes > 0 and minutes <= 30:
-        adjusted_start = overall_start.replace(minute=30, second=0, microsecond=0)
-    else:
-        adjusted_start = overall_start.replace(minute=0, second=0, microsecond=0)
-
-    current_slot: list[datetime, datetime] = [
-        adjusted_start,
-        adjusted_start + slot_duration,
-    ]
-
-    while current_slot[1] <= overall_end:
-        current_slot_start: datetime = current_slot[0]
-        current_slot_end: datetime = current_slot[1]
-
-        # Need an adjusted end hour if it's past midnight. Only used for the third comparision in the if statement below.
-        current_slot_end_hour_adjusted = (
-            current_slot_end.hour + 24
-            if current_slot_end.hour < start_of_day_hour
-            else current_slot_end.hour
-        )
+    return merged_slots
 
-        # Users have set when to start the day and when to end the day. If the current slot is not in that range, skip it.
-        if (
-            not start_of_day_hour <= current_slot_start.hour
-            or (
-                start_of_day_hour == current_slot_start.hour
-                and not start_of_day_minute <= current_slot_start.minute
-            )
-            or not current_slot_end_hour_adjusted <= end_of_day_hour
-            or (
-                current_slot_end.hour == end_of_day_hour
-                and not current_slot_end.minute <= end_of_day_minute
-            )
-        ):
-            current_slot = [
-                current_slot[0] + slot_duration,
-                current_slot[1] + slot_duration,
-            ]
-            continue
 
-        is_free = True
-        for start, end in intervals:
-            if current_slot[0] < end and current_slot[1] > start:
-                is_free = False
-                break
-
-        if is_free:
-            # Append the slot's starting time as a tuple.
-            free_slots.append(current_slot)
-
-        # Move to the next 30-minute slot.
-        current_slot = [
-            current_slot[0] + slot_duration,
-            current_slot[1] + slot_duration,
-        ]
-    if not free_slots:
-        print("calculate_empty_slots: No free slots are available.")
+def format_empty_slots(merged_slots: list[tuple[datetime, datetime]] | None) -> str:
+    if not merged_slots:
         return None
 
-    # lump together free slots that are next to each other
-    free_slots.sort(key=lambda x: x[0])
-    merged_slots = [free_slots[0]]
-    for current_slot in free_slots[1:]:
-        last_slot = merged_slots[-1]
-        if current_slot[0] <= last_slot[1]:
-            last_slot[1] = current_slot[1]
-        else:
-            merged_slots.append(current_slot)
+    # group to the same date. Each date's line is cached, so only the days that changed are re-rendered.
+    free_slots_grouped_by_date = {}
+    for start, end in merged_slots:
+        free_slots_grouped_by_date.setdefault(
+            f"{start.year}-{start.month}-{start.day}", []
+        ).append((start, end))
 
-    # group to the same date
-    dates = sorted(
-        set([f"{start.year}-{start.month}-{start.day}" for start, end in merged_slots])
+    free_slots_string = "".join(
+        _render_free_slots_of_date(date, tuple(slots))
+        for date, slots in free_slots_grouped_by_date.items()
     )
 
-    free_slots_grouped_by_date = {}
-    for date in dates:
-        free_slots_grouped_by_date[date] = []
+    return free_slots_string
 
-    for start, end in merged_slots:
-        free_slots_grouped_by_date[f"{start.year}-{start.month}-{start.day}"].append(
-            f"{str(start.hour).zfill(2)}:{str(start.minute).zfill(2)} ~ {str(end.hour).zfill(2)}:{str(end.minute).zfill(2)}"
-        )
 
-    free_slots_string = ""
+def schedule_item_to_route(item: ScheduleItem, terminal_time: datetime) -> dict:
+    """Store a terminal <-> accommodation item relative to the terminal time so it can be reused for other trips."""
+    start, end = get_schedule_item_interval(item)
 
-    for date, slots in free_slots_grouped_by_date.items():
-        free_slots_string += (
-            f"- {date}: " + ", ".join([(f"{slot}") for slot in slots]) + "\n"
-        )
+    return {
+        "schedule_item": item.model_dump(mode="json"),
+        "start_offset_minutes": (start - terminal_time).total_seconds() / 60,
+        "duration_minutes": (end - start).total_seconds() / 60,
+    }
 
-    return free_slots_string
+
+def route_to_schedule_item(route: dict, terminal_time: datetime) -> ScheduleItem:
+    """Time-shift a cached route to the given terminal time."""
+    start = terminal_time + timedelta(minutes=route["start_offset_minutes"])
+    end = start + timedelta(minutes=route["duration_minutes"])
+
+    item = ScheduleItem.model_validate(route["schedule_item"])
+    item.time = ScheduleItemTime(
+        start_time=start.strftime("%Y-%m-%d %H:%M"),
+        end_time=end.strftime("%Y-%m-%d %H:%M"),
+    )
+    return item
 
 
 def calculate_trip_free_hours(
@@ -239,16 +535,23 @@ def calculate_trip_free_hours(
 ) -> int:
     """Calculate free hours during the trip, accounting for arrival/departure times and fixed schedules."""
     # Parse trip dates and times
-    arrival_dt = datetime.strptime(
-        f"{trip_arrival_date} {trip_arrival_time}", "%Y-%m-%d %H:%M"
-    )
-    departure_dt = datetime.strptime(
-        f"{trip_departure_date} {trip_departure_time}", "%Y-%m-%d %H:%M"
-    )
+    arrival_dt = parse_datetime(f"{trip_arrival_date} {trip_arrival_time}")
+    departure_dt = parse_datetime(f"{trip_departure_date} {trip_departure_time}")
 
     # Parse daily start/end times
-    start_of_day = datetime.strptime(trip_start_of_day_at, "%H:%M").time()
-    end_of_day = datetime.strptime(trip_end_of_day_at, "%H:%M").time()
+    start_of_day = parse_datetime(trip_start_of_day_at).time()
+    end_of_day = parse_datetime(trip_end_of_day_at).time()
+
+    # Fixed schedules are parsed once on validation, not once per day
+    fixed_schedule_intervals = []
+    for schedule in trip_fixed_schedules:
+        schedule_start = schedule.time.start_datetime
+        # Handle end time (could be full datetime or just time)
+        schedule_end = schedule.time.end_datetime
+        if schedule_end is None:
+            # If no end time, assume 1 hour duration
+            schedule_end = schedule_start + timedelta(hours=1)
+        fixed_schedule_intervals.append((schedule_start, schedule_end))
 
     # Initialize result dictionary
     free_hours = {}
@@ -272,24 +575,7 @@ def calculate_trip_free_hours(
         free_minutes = (day_end - day_start).total_seconds() / 60
 
         # Deduct fixed schedules for this day
-        for schedule in trip_fixed_schedules:
-            schedule_start = datetime.strptime(
-                schedule.time.start_time, "%Y-%m-%d %H:%M"
-            )
-
-            # Handle end time (could be full datetime or just time)
-            if schedule.time.end_time:
-                if len(schedule.time.end_time) <= 5:  # Format: HH:MM
-                    end_time = datetime.strptime(schedule.time.end_time, "%H:%M").time()
-                    schedule_end = datetime.combine(schedule_start.date(), end_time)
-                else:  # Format: YYYY-MM-DD HH:MM
-                    schedule_end = datetime.strptime(
-                        schedule.time.end_time, "%Y-%m-%d %H:%M"
-                    )
-            else:
-                # If no end time, assume 1 hour duration
-                schedule_end = schedule_start + timedelta(hours=1)
-
+        for schedule_start, schedule_end in fixed_schedule_intervals:
             # Check if schedule overlaps with current day
             if (
                 schedule_start.date() == current_date
@@ -0,0 +1,153 @@
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+
+from app.state import CandidateVenue, ScheduleItem, ScheduleItemType
+from app.utils.cache import normalize_text
+from app.utils.utils import MEAL_WINDOWS, venue_key
+
+# Not something to pick from the research results
+NON_VENUE_TYPES = {
+    ScheduleItemType.TERMINAL,
+    ScheduleItemType.TRANSPORT,
+    ScheduleItemType.WALK,
+    ScheduleItemType.REMOVE,
+}
+
+MAX_MEAL_CANDIDATES = 5
+MAX_ACTIVITY_CANDIDATES = 10
+MAX_CACHED_TRIPS = 256
+
+# Longest venue name, in words, that is matched against schedule item titles and locations
+MAX_NAME_WORDS = 8
+
+
+@lru_cache(maxsize=8192)
+def _word_ngrams(text: str) -> frozenset[str]:
+    words = normalize_text(text).split()
+    return frozenset(
+        " ".join(words[i : i + size])
+        for size in range(1, MAX_NAME_WORDS + 1)
+        for i in range(len(words) - size + 1)
+    )
+
+
+class VenueIndex:
+    """Candidate venues of a trip indexed by category and by the words of their address.
+
+    Venues keep the order of candidate_venue_list (most mentioned first) within each category.
+    """
+
+    def __init__(self, venues: list[CandidateVenue]):
+        self.venues = venues
+        self.keys = [venue_key(venue.name) for venue in venues]
+        self.index_by_key = {key: i for i, key in enumerate(self.keys)}
+
+        self.by_category: dict[ScheduleItemType, list[int]] = {}
+        self.by_location_word: dict[str, set[int]] = {}
+        for i, venue in enumerate(venues):
+            self.by_category.setdefault(venue.activity_type, []).append(i)
+            for word in normalize_text(venue.address).split():
+                self.by_location_word.setdefault(word, set()).add(i)
+
+    def __len__(self):
+        return len(self.venues)
+
+    def used_indices(self, schedule_items: list[ScheduleItem]) -> set[int]:
+        """Venues whose name appears in the title or location of a schedule item."""
+        used = set()
+        for item in schedule_items:
+            for text in (item.title, item.location):
+                for key in _word_ngrams(text) & self.index_by_key.keys():
+                    used.add(self.index_by_key[key])
+        return used
+
+    def candidates(
+        self,
+        categories: list[ScheduleItemType],
+        near_location: str | None,
+        exclude: set[int],
+        limit: int,
+    ) -> list[CandidateVenue]:
+        """Unused venues of the categories. Venues sharing address words with near_location come first."""
+        nearby_score: dict[int, int] = {}
+        for word in set(normalize_text(near_location).split()):
+            for i in self.by_location_word.get(word, ()):
+                nearby_score[i] = nearby_score.get(i, 0) + 1
+
+        indices = [
+            i
+            for category in categories
+            for i in self.by_category.get(category, ())
+            if i not in exclude
+        ]
+        indices.sort(key=lambda i: (-nearby_score.get(i, 0), i))
+        return [self.venues[i] for i in indices[:limit]]
+
+    def candidates_for_slots(
+        self,
+        empty_slots: list[tuple[datetime, datetime]],
+        schedule_items: list[ScheduleItem],
+        max_slots: int = 3,
+        exclude: set[int] = frozenset(),
+    ) -> list[CandidateVenue]:
+        """Unused venues that fit the earliest empty slots, which are the ones the next fill iteration works on.
+
+        Meals are only included if a slot overlaps meal hours. Venues at the exclude indices are never returned.
+        """
+        if not empty_slots or not self.venues:
+            return []
+
+        slots = empty_slots[:max_slots]
+        needs_meal = any(
+            start.time() < meal_end and meal_start < end.time()
+            if start.date() == end.date()
+            else True
+            for start, end in slots
+            for meal_start, meal_end in MEAL_WINDOWS
+        )
+
+        # Where the user will be right before the first slot
+        near_location = None
+        for item in schedule_items:  # sorted by start time
+            start = item.time.parsed_times()[0]
+            if start is None or start >= slots[0][0]:
+                break
+            near_location = item.location
+
+        used = self.used_indices(schedule_items) | exclude
+        candidates = []
+        if needs_meal:
+            candidates += self.candidates(
+                [ScheduleItemType.MEAL], near_location, used, MAX_MEAL_CANDIDATES
+            )
+        candidates += self.candidates(
+            [
+                category
+                for category in ScheduleItemType
+                if category not in NON_VENUE_TYPES and category != ScheduleItemType.MEAL
+            ],
+            near_location,
+            used,
+            MAX_ACTIVITY_CANDIDATES,
+        )
+        return candidates
+
+
+_venue_indexes: OrderedDict[str, tuple[tuple[str, ...], VenueIndex]] = OrderedDict()
+
+
+def get_venue_index(trip_key: str, venues: list[CandidateVenue]) -> VenueIndex:
+    """The trip's VenueIndex, built once per process and rebuilt only when the venue list changes."""
+    fingerprint = tuple(venue.name for venue in venues)
+    cached = _venue_indexes.get(trip_key)
+    if cached is not None and cached[0] == fingerprint:
+        _venue_indexes.move_to_end(trip_key)
+        return cached[1]
+
+    venue_index = VenueIndex(venues)
+    _venue_indexes[trip_key] = (fingerprint, venue_index)
+    _venue_indexes.move_to_end(trip_key)
+    while len(_venue_indexes) > MAX_CACHED_TRIPS:
+        _venue_indexes.popitem(last=False)
+    return venue_index
@@ -1,4 +1,3 @@
-import asyncio
 from varname import nameof as n
 
 from langgraph.graph import START, END, StateGraph
@@ -6,14 +5,9 @@ from langgraph.graph import START, END, StateGraph
 from app.state import OverallState, Stage
 
 from .generate_schedule_graph import g as generate_schedule
-from app.utils.compile_graph import compile_graph_with_async_checkpointer
 
-async def init_generate_schedule():
-    global generate_schedule
-    generate_schedule = await compile_graph_with_async_checkpointer(
-        generate_schedule, "generate_schedule"
-    )
-asyncio.run(init_generate_schedule())
+# Compiled once without its own checkpointer so that it inherits the pooled one of the entry graph (see GraphRegistry)
+generate_schedule = generate_schedule.compile()
 
 def stage_router(state: OverallState):
     if state.current_stage == Stage.END:
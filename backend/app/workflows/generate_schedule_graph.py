@@ -1,6 +1,11 @@
+import os
 import json
+import time
+import asyncio
+import logging
 from varname import nameof as n
 from enum import Enum
+from datetime import timedelta
 from pydantic import BaseModel, Field, create_model
 from typing import Annotated
 
@@ -9,38 +14,133 @@ from langgraph.types import StreamWriter, Command, Send
 
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough, RunnableLambda
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda, RunnableConfig
 from langchain_core.messages import (
     AnyMessage,
     SystemMessage,
     HumanMessage,
     AIMessage,
-    RemoveMessage,
 )
 
 from app.state import (
     OverallState,
     InputState,
+    CandidateVenue,
     ScheduleItem,
     ScheduleItemType,
     ScheduleItemTime,
+    ScheduleList,
     extend_list,
+    allocate_schedule_ids,
+    assign_new_schedule_ids,
 )
 from app.llms import (
+    mark_as_cacheable_prefix,
     chat_model_anthropic_first,
     chat_model_openai_first,
     perplexity_chat_model,
     reasoning_model,
     small_model_anthropic_first,
+    small_model_openai_first,
 )
 from app.utils.utils import (
     convert_schedule_items_to_string,
-    calculate_empty_slots,
+    get_schedule_item_interval,
+    get_schedule_items_near,
+    find_empty_slots,
+    format_empty_slots,
     calculate_trip_free_hours,
+    run_in_background,
+    parse_datetime,
+    schedule_item_to_route,
+    route_to_schedule_item,
+    deduplicate_candidate_venues,
+    render_candidate_venue,
+    convert_search_results_to_string,
 )
+from app.utils.venue_index import get_venue_index
+from app.utils.schedule_validator import (
+    ScheduleRule,
+    validate_schedule,
+    get_items_around_violations,
+)
+from app.utils.rate_limiter import llm_rate_limiter
+from app.utils.cache import (
+    search_result_cache,
+    terminal_route_cache,
+    candidate_venue_cache,
+)
+from app.utils.semantic_cache import semantic_query_cache
+
+logger = logging.getLogger(__name__)
 
 FREE_HOURS_PER_QUERY = 6
 MAX_INTERNET_SEARCH = 10
+# Neighbouring schedule items within this many minutes of the added items are given to fill_schedule_reflection
+REFLECTION_WINDOW_MINUTES = int(os.getenv("REFLECTION_WINDOW_MINUTES", 120))
+
+# LLM rounds to fix the violations found by the local schedule validator
+MAX_VALIDATE_SCHEDULE_ROUNDS = int(os.getenv("MAX_VALIDATE_SCHEDULE_ROUNDS", 3))
+
+
+# Stopping policy of generate_search_query_loop, on top of the model saying the queries are good enough
+SEARCH_QUERY_LOOP_MAX_ITERATIONS = int(os.getenv("SEARCH_QUERY_LOOP_MAX_ITERATIONS", 3))
+SEARCH_QUERY_LOOP_TIME_BUDGET_SECONDS = float(
+    os.getenv("SEARCH_QUERY_LOOP_TIME_BUDGET_SECONDS", 30)
+)
+# An iteration that changes fewer queries than this is treated as converged
+SEARCH_QUERY_LOOP_MIN_CHANGES = int(os.getenv("SEARCH_QUERY_LOOP_MIN_CHANGES", 1))
+
+
+# Search the queries in the background while they are being refined. Results of the queries that survive are reused.
+SPECULATIVE_INTERNET_SEARCH = (
+    os.getenv("SPECULATIVE_INTERNET_SEARCH", "true").lower() == "true"
+)
+
+
+class SearchQueryLoopStopReason(str, Enum):
+    GOOD_ENOUGH = "good_enough"  # the model is happy with the queries
+    MAX_QUERIES = "max_queries"  # as many queries as the free hours allow
+    CONVERGED = "converged"  # the last iteration changed fewer than SEARCH_QUERY_LOOP_MIN_CHANGES queries
+    MAX_ITERATIONS = "max_iterations"
+    TIME_BUDGET = "time_budget"
+
+
+class InternetSearchSummaryMode(str, Enum):
+    INLINE = "inline"  # summarize before the search branch returns
+    BACKGROUND = "background"  # return raw results right away and summarize concurrently
+    SKIP = "skip"  # don't summarize at all
+
+
+# Summaries are only shown to the user as reasoning steps, so by default they are kept off the critical path
+INTERNET_SEARCH_SUMMARY_MODE = InternetSearchSummaryMode(
+    os.getenv("INTERNET_SEARCH_SUMMARY_MODE", InternetSearchSummaryMode.BACKGROUND.value)
+)
+
+
+# Extract venues from each search result, so that the fill prompt gets a deduplicated venue list instead of raw text
+EXTRACT_CANDIDATE_VENUES = os.getenv("EXTRACT_CANDIDATE_VENUES", "true").lower() == "true"
+
+# Upper bound on the research part of the fill-schedule system prompt
+FILL_PROMPT_SEARCH_RESULTS_TOKEN_BUDGET = int(
+    os.getenv("FILL_PROMPT_SEARCH_RESULTS_TOKEN_BUDGET", 6000)
+)
+
+
+class FillScheduleMode(str, Enum):
+    SEQUENTIAL = "sequential"  # fill the whole trip one batch at a time
+    PARALLEL_DAYS = "parallel_days"  # fill every day in its own branch at the same time
+
+
+FILL_SCHEDULE_MODE = FillScheduleMode(
+    os.getenv("FILL_SCHEDULE_MODE", FillScheduleMode.SEQUENTIAL.value)
+)
+
+# Fill and reflection rounds of a single day in parallel_days mode. The slots left empty are filled sequentially afterwards.
+MAX_FILL_SCHEDULE_DAY_ITERATIONS = int(os.getenv("MAX_FILL_SCHEDULE_DAY_ITERATIONS", 4))
+
+# Ids reserved for each day in parallel_days mode
+FILL_SCHEDULE_DAY_ID_BLOCK = 50
 
 
 class ScheduleAction(BaseModel):
@@ -56,7 +156,7 @@ class FillScheduleResponse(BaseModel):
     actions: list[ScheduleAction]
 
 
-def calculate_trip_free_hours_node(state: OverallState, writer: StreamWriter):
+async def calculate_trip_free_hours_node(state: OverallState, writer: StreamWriter):
 
     free_hours: int = calculate_trip_free_hours(
         state.trip_arrival_date,
@@ -75,7 +175,7 @@ def calculate_trip_free_hours_node(state: OverallState, writer: StreamWriter):
     }
 
 
-def add_fixed_schedules(state: OverallState, writer: StreamWriter):
+async def add_fixed_schedules(state: OverallState, writer: StreamWriter):
     if not state.trip_fixed_schedules:
         return {}
 
@@ -90,16 +190,19 @@ def add_fixed_schedules(state: OverallState, writer: StreamWriter):
     return {n(state.schedule_list): state.trip_fixed_schedules}
 
 
-def add_terminal_schedules(state: OverallState, writer: StreamWriter):
+async def add_terminal_schedules(state: OverallState, writer: StreamWriter):
     writer({"short": "Adding terminal schedules", "long": None})
 
     arrival_time = f"{state.trip_arrival_date} {state.trip_arrival_time}"
     departure_time = f"{state.trip_departure_date} {state.trip_departure_time}"
+    arrival_id, departure_id = allocate_schedule_ids(
+        state.last_schedule_item_id, 2, state.schedule_list
+    )
 
     return {
         n(state.schedule_list): [
             ScheduleItem(
-                id=len(state.schedule_list) + 1,
+                id=arrival_id,
                 activity_type=ScheduleItemType.TERMINAL,
                 time=ScheduleItemTime(
                     start_time=arrival_time,
@@ -111,7 +214,7 @@ def add_terminal_schedules(state: OverallState, writer: StreamWriter):
                 suggestion=None,
             ),
             ScheduleItem(
-                id=len(state.schedule_list) + 2,
+                id=departure_id,
                 activity_type=ScheduleItemType.TERMINAL,
                 time=ScheduleItemTime(
                     start_time=departure_time,
@@ -122,13 +225,47 @@ def add_terminal_schedules(state: OverallState, writer: StreamWriter):
                 description=None,
                 suggestion=None,
             ),
-        ]
+        ],
+        n(state.last_schedule_item_id): departure_id,
     }
 
 
-def fill_terminal_transportation_schedule(state: OverallState, writer: StreamWriter):
+async def fill_terminal_transportation_schedule(state: OverallState, writer: StreamWriter):
     writer({"short": "Adding terminal <-> accommodation schedules", "long": None})
 
+    arrival_time = parse_datetime(f"{state.trip_arrival_date} {state.trip_arrival_time}")
+    departure_time = parse_datetime(
+        f"{state.trip_departure_date} {state.trip_departure_time}"
+    )
+
+    # Routes between a terminal and an accommodation area are nearly identical across users, so only the times differ
+    arrival_route_key = terminal_route_cache.make_key(
+        state.trip_arrival_terminal,
+        state.trip_accommodation_location,
+        state.trip_location,
+        "to_accommodation",
+    )
+    departure_route_key = terminal_route_cache.make_key(
+        state.trip_departure_terminal,
+        state.trip_accommodation_location,
+        state.trip_location,
+        "to_terminal",
+    )
+    arrival_route = await terminal_route_cache.get(arrival_route_key)
+    departure_route = await terminal_route_cache.get(departure_route_key)
+
+    if arrival_route and departure_route:
+        writer({"short": "Reused terminal <-> accommodation routes", "long": None})
+        arrival_item = route_to_schedule_item(arrival_route, arrival_time)
+        departure_item = route_to_schedule_item(departure_route, departure_time)
+        arrival_item.id, departure_item.id = allocate_schedule_ids(
+            state.last_schedule_item_id, 2, state.schedule_list
+        )
+        return {
+            n(state.schedule_list): [arrival_item, departure_item],
+            n(state.last_schedule_item_id): departure_item.id,
+        }
+
     prompt_for_perplexity = """
 You are an AI tour planner, and now finding transportation methods between the terminals and the accommodation.
 
@@ -171,20 +308,65 @@ Using the information above, create two TRANSPORT type schedule items: one for a
         **state.model_dump()
     ).strip()
 
-    response: FillScheduleResponse = (
-        perplexity_chat_model
-        | StrOutputParser()
-        | RunnableLambda(lambda x: x + "\n\n---\n\n" + prompt_for_chat_model)
-        | chat_model_anthropic_first.with_structured_output(FillScheduleResponse)
-    ).invoke(prompt_for_perplexity)
+    # If only one of the routes was cached, its research text is reused only if it covers the same terminals.
+    # Otherwise the missing leg would be built from research about another terminal.
+    research_key = terminal_route_cache.make_key(
+        state.trip_arrival_terminal,
+        state.trip_departure_terminal,
+        state.trip_accommodation_location,
+        state.trip_location,
+    )
+    research = next(
+        (
+            route["research"]
+            for route in [arrival_route, departure_route]
+            if route and route.get("research_key") == research_key
+        ),
+        None,
+    )
+    if research is None:
+        with llm_rate_limiter.for_user(state.user_id):
+            research = await (perplexity_chat_model | StrOutputParser()).ainvoke(
+                prompt_for_perplexity
+            )
+
+    with llm_rate_limiter.for_user(state.user_id):
+        response: FillScheduleResponse = await (
+            chat_model_anthropic_first.with_structured_output(FillScheduleResponse)
+        ).ainvoke(research + "\n\n---\n\n" + prompt_for_chat_model)
 
     # Adjust ids considering existing schedule items
-    starting_id = len(state.schedule_list) + 1
-    for i in range(len(response.actions)):
-        response.actions[i].schedule_item.id = starting_id + i
+    new_ids = allocate_schedule_ids(
+        state.last_schedule_item_id, len(response.actions), state.schedule_list
+    )
+    for action, new_id in zip(response.actions, new_ids):
+        action.schedule_item.id = new_id
+
+    transport_items = sorted(
+        [action.schedule_item for action in response.actions],
+        key=ScheduleList.sort_key,
+    )
+    if len(transport_items) == 2:
+        await terminal_route_cache.set(
+            arrival_route_key,
+            {
+                **schedule_item_to_route(transport_items[0], arrival_time),
+                "research": research,
+                "research_key": research_key,
+            },
+        )
+        await terminal_route_cache.set(
+            departure_route_key,
+            {
+                **schedule_item_to_route(transport_items[1], departure_time),
+                "research": research,
+                "research_key": research_key,
+            },
+        )
 
     return {
         n(state.schedule_list): [action.schedule_item for action in response.actions],
+        n(state.last_schedule_item_id): max([state.last_schedule_item_id, *new_ids]),
     }
 
 
@@ -194,7 +376,9 @@ class QueryWithRationale(BaseModel):
     query: str
 
 
-async def init_generate_search_query_loop(state: OverallState, writer: StreamWriter):
+async def init_generate_search_query_loop(
+    state: OverallState, writer: StreamWriter, config: RunnableConfig
+):
     writer({"short": "Generating queries for internet search", "long": None})
 
     format_data = state.model_dump()
@@ -254,6 +438,8 @@ Important notes:
             **format_data
         ).strip()
     )
+    # Resent on every loop iteration. Cache it on the provider side.
+    mark_as_cacheable_prefix(system_prompt)
 
     human_message = HumanMessage(
         f"""Read my trip information carefully, and generate upto {state.trip_free_hours // FREE_HOURS_PER_QUERY} queries to look up information on the internet. Make sure each query don't overlap with the other ones.""".strip()
@@ -262,10 +448,11 @@ Important notes:
     class Queries(BaseModel):
         queries: list[QueryWithRationale]
 
-    response: Queries = (
-        ChatPromptTemplate.from_messages([system_prompt, human_message])
-        | chat_model_anthropic_first.with_structured_output(Queries)
-    ).invoke({})
+    with llm_rate_limiter.for_user(state.user_id):
+        response: Queries = await (
+            ChatPromptTemplate.from_messages([system_prompt, human_message])
+            | chat_model_anthropic_first.with_structured_output(Queries)
+        ).ainvoke({})
 
     writer(
         {
@@ -283,8 +470,15 @@ Important notes:
         query_dict["id"] = i
         response_dict_with_id.append(query_dict)
 
+    sync_speculative_internet_search(
+        state,
+        config["configurable"]["thread_id"],
+        [query["query"] for query in response_dict_with_id],
+    )
+
     return {
         "loop_iteration": 1,
+        "search_query_loop_started_at": time.time(),
         "search_queries": response_dict_with_id,
         "generate_search_query_loop_messages": [
             system_prompt,
@@ -298,13 +492,74 @@ Important notes:
 # We need an temporary state that stores the message list and the queries
 class GenerateSearchQueryLoopState(OverallState):  # Inherit from OverallState
     loop_iteration: int
+    # Wall clock time (time.time()) when the loop started. Checkpoints may be resumed by another process.
+    search_query_loop_started_at: float = Field(default=None)
     search_queries: list[QueryWithRationale]
     generate_search_query_loop_messages: Annotated[list[AnyMessage], extend_list]
 
 
-def generate_search_query_loop(
-    state: GenerateSearchQueryLoopState, writer: StreamWriter
+def get_search_query_loop_budget_stop_reason(
+    state: GenerateSearchQueryLoopState,
+) -> SearchQueryLoopStopReason | None:
+    """Checked before each refinement call, so that no call is started once a budget is used up."""
+    if state.loop_iteration > SEARCH_QUERY_LOOP_MAX_ITERATIONS:
+        return SearchQueryLoopStopReason.MAX_ITERATIONS
+    if (
+        state.search_query_loop_started_at is not None
+        and time.time() - state.search_query_loop_started_at
+        >= SEARCH_QUERY_LOOP_TIME_BUDGET_SECONDS
+    ):
+        return SearchQueryLoopStopReason.TIME_BUDGET
+    return None
+
+
+def start_internet_search(
+    state: GenerateSearchQueryLoopState,
+    queries: list[QueryWithRationale],
+    stop_reason: SearchQueryLoopStopReason,
+    writer: StreamWriter,
+    thread_id: str,
+) -> Command:
+    writer(
+        {
+            "short": f"Starting {len(queries)} internet search in parallel",
+            "long": None,
+        }
+    )
+    logger.debug("generate_search_query_loop: stopped (%s)", stop_reason.value)
+
+    sync_speculative_internet_search(
+        state, thread_id, [query.query for query in queries], launch=False
+    )
+
+    # Call the internet_search node for each query in parallel
+    return Command(
+        update={n(state.search_queries): queries},
+        goto=[
+            Send(
+                n(internet_search),
+                InternetSearchState.model_validate(
+                    {
+                        **state.model_dump(),
+                        "query": query.query,
+                    }
+                ),
+            )
+            for query in queries[:MAX_INTERNET_SEARCH]
+        ],
+    )
+
+
+async def generate_search_query_loop(
+    state: GenerateSearchQueryLoopState, writer: StreamWriter, config: RunnableConfig
 ):
+    thread_id = config["configurable"]["thread_id"]
+    stop_reason = get_search_query_loop_budget_stop_reason(state)
+    if stop_reason:
+        return start_internet_search(
+            state, state.search_queries, stop_reason, writer, thread_id
+        )
+
     writer({"short": "Reviewing search queries for improvement (loop)", "long": None})
 
     class GenerateSearchQueryActionsType(str, Enum):
@@ -331,99 +586,104 @@ def generate_search_query_loop(
         "Review the queries for quality. Ensure they are diverse and not redundant. If any queries are redundant, keep only the best one. Add new queries relevant to my trip if any key aspects are missing. Modify queries that are too vague to make them more specific to my trip. For queries that meet the criteria, mark them with 'SKIP' as the action type. If all queries are good enough, return True for is_current_queries_good_enough."
     )
 
-    response: GenerateSearchQueryLoopResponse = (
-        ChatPromptTemplate.from_messages(
-            [
-                *state.generate_search_query_loop_messages,
-                human_message,
-            ]
-        )
-        | chat_model_anthropic_first.with_structured_output(
-            GenerateSearchQueryLoopResponse
+    with llm_rate_limiter.for_user(state.user_id):
+        response: GenerateSearchQueryLoopResponse = await (
+            ChatPromptTemplate.from_messages(
+                [
+                    *state.generate_search_query_loop_messages,
+                    human_message,
+                ]
+            )
+            | chat_model_anthropic_first.with_structured_output(
+                GenerateSearchQueryLoopResponse
+            )
+        ).ainvoke({})
+
+    if response.is_current_queries_good_enough:
+        return start_internet_search(
+            state,
+            state.search_queries,
+            SearchQueryLoopStopReason.GOOD_ENOUGH,
+            writer,
+            thread_id,
         )
-    ).invoke({})
-
-    if (
-        response.is_current_queries_good_enough
-        or len(state.search_queries) >= state.trip_free_hours // FREE_HOURS_PER_QUERY
-    ):
-        # If the current queries are good enough or the maximum number of queries has been reached, then terminate the loop and start the internet search nodes in parallel
-        writer(
-            {
-                "short": f"Starting {len(state.search_queries)} internet search in parallel",
-                "long": None,
-            }
+    if len(state.search_queries) >= state.trip_free_hours // FREE_HOURS_PER_QUERY:
+        return start_internet_search(
+            state,
+            state.search_queries,
+            SearchQueryLoopStopReason.MAX_QUERIES,
+            writer,
+            thread_id,
         )
 
-        # Call the internet_search node for each query in parallel
-        return Command(
-            goto=[
-                Send(
-                    n(internet_search),
-                    InternetSearchState.model_validate(
-                        {
-                            **state.model_dump(),
-                            "query": query.query,
-                        }
-                    ),
-                )
-                for query in state.search_queries[:MAX_INTERNET_SEARCH]
-            ]
-        )
-    else:
-        # Process actions to add, remove, and modify the queries
-        queries = state.search_queries
-        for action in response.actions:
-            if action.activity_type == ActionsType.ADD:
-                # Add a new query with the next available ID
-                if len(queries) == 0:
-                    next_id = 1
-                else:
-                    # Find the highest ID to assign next ID
-                    next_id = max([q.id for q in queries], default=0) + 1
-                new_query = QueryWithRationale(
-                    id=next_id,
-                    rationale=action.rationale,
-                    query=action.new_query_value,
-                )
-                queries.append(new_query)
-            elif action.activity_type == ActionsType.REMOVE:
-                # Remove query by ID
-                queries[:] = [q for q in queries if q.id != action.query_id]
-            elif action.activity_type == ActionsType.MODIFY:
-                # Modify existing query by ID
-                for query in queries:
-                    if query.id == action.query_id:
+    # Process actions to add, remove, and modify the queries
+    queries = state.search_queries
+    changed_count = 0
+    for action in response.actions:
+        if action.type == GenerateSearchQueryActionsType.ADD:
+            # Add a new query with the next available ID
+            if len(queries) == 0:
+                next_id = 1
+            else:
+                # Find the highest ID to assign next ID
+                next_id = max([q.id for q in queries], default=0) + 1
+            new_query = QueryWithRationale(
+                id=next_id,
+                rationale=action.rationale,
+                query=action.new_query_value,
+            )
+            queries.append(new_query)
+            changed_count += 1
+        elif action.type == GenerateSearchQueryActionsType.REMOVE:
+            # Remove query by ID
+            query_count = len(queries)
+            queries[:] = [q for q in queries if q.id != action.query_id]
+            changed_count += query_count - len(queries)
+        elif action.type == GenerateSearchQueryActionsType.MODIFY:
+            # Modify existing query by ID
+            for query in queries:
+                if query.id == action.query_id:
+                    if query.query != action.new_query_value:
                         query.query = action.new_query_value
-                        break
+                        changed_count += 1
+                    break
 
-        writer({"short": f"Found {len(response.actions)} improvements", "long": None})
+    writer({"short": f"Found {len(response.actions)} improvements", "long": None})
 
-        # Create a new message that contains the LLM's actions
-        new_message = AIMessage(
-            "\n".join([json.dumps(action.model_dump()) for action in response.actions])
-        )
+    sync_speculative_internet_search(
+        state, thread_id, [query.query for query in queries]
+    )
 
-        # Update GenerateQueryLoopState with new queries and a message, and loop back to the current node "validate_and_improve_queries"
-        return Command(
-            update={
-                n(state.loop_iteration): state.loop_iteration + 1,
-                n(state.search_queries): queries,
-                n(state.generate_search_query_loop_messages): [
-                    human_message,
-                    new_message,
-                ],
-            },
-            goto=n(generate_search_query_loop),
+    if changed_count < SEARCH_QUERY_LOOP_MIN_CHANGES:
+        return start_internet_search(
+            state, queries, SearchQueryLoopStopReason.CONVERGED, writer, thread_id
         )
 
+    # Create a new message that contains the LLM's actions
+    new_message = AIMessage(
+        "\n".join([json.dumps(action.model_dump()) for action in response.actions])
+    )
+
+    # Update GenerateQueryLoopState with new queries and a message, and loop back to the current node "validate_and_improve_queries"
+    return Command(
+        update={
+            n(state.loop_iteration): state.loop_iteration + 1,
+            n(state.search_queries): queries,
+            n(state.generate_search_query_loop_messages): [
+                human_message,
+                new_message,
+            ],
+        },
+        goto=n(generate_search_query_loop),
+    )
+
 
 class InternetSearchState(InputState):  # Inherit from InputState
     query: str = Field(description="The query to search for.")
 
 
-def internet_search(state: InternetSearchState, writer: StreamWriter):
-
+async def search_internet(state: InternetSearchState) -> tuple[str, str | None]:
+    """The search result of state.query from the caches or Perplexity, and the similar query whose result was reused."""
     #! Excluded trip_theme, user_interests, and extra_info since they are distracting
     prompt = """
 You are an AI tour planner doing some research for the user.
@@ -452,38 +712,256 @@ Important Rules
         **state.model_dump()
     ).strip()
 
-    response = (perplexity_chat_model | StrOutputParser()).invoke(prompt)
+    # Popular destinations get the same queries from many users
+    cache_key = search_result_cache.make_key(
+        state.query,
+        state.trip_location,
+        state.trip_arrival_date,
+        state.trip_departure_date,
+    )
+    response = await search_result_cache.get(cache_key)
+
+    # Reworded queries that mean the same thing reuse the result of the similar query
+    semantic_cache_scope = search_result_cache.make_key(
+        state.trip_location, state.trip_arrival_date, state.trip_departure_date
+    )
+    similar_query = None
+    if response is None and (
+        similar_result := semantic_query_cache.lookup(state.query, semantic_cache_scope)
+    ):
+        similar_query = similar_result["query"]
+        response = similar_result["query_result"]
+
+    if response is None:
+        with llm_rate_limiter.for_user(state.user_id):
+            response = await (perplexity_chat_model | StrOutputParser()).ainvoke(
+                prompt
+            )
+        await search_result_cache.set(cache_key, response)
+        semantic_query_cache.add(
+            state.query,
+            semantic_cache_scope,
+            {"query": state.query, "query_result": response},
+        )
+
+    return response, similar_query
+
+
+# In-flight speculative searches by (thread_id, query). Cancelled by the runner when the generation ends.
+_speculative_searches: dict[tuple[str, str], asyncio.Task] = {}
+# Summaries streamed in the background by thread_id, cancelled with the speculative searches
+_background_summaries: dict[str, set[asyncio.Task]] = {}
+
+
+async def speculative_internet_search(
+    state: InternetSearchState,
+) -> tuple[str, str | None]:
+    response, similar_query = await search_internet(state)
+    if EXTRACT_CANDIDATE_VENUES:
+        # Warms candidate_venue_cache for internet_search
+        await extract_candidate_venues(state.query, response, state.user_id)
+    return response, similar_query
+
+
+def sync_speculative_internet_search(
+    state: OverallState, thread_id: str, queries: list[str], launch: bool = True
+):
+    """Start searching the queries that aren't being searched yet, and cancel the searches of the queries that are gone.
+
+    Removed and reworded queries are cancelled. Their results, if they already finished, only stay in the caches.
+    """
+    if not SPECULATIVE_INTERNET_SEARCH:
+        return
+
+    wanted = {(thread_id, query) for query in queries[:MAX_INTERNET_SEARCH]}
+    for key in [key for key in _speculative_searches if key[0] == thread_id]:
+        if key not in wanted:
+            _speculative_searches.pop(key).cancel()
+
+    if not launch:
+        return
+    state_data = state.model_dump()
+    for key in wanted:
+        if key not in _speculative_searches:
+            _speculative_searches[key] = run_in_background(
+                speculative_internet_search(
+                    InternetSearchState.model_validate({**state_data, "query": key[1]})
+                ),
+                name=f"speculative_internet_search:{key[1]}",
+            )
+
 
-    summarized_response = small_model_anthropic_first.invoke(
-        f"Summarize the following internet search result in a single paragraph. If there are list of tourist attractions, places of interest, or landmarks, include all of them in the summary. Here is the result:\n{response}"
+def cancel_background_tasks(thread_id: str):
+    """Cancel the speculative searches and summaries of a generation that ended, whether it finished, failed, or was
+    cancelled. Its stream writer is gone by then.
+    """
+    for key in [key for key in _speculative_searches if key[0] == thread_id]:
+        _speculative_searches.pop(key).cancel()
+    for task in _background_summaries.pop(thread_id, set()):
+        task.cancel()
+
+
+async def internet_search(
+    state: InternetSearchState, writer: StreamWriter, config: RunnableConfig
+):
+    search_result = None
+    speculative_search = _speculative_searches.pop(
+        (config["configurable"]["thread_id"], state.query), None
     )
+    if speculative_search is not None:
+        try:
+            # Shielded to tell the search being cancelled apart from this node being cancelled
+            search_result = await asyncio.shield(speculative_search)
+        except asyncio.CancelledError:
+            if not speculative_search.cancelled():
+                # It was popped from _speculative_searches, so nothing else would cancel it
+                speculative_search.cancel()
+                raise
+        except Exception:
+            logger.warning(
+                f"Speculative search for '{state.query}' failed. Searching again.",
+                exc_info=True,
+            )
+    # None if it was cancelled or failed
+    if search_result is None:
+        search_result = await search_internet(state)
+    response, similar_query = search_result
+
+    if similar_query:
+        writer(
+            {
+                "short": f"Reused the search result of a similar query: {similar_query}",
+                "long": None,
+            }
+        )
+
+    if INTERNET_SEARCH_SUMMARY_MODE == InternetSearchSummaryMode.INLINE:
+        await summarize_internet_search_result(
+            state.query, response, writer, state.user_id
+        )
+    elif INTERNET_SEARCH_SUMMARY_MODE == InternetSearchSummaryMode.BACKGROUND:
+        summary = run_in_background(
+            summarize_internet_search_result(
+                state.query, response, writer, state.user_id
+            ),
+            name=f"summarize_internet_search_result:{state.query}",
+        )
+        summaries = _background_summaries.setdefault(
+            config["configurable"]["thread_id"], set()
+        )
+        summaries.add(summary)
+        summary.add_done_callback(summaries.discard)
+    else:
+        writer({"short": f"Searched: {state.query}", "long": None})
+
+    result = {
+        "query": state.query,
+        "query_result": response,
+        "venues": (
+            await extract_candidate_venues(state.query, response, state.user_id)
+            if EXTRACT_CANDIDATE_VENUES
+            else None
+        ),
+    }
+
+    return {"internet_search_result_list": [result]}
+
+
+class CandidateVenueList(BaseModel):
+    venues: list[CandidateVenue]
+
+
+async def extract_candidate_venues(
+    query: str, query_result: str, user_id: str = None
+) -> list[dict] | None:
+    """Structured venues mentioned in a search result. None if the extraction failed, so the raw text is used instead."""
+    cache_key = candidate_venue_cache.make_key(query, query_result)
+    venues = await candidate_venue_cache.get(cache_key)
+    if venues is not None:
+        return venues
+
+    prompt = f"""
+Extract every venue (restaurant, cafe, museum, gallery, historical site, street, event, etc.) mentioned in the following internet search result.
+Only use information that is in the result. Don't make anything up.
+
+Search Query: {query}
+
+Result:
+{query_result}
+    """.strip()
+
+    try:
+        with llm_rate_limiter.for_user(user_id):
+            response: CandidateVenueList = (
+                await small_model_openai_first.with_structured_output(
+                    CandidateVenueList
+                ).ainvoke(prompt)
+            )
+    except Exception:
+        logger.warning(f"Failed to extract venues for '{query}'", exc_info=True)
+        return None
+
+    venues = [venue.model_dump(mode="json") for venue in response.venues]
+    await candidate_venue_cache.set(cache_key, venues)
+    return venues
+
+
+async def summarize_internet_search_result(
+    query: str, query_result: str, writer: StreamWriter, user_id: str = None
+):
+    # The summary is only streamed to the user. It is not stored in the state.
+    with llm_rate_limiter.for_user(user_id):
+        summarized_response = await small_model_anthropic_first.ainvoke(
+            f"Summarize the following internet search result in a single paragraph. If there are list of tourist attractions, places of interest, or landmarks, include all of them in the summary. Here is the result:\n{query_result}"
+        )
 
     writer(
         {
             "short": None,
             "long": {
                 "title": f"Internet search result",
-                "description": f"**Query**: {state.query}\n\n**Summarized result**: {summarized_response.content}",
+                "description": f"**Query**: {query}\n\n**Summarized result**: {summarized_response.content}",
             },
         }
     )
 
-    result = {
-        "query": state.query,
-        "query_result": response,
-    }
 
-    return {"internet_search_result_list": [result]}
+async def compress_internet_search_results(
+    state: OverallState, writer: StreamWriter
+):
+    candidate_venue_list = deduplicate_candidate_venues(
+        [r.get("venues") for r in state.internet_search_result_list]
+    )
+
+    if candidate_venue_list:
+        writer(
+            {
+                "short": f"Found {len(candidate_venue_list)} candidate venues",
+                "long": None,
+            }
+        )
+
+    # Build the trip's venue index once, right after the searches join
+    get_venue_index(state.user_id, candidate_venue_list)
+
+    return {n(state.candidate_venue_list): candidate_venue_list}
 
 
-def init_fill_schedule_loop(state: OverallState, writer: StreamWriter):
+async def init_fill_schedule_loop(state: OverallState, writer: StreamWriter):
 
     format_data = state.model_dump()
-    format_data["internet_search_results_string"] = "\n\n\n".join(
-        [
-            f"# {i+1}.\n\nSearch Query: {r['query']}\n\nResult:\n{r['query_result'].replace("---", "")}"
-            for i, r in enumerate(state.internet_search_result_list)
-        ]
+    format_data["internet_search_results_string"] = convert_search_results_to_string(
+        state.internet_search_result_list, FILL_PROMPT_SEARCH_RESULTS_TOKEN_BUDGET
+    )
+    if state.candidate_venue_list:
+        # The venues themselves change every iteration, so they go into the human message, not this cached prefix
+        format_data["internet_search_results_string"] = (
+            "The venues you found are listed in each request, narrowed down to the ones that fit the empty slots and are not in the schedule yet.\n\n"
+            + format_data["internet_search_results_string"]
+        ).strip()
+    # The rules don't change between iterations, so they go into the cached prefix instead of every turn
+    format_data["fill_schedule_criteria_string"] = "\n".join(
+        [f"- {c}" for c in FILL_SCHEDULE_CRITERIA_LIST]
     )
 
     system_prompt = SystemMessage(
@@ -509,11 +987,18 @@ Here are information that you have collected on the internet:
 ---
 
 
+Important rules for filling the schedule:
+{fill_schedule_criteria_string}
+
+
 <warning>DO NOT RETURN AN EMPTY RESPONSE!! YOU HAVE ENOUGH OUTPUT TOKENS</warning>
     """.format(
             **format_data
         ).strip()
     )
+    # Every fill_schedule_loop and fill_schedule_reflection call starts with this prompt.
+    # Mark it so that the search results are read from the provider's prompt cache.
+    mark_as_cacheable_prefix(system_prompt)
 
     return {
         "fill_schedule_loop_messages": [system_prompt],
@@ -535,22 +1020,45 @@ class FillScheduleLoopState(OverallState):  # Inherit from OverallState
     fill_schedule_loop_messages: Annotated[list[AnyMessage], add_messages] = Field(
         default_factory=list
     )
+    # Ids of the items added by the latest fill_schedule_loop iteration
+    fill_schedule_added_ids: list[int] = Field(default_factory=list)
+    # Set once the days have been filled in parallel. The slots they leave empty are filled sequentially.
+    fill_schedule_days_dispatched: bool = Field(default=False)
+
+
+class FillScheduleDayState(FillScheduleLoopState):  # Inherit from FillScheduleLoopState
+    fill_schedule_date: str = Field(default=None, description="YYYY-MM-DD")
+    fill_schedule_day_index: int = Field(default=0)
+    fill_schedule_day_count: int = Field(default=1)
+    # Ids allocated for this day up front, so that days filled at the same time never share an id
+    fill_schedule_reserved_ids: list[int] = Field(default_factory=list)
+
+
+def get_candidate_venues_string(
+    state: OverallState,
+    schedule_list: ScheduleList,
+    empty_slot_list: list,
+    exclude: set[int] = frozenset(),
+) -> str:
+    # Only the venues that fit the next slots and aren't scheduled yet, instead of every venue on every turn
+    candidate_venues = get_venue_index(
+        state.user_id, state.candidate_venue_list
+    ).candidates_for_slots(empty_slot_list, schedule_list, exclude=exclude)
+    if candidate_venues:
+        return "\n".join(render_candidate_venue(venue) for venue in candidate_venues)
+    elif state.candidate_venue_list:
+        return "All the venues you found are already in the schedule. Use what you know about the trip location."
+    else:
+        return "Pick from the information that you have collected on the internet."
 
 
-def fill_schedule_loop(state: FillScheduleLoopState, writer: StreamWriter):
-    empty_slots = calculate_empty_slots(
-        state.schedule_list, state.trip_start_of_day_at, state.trip_end_of_day_at
-    )
-    if not empty_slots:
-        writer({"short": "Completed filling all schedule items", "long": None})
-        return Command(
-            goto=n(validate_full_schedule_loop),
-        )
-
-    writer({"short": "Filling schedule items (loop)", "long": None})
-
-    messages = state.fill_schedule_loop_messages
-
+async def generate_schedule_items(
+    state: FillScheduleLoopState,
+    schedule_list: ScheduleList,
+    empty_slot_list: list,
+    candidate_venues_string: str,
+) -> list[ScheduleItem]:
+    """Ask the model for the next schedule items to fill empty_slot_list. Ids are left to the caller."""
     #! Added an ad hoc warning message since Claude sonnet 3.5 keeps returning an empty response half of the time.
     #! Make sure to remove this after the model gets better.
     human_message = HumanMessage(
@@ -560,78 +1068,38 @@ def fill_schedule_loop(state: FillScheduleLoopState, writer: StreamWriter):
 Fill the schedule with the best schedule items. Don't need to fill all at once because you'll be asked again until all slots are filled.
 
 Current schedule:
-{convert_schedule_items_to_string(state.schedule_list, include_ids=False, include_description=False, include_suggestion=False)}
+{convert_schedule_items_to_string(schedule_list, include_ids=False, include_description=False, include_suggestion=False)}
 
 Empty slots:
-{empty_slots}
+{format_empty_slots(empty_slot_list)}
 
-Important Rules:
-{"\n".join([f"- {c}" for c in FILL_SCHEDULE_CRITERIA_LIST])}
+Candidate venues:
+{candidate_venues_string}
+
+Follow the important rules for filling the schedule.
 
 
 <warning>DO NOT RETURN AN EMPTY RESPONSE!! YOU HAVE ENOUGH OUTPUT TOKENS</warning>
 """.strip()
     )
 
-    messages.append(human_message)
-
-    response: FillScheduleResponse = (
-        ChatPromptTemplate.from_messages(messages)
-        | chat_model_anthropic_first.with_structured_output(FillScheduleResponse)
-    ).invoke({})
-
-    # Note: This creates a new list but the items inside are references to the original objects
-    new_schedule_list = [action.schedule_item for action in response.actions]
-
-    starting_id = len(state.schedule_list) + 1
-
-    # Since we're working with references, this updates both new_schedule_list
-    # and the original items in response.actions simultaneously
-    for i, item in enumerate(new_schedule_list):
-        item.id = starting_id + i
-
-    new_messages = []
-    new_messages.extend(
-        [
-            human_message,
-            AIMessage(
-                convert_schedule_items_to_string(
-                    [action.schedule_item for action in response.actions],
-                    include_ids=True,
-                    include_description=True,
-                    include_suggestion=True,
-                )
-            ),
-        ]
-    )
-    writer(
-        {
-            "short": f"Added {len(response.actions)} schedule items",
-            "long": {
-                "title": f"Added {len(response.actions)} schedule items",
-                "description": convert_schedule_items_to_string(
-                    [action.schedule_item for action in response.actions],
-                    include_ids=False,
-                    include_description=False,
-                    include_suggestion=False,
-                    include_heading=False,
-                ),
-            },
-        }
-    )
-
-    return Command(
-        goto=n(fill_schedule_reflection),
-        update={
-            n(state.fill_schedule_loop_messages): new_messages,
-            n(state.schedule_list): new_schedule_list,
-        },
-    )
+    with llm_rate_limiter.for_user(state.user_id):
+        response: FillScheduleResponse = await (
+            ChatPromptTemplate.from_messages(
+                [*state.fill_schedule_loop_messages, human_message]
+            )
+            | chat_model_anthropic_first.with_structured_output(FillScheduleResponse)
+        ).ainvoke({})
 
+    return [action.schedule_item for action in response.actions]
 
-def fill_schedule_reflection(state: FillScheduleLoopState, writer: StreamWriter):
-    writer({"short": "Reflecting on added schedule items", "long": None})
 
+async def review_added_schedule_items(
+    state: OverallState,
+    schedule_list: ScheduleList,
+    added_ids: set[int],
+) -> list[ScheduleItem]:
+    """Ask the reasoning model to check the items that were just added. Returns the items to upsert or remove."""
     criteria_instruction = (
         "Think out loud if provided schedule items meet the following criteria:"
     )
@@ -666,27 +1134,81 @@ Important!! This field is required. Don't forget to return an empty list if all
         "FillScheduleReflectionResponse", **fields, __base__=BaseModel
     )
 
+    # A compact context instead of the whole loop conversation: the items just added and their neighbours.
+    # Its size depends on the window, not on the length of the trip.
+    added_items = [item for item in schedule_list if item.id in added_ids]
+    neighbour_items = [
+        item
+        for item in get_schedule_items_near(
+            schedule_list,
+            [get_schedule_item_interval(item) for item in added_items],
+            timedelta(minutes=REFLECTION_WINDOW_MINUTES),
+        )
+        if item.id not in added_ids
+    ]
+
     messages = [
-        *state.fill_schedule_loop_messages,  # messages in the fill_schedule_loop
+        SystemMessage(
+            f"""
+As an AI tour planner, you review the schedule items that were just added to the user's travel schedule.
+
+The user will be visiting {state.trip_location}, staying at {state.trip_accommodation_location}, from {state.trip_arrival_date} {state.trip_arrival_time} to {state.trip_departure_date} {state.trip_departure_time}. They prefer a {state.trip_budget} trip with a focus on {state.trip_theme} and are particularly interested in {state.user_interests}. Their day starts at {state.trip_start_of_day_at} and ends at {state.trip_end_of_day_at}.
+            """.strip()
+        ),
         HumanMessage(
-            "Verify if the schedule items you just returned meet the provided criteria. Focus only on the items within your current scope, not the entire schedule. For example, if you returned schedules from March 9th 3:00 PM to March 9th 5:00 PM, you only need to evaluate that timeframe."
+            f"""
+Schedule items that were just added:
+{convert_schedule_items_to_string(added_items, include_ids=True, include_description=True, include_suggestion=True)}
+
+Schedule items within {REFLECTION_WINDOW_MINUTES} minutes of them:
+{convert_schedule_items_to_string(neighbour_items, include_ids=True, include_description=False, include_suggestion=False)}
+
+Verify if the schedule items that were just added meet the provided criteria. Focus only on the items that were just added, and use the schedule items around them as context. Don't evaluate the rest of the schedule.
+            """.strip()
         ),
-    ]  # did not include the system prompt
+    ]
 
     # Using O3-mini
-    response = (
-        ChatPromptTemplate.from_messages(messages)
-        | reasoning_model.with_structured_output(FillScheduleReflectionResponse)
-    ).invoke({})
+    with llm_rate_limiter.for_user(state.user_id):
+        response = await (
+            ChatPromptTemplate.from_messages(messages)
+            | reasoning_model.with_structured_output(FillScheduleReflectionResponse)
+        ).ainvoke({})
+
+    return [action.schedule_item for action in response.actions]
+
+
+def write_added_schedule_items(
+    writer: StreamWriter, schedule_items: list[ScheduleItem], label: str = ""
+):
+    writer(
+        {
+            "short": f"{label}Added {len(schedule_items)} schedule items",
+            "long": {
+                "title": f"{label}Added {len(schedule_items)} schedule items",
+                "description": convert_schedule_items_to_string(
+                    schedule_items,
+                    include_ids=False,
+                    include_description=False,
+                    include_suggestion=False,
+                    include_heading=False,
+                ),
+            },
+        }
+    )
+
 
-    if len(response.actions) > 0:
+def write_reflection_result(
+    writer: StreamWriter, schedule_items: list[ScheduleItem], label: str = ""
+):
+    if len(schedule_items) > 0:
         writer(
             {
-                "short": f"Found {len(response.actions)} improvements",
+                "short": f"{label}Found {len(schedule_items)} improvements",
                 "long": {
-                    "title": f"Found {len(response.actions)} improvements in added schedule items",
+                    "title": f"{label}Found {len(schedule_items)} improvements in added schedule items",
                     "description": convert_schedule_items_to_string(
-                        [action.schedule_item for action in response.actions],
+                        schedule_items,
                         include_ids=False,
                         include_description=False,
                         include_suggestion=False,
@@ -696,33 +1218,266 @@ Important!! This field is required. Don't forget to return an empty list if all
             }
         )
     else:
-        writer({"short": "All added schedule items have been verified", "long": None})
+        writer(
+            {
+                "short": f"{label}All added schedule items have been verified",
+                "long": None,
+            }
+        )
+
 
-    messages_to_remove = [
-        RemoveMessage(msg.id) for msg in state.fill_schedule_loop_messages[-2:]
-    ]  # We need to remove these messages because we are going to summarize them in the prompt of the next loop
+def dispatch_fill_schedule_days(
+    state: FillScheduleLoopState, empty_slot_list: list
+) -> list[Send]:
+    """One Send per day that has empty slots, each with its own block of ids. Empty if the trip can't be split."""
+    dates = sorted({start.date() for start, _ in empty_slot_list})
+    if len(dates) < 2:
+        return []
+
+    reserved_ids = allocate_schedule_ids(
+        state.last_schedule_item_id,
+        len(dates) * FILL_SCHEDULE_DAY_ID_BLOCK,
+        state.schedule_list,
+    )
+
+    state_data = dict(state)
+    return [
+        Send(
+            n(fill_schedule_day),
+            FillScheduleDayState.model_validate(
+                {
+                    **state_data,
+                    "fill_schedule_date": date.isoformat(),
+                    "fill_schedule_day_index": i,
+                    "fill_schedule_day_count": len(dates),
+                    "fill_schedule_reserved_ids": reserved_ids[
+                        i * FILL_SCHEDULE_DAY_ID_BLOCK : (i + 1)
+                        * FILL_SCHEDULE_DAY_ID_BLOCK
+                    ],
+                }
+            ),
+        )
+        for i, date in enumerate(dates)
+    ]
+
+
+async def fill_schedule_loop(state: FillScheduleLoopState, writer: StreamWriter):
+    empty_slot_list = find_empty_slots(
+        state.schedule_list, state.trip_start_of_day_at, state.trip_end_of_day_at
+    )
+    if not empty_slot_list:
+        writer({"short": "Completed filling all schedule items", "long": None})
+        return Command(
+            goto=n(validate_full_schedule_loop),
+            update={n(state.validate_schedule_round): 0},
+        )
+
+    if (
+        FILL_SCHEDULE_MODE == FillScheduleMode.PARALLEL_DAYS
+        and not state.fill_schedule_days_dispatched
+    ):
+        sends = dispatch_fill_schedule_days(state, empty_slot_list)
+        if sends:
+            writer({"short": f"Filling {len(sends)} days in parallel", "long": None})
+            return Command(
+                goto=sends,
+                update={
+                    n(state.fill_schedule_days_dispatched): True,
+                    n(state.last_schedule_item_id): max(
+                        send.arg.fill_schedule_reserved_ids[-1] for send in sends
+                    ),
+                },
+            )
+
+    writer({"short": "Filling schedule items (loop)", "long": None})
+
+    new_schedule_list = await generate_schedule_items(
+        state,
+        state.schedule_list,
+        empty_slot_list,
+        get_candidate_venues_string(state, state.schedule_list, empty_slot_list),
+    )
+
+    new_ids = allocate_schedule_ids(
+        state.last_schedule_item_id, len(new_schedule_list), state.schedule_list
+    )
+    for item, new_id in zip(new_schedule_list, new_ids):
+        item.id = new_id
+
+    write_added_schedule_items(writer, new_schedule_list)
+
+    # The turn isn't kept in fill_schedule_loop_messages. Reflection gets its own compact context from the added ids.
+    return Command(
+        goto=n(fill_schedule_reflection),
+        update={
+            n(state.schedule_list): new_schedule_list,
+            n(state.fill_schedule_added_ids): new_ids,
+            n(state.last_schedule_item_id): max([state.last_schedule_item_id, *new_ids]),
+        },
+    )
+
+
+async def fill_schedule_reflection(state: FillScheduleLoopState, writer: StreamWriter):
+    writer({"short": "Reflecting on added schedule items", "long": None})
+
+    reflection_items = await review_added_schedule_items(
+        state, state.schedule_list, set(state.fill_schedule_added_ids)
+    )
+
+    last_id = assign_new_schedule_ids(
+        reflection_items, state.schedule_list, state.last_schedule_item_id
+    )
+
+    write_reflection_result(writer, reflection_items)
 
     return Command(
         goto=n(fill_schedule_loop),
         update={
-            n(state.schedule_list): [
-                action.schedule_item for action in response.actions
-            ],
-            n(state.fill_schedule_loop_messages): messages_to_remove,
+            n(state.schedule_list): reflection_items,
+            n(state.last_schedule_item_id): last_id,
         },
     )
 
 
-def validate_full_schedule_loop(state: OverallState, writer: StreamWriter):
+async def fill_schedule_day(state: FillScheduleDayState, writer: StreamWriter):
+    """Fill and reflect on the empty slots of a single day.
+
+    All days run in the same step, so the whole loop of a day happens within this node and
+    its items are merged into schedule_list by insert_schedules when every day is done.
+    """
+    label = f"[{state.fill_schedule_date}] "
+
+    # Venues are dealt out to the days by rank, so that days filled at the same time don't pick the same venue
+    venue_count = len(state.candidate_venue_list)
+    other_days_venues = {
+        i
+        for i in range(venue_count)
+        if i % state.fill_schedule_day_count != state.fill_schedule_day_index
+    }
+
+    # A local copy. Other days change schedule_list concurrently, but only outside this day.
+    schedule_list = ScheduleList(state.schedule_list)
+    owned_ids: set[int] = set()
+    reserved_ids = iter(state.fill_schedule_reserved_ids)
+    updates: list[ScheduleItem] = []
+
+    for _ in range(MAX_FILL_SCHEDULE_DAY_ITERATIONS):
+        empty_slot_list = [
+            slot
+            for slot in find_empty_slots(
+                schedule_list, state.trip_start_of_day_at, state.trip_end_of_day_at
+            )
+            or []
+            if slot[0].date().isoformat() == state.fill_schedule_date
+        ]
+        if not empty_slot_list:
+            break
+
+        writer({"short": f"{label}Filling schedule items", "long": None})
+
+        new_items = await generate_schedule_items(
+            state,
+            schedule_list,
+            empty_slot_list,
+            get_candidate_venues_string(
+                state, schedule_list, empty_slot_list, exclude=other_days_venues
+            ),
+        )
+        added_items = []
+        for item, item_id in zip(new_items, reserved_ids):
+            item.id = item_id
+            added_items.append(item)
+        if not added_items:
+            break
+
+        write_added_schedule_items(writer, added_items, label)
+
+        owned_ids.update(item.id for item in added_items)
+        for item in added_items:
+            schedule_list.upsert(item)
+        updates.extend(added_items)
+
+        reflection_items = await review_added_schedule_items(
+            state, schedule_list, {item.id for item in added_items}
+        )
+
+        existing_ids = schedule_list.ids()
+        applied_items = []
+        for item in reflection_items:
+            if item.id not in existing_ids:
+                # A new item. The id the model picked may belong to another day.
+                if item.activity_type == ScheduleItemType.REMOVE:
+                    continue
+                item.id = next(reserved_ids, None)
+                if item.id is None:
+                    continue
+                owned_ids.add(item.id)
+            elif item.id not in owned_ids:
+                # Items of other days, and fixed schedules, are left to the other branches and validation
+                continue
+
+            if item.activity_type == ScheduleItemType.REMOVE:
+                schedule_list.remove_id(item.id)
+            else:
+                schedule_list.upsert(item)
+            applied_items.append(item)
+        updates.extend(applied_items)
+
+        write_reflection_result(writer, applied_items, label)
+
+    return {n(state.schedule_list): updates}
+
+
+async def validate_full_schedule_loop(state: OverallState, writer: StreamWriter):
     writer({"short": "Reviewing full schedule", "long": None})
 
-    validate_filled_schedule_criteria_list = [
-        """
+    # The mechanical rules are checked locally. The LLM is only asked to fix the violations it finds.
+    violations = validate_schedule(
+        state.schedule_list,
+        state.trip_accommodation_location,
+        state.trip_start_of_day_at,
+        state.trip_end_of_day_at,
+    )
+    violations_string = "\n".join([f"- {v.message}" for v in violations])
+
+    if not violations:
+        print("\n>>> Workflow completed!")
+        return Command(
+            goto=END,
+        )
+
+    if state.validate_schedule_round >= MAX_VALIDATE_SCHEDULE_ROUNDS:
+        writer(
+            {
+                "short": f"Stopped reviewing with {len(violations)} issues left",
+                "long": {
+                    "title": "Issues left in the final schedule",
+                    "description": violations_string,
+                },
+            }
+        )
+        print("\n>>> Workflow completed!")
+        return Command(
+            goto=END,
+        )
+
+    writer(
+        {
+            "short": f"Found {len(violations)} issues in the schedule",
+            "long": {
+                "title": "Issues found in the schedule",
+                "description": violations_string,
+            },
+        }
+    )
+
+    validate_filled_schedule_criteria = {
+        ScheduleRule.MEALS: """
 There should be at least 3 meals per day unless 
 1. The user-provided schedules overlap with the meal time.
 2. It is arrival or departure day, and the meal time is before or after the terminal schedule
         """.strip(),
-        """
+        ScheduleRule.TRANSPORTATION: """
 There should be proper transportation slots between locations.
 Here are some examples:
 
@@ -734,18 +1489,20 @@ Schedule:
 Response: It doesn't meet the criteria, because it didn't account for the travel time from 891 Amsterdam Avenue to 89 E 42nd St, whic takes about 30 minutes. I need to modify the 
 
         """.strip(),
-        """
+        ScheduleRule.RETURN_TO_ACCOMMODATION: """
 The user should start at accomodation and come back to the accomodation every day except arrival and departure day.
         """.strip(),
-        """
+        ScheduleRule.DUPLICATES: """
 There shouldn't be duplicated schedule items.
         """.strip(),
-    ]
+    }
     criteria_instruction = (
         "Think out loud if provided schedule meets the following criteria:"
     )
+    # Only the criteria that are violated
     validate_filled_schedule_criteria_list = [
-        criteria_instruction + c for c in validate_filled_schedule_criteria_list
+        criteria_instruction + validate_filled_schedule_criteria[rule]
+        for rule in dict.fromkeys(v.rule for v in violations)
     ]
 
     # Dynamically create field definitions for the ValidateScheduleResponse class
@@ -774,17 +1531,30 @@ Return an empty list if all the criteria are met. Otherwise, add actions to addr
     )
 
     prompt = """
-You are an AI tour planner, and just finished filling the schedule. Now you need to check if the schedule meets the provided criteria.
+You are an AI tour planner, and just finished filling the schedule. An automatic check found issues with the schedule. Fix them so that the schedule meets the provided criteria.
 
 
 ---
 
 
-Here is the full schedule that you just filled:
-{full_schedule_string}
+Issues:
+{violations_string}
+
+
+---
+
+
+Here is the part of the schedule around the issues:
+{schedule_string}
+
+You only see part of the schedule. Use IDs starting from {next_id} for new items.
     """.format(
-        full_schedule_string=convert_schedule_items_to_string(
-            state.schedule_list,
+        violations_string=violations_string,
+        next_id=allocate_schedule_ids(
+            state.last_schedule_item_id, 1, state.schedule_list
+        )[0],
+        schedule_string=convert_schedule_items_to_string(
+            get_items_around_violations(state.schedule_list, violations),
             include_ids=True,
             include_description=True,
             include_suggestion=True,
@@ -792,9 +1562,10 @@ Here is the full schedule that you just filled:
     ).strip()
 
     # Using O3-mini
-    response = (
-        reasoning_model.with_structured_output(ValidateScheduleResponse)
-    ).invoke(prompt)
+    with llm_rate_limiter.for_user(state.user_id):
+        response = await (
+            reasoning_model.with_structured_output(ValidateScheduleResponse)
+        ).ainvoke(prompt)
 
     if len(response.actions) == 0:
         print("\n>>> Workflow completed!")
@@ -818,12 +1589,17 @@ Here is the full schedule that you just filled:
             }
         )
 
+        new_schedule_items = [action.schedule_item for action in response.actions]
+        last_id = assign_new_schedule_ids(
+            new_schedule_items, state.schedule_list, state.last_schedule_item_id
+        )
+
         return Command(
             goto=n(validate_full_schedule_loop),
             update={
-                n(state.schedule_list): [
-                    action.schedule_item for action in response.actions
-                ]
+                n(state.schedule_list): new_schedule_items,
+                n(state.validate_schedule_round): state.validate_schedule_round + 1,
+                n(state.last_schedule_item_id): last_id,
             },
         )
 
@@ -852,7 +1628,10 @@ g.add_edge(n(init_generate_search_query_loop), n(generate_search_query_loop))
 g.add_node(generate_search_query_loop)
 
 g.add_node(internet_search)
-g.add_edge(n(internet_search), n(init_fill_schedule_loop))
+g.add_edge(n(internet_search), n(compress_internet_search_results))
+
+g.add_node(compress_internet_search_results)
+g.add_edge(n(compress_internet_search_results), n(init_fill_schedule_loop))
 
 g.add_node(init_fill_schedule_loop)
 g.add_edge(n(init_fill_schedule_loop), n(fill_schedule_loop))
@@ -861,6 +1640,9 @@ g.add_node(fill_schedule_loop)
 
 g.add_node(fill_schedule_reflection)
 
+g.add_node(fill_schedule_day)
+g.add_edge(n(fill_schedule_day), n(fill_schedule_loop))
+
 g.add_node(fill_terminal_transportation_schedule)
 
 g.add_node(validate_full_schedule_loop)
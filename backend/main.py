@@ -2,30 +2,32 @@ import os
 import json
 import logging
 from typing import Optional
-from varname import nameof as n
 from fastapi.websockets import WebSocketDisconnect
 from websockets.exceptions import ConnectionClosedError
 
 from fastapi import FastAPI, WebSocket, Request, Depends
-from fastapi.responses import JSONResponse
+from fastapi.requests import HTTPConnection
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.websockets import WebSocketDisconnect
 import redis.asyncio as redis
-from datetime import timedelta
 
 from langgraph.errors import InvalidUpdateError
 
 from app.state import ScheduleItem, Stage
-from app.utils.compile_graph import compile_graph_with_async_checkpointer
-from app.workflows.entry_graph import g as entry_graph
-from app.workflows.generate_schedule_graph import (
-    add_fixed_schedules,
-    fill_schedule_loop,
-    add_terminal_schedules,
-    fill_terminal_transportation_schedule,
-    validate_full_schedule_loop,
-    fill_schedule_reflection,
+from app.llms import llm_usage_tracker
+from app.utils.compile_graph import graph_registry
+from app.utils.rate_limiter import llm_rate_limiter
+from app.utils.cache import caches, configure_caches, create_cache_backend
+from app.utils.semantic_cache import semantic_query_cache
+from app.utils.schedule_projection import latest_schedules
+from app.utils.generation_events import GenerationEventLog
+from app.utils.generation_jobs import (
+    GenerationJobQueue,
+    GenerationQueueFull,
+    GenerationWorkerPool,
 )
+from app.workflows.entry_graph import g as entry_graph
 
 
 logger = logging.getLogger(__name__)
@@ -48,15 +50,41 @@ async def get_current_user_http(request: Request) -> Optional[dict]:
     }
 
 
+async def get_compiled_entry_graph(connection: HTTPConnection):
+    # Works for both HTTP and WebSocket routes
+    return connection.app.state.graph_registry.get("entry")
+
+
 from contextlib import asynccontextmanager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: reset Redis
-    await redis_client.flushall()
-    logger.critical("All Redis keys have been reset")
+    # Redis is not reset on startup. Queued generations and those cut off by a restart are picked up by the workers.
+
+    # Startup: compile graphs once with a pooled checkpointer
+    await graph_registry.start({"entry": entry_graph})
+    app.state.graph_registry = graph_registry
+    latest_schedules.start(graph_registry.mongodb_client)
+    logger.critical("Graphs are compiled")
+
+    # Startup: choose where search results are cached (memory | redis | mongo)
+    configure_caches(
+        create_cache_backend(
+            os.getenv("SEARCH_CACHE_BACKEND", "memory"),
+            redis_client=redis_client,
+            mongodb_client=graph_registry.mongodb_client,
+        )
+    )
+    semantic_query_cache.load()
+
+    # Startup: run queued generations in this process, unless GENERATION_WORKERS is 0
+    generation_workers.start(lambda: graph_registry.get("entry"))
     yield
-    # Shutdown: cleanup if needed
+    # Shutdown: stop the workers, persist the semantic query index and close the shared clients
+    await generation_workers.close()
+    semantic_query_cache.save()
+    await graph_registry.close()
+    await redis_client.aclose()
 
 app = FastAPI(title="Trip Planner Backend", lifespan=lifespan)
 
@@ -86,11 +114,9 @@ except Exception as e:
     logger.critical(f"Failed to connect to Redis: {str(e)}")
     raise
 
-# Key prefix for Redis
-REDIS_KEY_PREFIX = "tour_assistant:ids_in_progress:"
-
-# Time to live for Redis keys
-REDIS_TTL = timedelta(minutes=10)
+generation_event_log = GenerationEventLog(redis_client)
+generation_jobs = GenerationJobQueue(redis_client, generation_event_log)
+generation_workers = GenerationWorkerPool(generation_jobs)
 
 
 @app.get("/health")
@@ -98,15 +124,38 @@ async def health_check():
     return {"status": "healthy", "message": "Service is running"}
 
 
+@app.get("/metrics/llm")
+async def llm_metrics():
+    # Queue depth and wait time of the shared LLM rate limiter for each provider,
+    # and token usage with prompt cache reads/writes for each model
+    return {
+        "providers": llm_rate_limiter.metrics(),
+        "models": llm_usage_tracker.metrics(),
+    }
+
+
+@app.get("/metrics/cache")
+async def cache_metrics():
+    return {
+        "caches": [cache.metrics() for cache in caches]
+        + [semantic_query_cache.metrics()]
+    }
+
+
+@app.get("/metrics/generations")
+async def generation_metrics():
+    # Generations waiting for a worker in all processes, and the workers of this process
+    return {"queued": await generation_jobs.depth(), **generation_workers.metrics()}
+
+
 @app.post("/add_user")
-async def add_user(request: Request):
+async def add_user(
+    request: Request, compiled_entry_graph=Depends(get_compiled_entry_graph)
+):
     user = await request.json()
 
     if not user:
         return {"error": "No user provided"}
-    compiled_entry_graph = await compile_graph_with_async_checkpointer(
-        entry_graph, "entry"
-    )
     config = {"configurable": {"thread_id": user["id"]}}
     await compiled_entry_graph.aupdate_state(
         config,
@@ -116,27 +165,33 @@ async def add_user(request: Request):
             "user_email": user["email"],
         },
     )
+    await latest_schedules.refresh(compiled_entry_graph, user["id"])
     return True
 
 
 @app.get("/graph_state")
-async def get_graph_state(user: dict = Depends(get_current_user_http)):
+async def get_graph_state(
+    user: dict = Depends(get_current_user_http),
+    compiled_entry_graph=Depends(get_compiled_entry_graph),
+):
 
     if not user:
         return {"error": "No user provided or user not found"}
 
-    # Check if user ID exists in Redis
-    if await redis_client.exists(f"{REDIS_KEY_PREFIX}{user['id']}"):
+    # Check if the user's generation is queued, running, or was cut off and is resumed by its subscribers
+    if await generation_jobs.is_pending(user["id"]):
         return {
             "connection_closed": True,
             "error": "The user's schedule is under generation. Please wait until the generation is complete. It may take up to 5 minutes.",
         }
 
-    compiled_entry_graph = await compile_graph_with_async_checkpointer(
-        entry_graph, "entry"
-    )
+    # Served from the projection of the latest schedule. The checkpoint is read only if it's missing.
+    if projection := await latest_schedules.get(user["id"]):
+        return projection
+
     config = {"configurable": {"thread_id": user["id"]}}
     state = await compiled_entry_graph.aget_state(config, subgraphs=True)
+    await latest_schedules.set(user["id"], state)
     state = state.values
 
     if not state:
@@ -145,7 +200,9 @@ async def get_graph_state(user: dict = Depends(get_current_user_http)):
 
 
 @app.post("/update_trip")
-async def update_trip(request: Request):
+async def update_trip(
+    request: Request, compiled_entry_graph=Depends(get_compiled_entry_graph)
+):
     form_data = await request.json()
 
     if not form_data:
@@ -164,9 +221,6 @@ async def update_trip(request: Request):
     else:
         form_data["trip_fixed_schedules"] = []
 
-    compiled_entry_graph = await compile_graph_with_async_checkpointer(
-        entry_graph, "entry"
-    )
     config = {"configurable": {"thread_id": form_data["id"]}}
 
     #! TODO: Need to keep this variable for modify feature later
@@ -198,6 +252,7 @@ async def update_trip(request: Request):
             config=config,
             values={"current_stage": Stage.FIRST_GENERATION},
         )
+    await latest_schedules.refresh(compiled_entry_graph, form_data["id"])
 
     return JSONResponse(
         status_code=200,
@@ -207,19 +262,19 @@ async def update_trip(request: Request):
 
 @app.post("/update_schedule")
 async def update_schedule(
-    request: Request, user: dict = Depends(get_current_user_http)
+    request: Request,
+    user: dict = Depends(get_current_user_http),
+    compiled_entry_graph=Depends(get_compiled_entry_graph),
 ):
     new_schedule_data = await request.json()
 
     if not new_schedule_data:
         return {"error": "No form data provided"}
 
-    compiled_entry_graph = await compile_graph_with_async_checkpointer(
-        entry_graph, "entry"
-    )
     config = {"configurable": {"thread_id": user["id"]}}
 
     await compiled_entry_graph.aupdate_state(config, new_schedule_data)
+    await latest_schedules.refresh(compiled_entry_graph, user["id"])
 
     return JSONResponse(
         status_code=200,
@@ -228,12 +283,16 @@ async def update_schedule(
 
 
 @app.delete("/reset_state")
-async def reset_state(user: dict = Depends(get_current_user_http)):
-    compiled_entry_graph = await compile_graph_with_async_checkpointer(
-        entry_graph, "entry"
-    )
+async def reset_state(
+    user: dict = Depends(get_current_user_http),
+    compiled_entry_graph=Depends(get_compiled_entry_graph),
+):
     config = {"configurable": {"thread_id": user["id"]}}
 
+    # Otherwise /graph_state keeps reporting a generation, and followers resume it. Also waits for a running
+    # generation to stop, so that its checkpoints don't write over the reset.
+    await generation_jobs.reset(user["id"])
+
     # update the state with form data
     await compiled_entry_graph.aupdate_state(
         config,
@@ -243,9 +302,7 @@ async def reset_state(user: dict = Depends(get_current_user_http)):
             "schedule_list": ["RESET_LIST"],
         },
     )
-
-    # reset Redis key
-    await redis_client.delete(f"{REDIS_KEY_PREFIX}{user['id']}")
+    await latest_schedules.refresh(compiled_entry_graph, user["id"])
 
     return JSONResponse(
         status_code=200,
@@ -253,6 +310,59 @@ async def reset_state(user: dict = Depends(get_current_user_http)):
     )
 
 
+def generation_queue_full_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={
+            "status": "error",
+            "message": "All schedule generators are busy. Please try again in a minute.",
+        },
+        headers={"Retry-After": "60"},
+    )
+
+
+@app.post("/generations")
+async def create_generation(user: dict = Depends(get_current_user_http)):
+    # Queue the generation of the user's schedule. Its events are streamed by /generations/events
+    # and /ws/generate_schedule.
+    try:
+        queued = await generation_jobs.enqueue(user["id"])
+    except GenerationQueueFull:
+        return generation_queue_full_response()
+
+    return JSONResponse(
+        status_code=202,
+        content={
+            "status": "success",
+            "message": (
+                "Generation queued"
+                if queued
+                else "The user's schedule is already under generation"
+            ),
+        },
+    )
+
+
+@app.get("/generations/events")
+async def generation_events(
+    request: Request, user: dict = Depends(get_current_user_http)
+):
+    # Server-sent events of the user's generation. Reconnecting clients get the events after Last-Event-ID, or all
+    # of them if it's from an earlier generation.
+    last_event_id = (
+        request.headers.get("last-event-id")
+        or request.query_params.get("last_event_id")
+        or GenerationEventLog.START
+    )
+
+    async def stream():
+        async for event_id, event in generation_jobs.follow(user["id"], last_event_id):
+            yield f"id: {event_id}\ndata: {json.dumps(event)}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
 @app.websocket("/ws/generate_schedule")
 async def generate_schedule_ws(websocket: WebSocket):
     try:
@@ -260,74 +370,40 @@ async def generate_schedule_ws(websocket: WebSocket):
         user = await get_current_user_websocket(websocket)
         if not user:
             await websocket.send_json(
-                {"error": "No user ID provided or user not found"}
+                {"error": "No user provided or user not found"}
             )
             await websocket.close()
             return
 
-        workflow = await compile_graph_with_async_checkpointer(entry_graph, "entry")
-        send_date_via_websocket = True
-
-        # Add user ID to Redis with TTL
-        await redis_client.setex(f"{REDIS_KEY_PREFIX}{user['id']}", REDIS_TTL, "1")
-        logger.critical(f"User ID {user['id']} is added to Redis")
-
-        async for graph_namespace, stream_mode, data in workflow.astream(
-            {"current_stage": Stage.FIRST_GENERATION},
-            stream_mode=["custom", "updates"],
-            config={
-                "recursion_limit": int(os.environ.get("RECURSION_LIMIT")),
-                "configurable": {
-                    "thread_id": user["id"],
-                },
-            },
-            subgraphs=True,
-        ):
-            if not send_date_via_websocket:
-                continue
-
-            if stream_mode == "custom":
-                data["data_type"] = "reasoning_steps"
-                try:
-                    await websocket.send_json(data)
-                except WebSocketDisconnect:
-                    logger.info("WebSocket connection closed by client")
-                    send_date_via_websocket = False
-                    continue
-                except ConnectionClosedError:
-                    logger.info("WebSocket connection closed unexpectedly")
-                    send_date_via_websocket = False
-                    continue
-                except Exception as e:
-                    logger.error(f"Error sending data via websocket: {str(e)}")
-                    break
-            else:
-                if update_dict := (
-                    data.get(n(add_fixed_schedules))
-                    or data.get(n(add_terminal_schedules))
-                    or data.get(n(fill_schedule_loop))
-                    or data.get(n(fill_schedule_reflection))
-                    or data.get(n(fill_terminal_transportation_schedule))
-                    or data.get(n(validate_full_schedule_loop))
-                ):
-                    for schedule in update_dict["schedule_list"]:
-                        try:
-                            await websocket.send_json(
-                                {**schedule.model_dump(), "data_type": "schedule"}
-                            )
-                        except WebSocketDisconnect:
-                            logger.info("WebSocket connection closed by client")
-                            send_date_via_websocket = False
-                            continue
-                        except ConnectionClosedError:
-                            logger.info("WebSocket connection closed unexpectedly")
-                            send_date_via_websocket = False
-                            continue
-                        except Exception as e:
-                            logger.error(
-                                f"Error sending schedule via websocket: {str(e)}"
-                            )
-                            break
+        # A reconnecting client passes the id of the last event it got, or resume=true to get all the events of
+        # the running generation. Otherwise a new generation is queued, unless one is already running.
+        last_event_id = websocket.query_params.get("last_event_id")
+        resume = bool(last_event_id) or websocket.query_params.get("resume") == "true"
+        last_event_id = last_event_id or GenerationEventLog.START
+        if not resume:
+            try:
+                await generation_jobs.enqueue(user["id"])
+            except GenerationQueueFull:
+                await websocket.send_json(
+                    {
+                        "error": "All schedule generators are busy. Please try again in a minute."
+                    }
+                )
+                return
+
+        # The generation runs in a worker. The client only follows its events, so it can disconnect at any time.
+        async for event_id, event in generation_jobs.follow(user["id"], last_event_id):
+            try:
+                await websocket.send_json({**event, "event_id": event_id})
+            except WebSocketDisconnect:
+                logger.info("WebSocket connection closed by client")
+                break
+            except ConnectionClosedError:
+                logger.info("WebSocket connection closed unexpectedly")
+                break
+            except Exception as e:
+                logger.error(f"Error sending data via websocket: {str(e)}")
+                break
 
     except Exception as e:
         import traceback
@@ -339,8 +415,6 @@ async def generate_schedule_ws(websocket: WebSocket):
             await websocket.close()
         except Exception as e:
             pass
-        await redis_client.delete(f"{REDIS_KEY_PREFIX}{user['id']}")
-
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,150 @@
+"""In-memory stand-in for the parts of the async pymongo API the checkpointers use.
+
+Supports equality (including matching an element of an array), $in, $lt and $size in queries, and $set,
+$setOnInsert, $addToSet and $pull in updates. Queries scan the whole collection, like a collection without indexes.
+"""
+
+from pymongo import UpdateOne
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        value = doc
+        for part in key.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        if isinstance(condition, dict) and condition and all(
+            operator.startswith("$") for operator in condition
+        ):
+            for operator, argument in condition.items():
+                if operator == "$in":
+                    if value not in argument:
+                        return False
+                elif operator == "$lt":
+                    if value is None or not value < argument:
+                        return False
+                elif operator == "$size":
+                    if not isinstance(value, list) or len(value) != argument:
+                        return False
+                else:
+                    raise NotImplementedError(operator)
+        elif isinstance(value, list) and not isinstance(condition, list):
+            if condition not in value:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _size(value) -> int:
+    if isinstance(value, dict):
+        return sum(_size(item) for item in value.values())
+    return len(value) if isinstance(value, (bytes, str)) else 0
+
+
+def _project(doc: dict, projection: dict | None) -> dict:
+    if not projection:
+        return dict(doc)
+    fields = {key.split(".")[0] for key, included in projection.items() if included}
+    if projection.get("_id", 1):
+        fields.add("_id")
+    return {key: value for key, value in doc.items() if key in fields}
+
+
+class MemoryCursor:
+    def __init__(self, docs: list[dict]):
+        self.docs = docs
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+
+class MemoryCollection:
+    def __init__(self):
+        self.docs: list[dict] = []
+        self.indexes = []
+
+    def find(self, query=None, projection=None, sort=None, limit=0):
+        docs = [doc for doc in self.docs if _matches(doc, query or {})]
+        for key, direction in reversed(sort or []):
+            docs.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        if limit:
+            docs = docs[:limit]
+        return MemoryCursor([_project(doc, projection) for doc in docs])
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False):
+        for doc in self.docs:
+            if _matches(doc, filter):
+                self._update(doc, update)
+                return
+        if upsert:
+            doc = {
+                key: value for key, value in filter.items() if not isinstance(value, dict)
+            }
+            doc.update(update.get("$setOnInsert", {}))
+            self._update(doc, update)
+            self.docs.append(doc)
+
+    async def update_many(self, filter: dict, update: dict):
+        for doc in self.docs:
+            if _matches(doc, filter):
+                self._update(doc, update)
+
+    async def bulk_write(self, operations: list[UpdateOne], ordered: bool = True):
+        for operation in operations:
+            await self.update_one(
+                operation._filter, operation._doc, upsert=operation._upsert
+            )
+
+    async def delete_many(self, filter: dict):
+        self.docs = [doc for doc in self.docs if not _matches(doc, filter)]
+
+    async def distinct(self, key: str, filter: dict | None = None) -> list:
+        values = []
+        for doc in self.docs:
+            if not _matches(doc, filter or {}):
+                continue
+            value = doc.get(key)
+            for item in value if isinstance(value, list) else [value]:
+                if item not in values:
+                    values.append(item)
+        return values
+
+    async def create_index(self, keys):
+        self.indexes.append(keys)
+
+    @staticmethod
+    def _update(doc: dict, update: dict):
+        for operator, fields in update.items():
+            if operator == "$set":
+                for key, value in fields.items():
+                    *parents, field = key.split(".")
+                    target = doc
+                    for part in parents:
+                        target = target.setdefault(part, {})
+                    target[field] = value
+            elif operator == "$addToSet":
+                for key, value in fields.items():
+                    values = doc.setdefault(key, [])
+                    if value not in values:
+                        values.append(value)
+            elif operator == "$pull":
+                for key, value in fields.items():
+                    doc[key] = [item for item in doc.get(key, []) if item != value]
+            elif operator != "$setOnInsert":
+                raise NotImplementedError(operator)
+
+    def stored_bytes(self) -> int:
+        return sum(_size(doc) for doc in self.docs)
+
+
+class MemoryDatabase(dict):
+    def __missing__(self, name: str) -> MemoryCollection:
+        self[name] = MemoryCollection()
+        return self[name]
+
+
+class MemoryMongoClient(dict):
+    def __missing__(self, name: str) -> MemoryDatabase:
+        self[name] = MemoryDatabase()
+        return self[name]
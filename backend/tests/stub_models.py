@@ -0,0 +1,218 @@
+"""Stub chat models, so that the graphs run offline with a fixed latency per call.
+
+install() must be called before the graphs are compiled. Import this module before anything from app, since
+the real models are built on import and need API keys.
+"""
+
+import os
+import re
+import asyncio
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+os.environ.setdefault("PPLX_API_KEY", "test")
+os.environ.setdefault("RECURSION_LIMIT", "200")
+# Only the stubbed latency is measured, not the provider rate limits
+for provider in ["ANTHROPIC", "OPENAI", "PERPLEXITY"]:
+    os.environ.setdefault(f"{provider}_MAX_CONCURRENCY", "1000")
+    os.environ.setdefault(f"{provider}_REQUESTS_PER_MINUTE", "100000")
+
+from langchain_core.runnables import Runnable, RunnableLambda
+from langchain_core.messages import AIMessage
+from langchain_core.prompt_values import PromptValue
+
+STUB_MODEL_NAMES = [
+    "chat_model_anthropic_first",
+    "chat_model_openai_first",
+    "reasoning_model",
+    "perplexity_chat_model",
+    "small_model_anthropic_first",
+    "small_model_openai_first",
+]
+
+TRIP = {
+    "user_id": "test_user",
+    "user_name": "Test",
+    "user_email": "test@example.com",
+    "user_interests": "art",
+    "user_extra_info": "",
+    "trip_arrival_date": "2025-03-01",
+    "trip_arrival_time": "10:00",
+    "trip_arrival_terminal": "ICN",
+    "trip_departure_date": "2025-03-03",
+    "trip_departure_time": "18:00",
+    "trip_departure_terminal": "ICN",
+    "trip_location": "Seoul",
+    "trip_accommodation_location": "Myeongdong",
+    "trip_budget": "mid",
+    "trip_theme": "culture",
+    "trip_start_of_day_at": "09:00",
+    "trip_end_of_day_at": "21:00",
+    "trip_fixed_schedules": [],
+}
+
+
+def _prompt_text(prompt) -> str:
+    if isinstance(prompt, PromptValue):
+        return "\n".join(str(message.content) for message in prompt.to_messages())
+    if isinstance(prompt, list):
+        return "\n".join(str(getattr(message, "content", message)) for message in prompt)
+    return str(prompt)
+
+
+def _empty_slots(text: str) -> list[tuple[str, str, str]]:
+    """(date, start, end) of the last "Empty slots:" list of a fill prompt."""
+    index = text.rfind("Empty slots:")
+    if index < 0:
+        return []
+    slots = []
+    for line in text[index:].splitlines()[1:]:
+        match = re.match(r"- (\d+-\d+-\d+): (.*)", line.strip())
+        if not match:
+            if slots:
+                break
+            continue
+        for time_range in match.group(2).split(","):
+            start, end = [time.strip() for time in time_range.split("~")]
+            slots.append((match.group(1), start, end))
+    return slots
+
+
+def _structured_response(schema, text: str):
+    name = schema.__name__
+    if name == "Queries":
+        return schema.model_validate(
+            {
+                "queries": [
+                    {"rationale": "stub", "query": f"q{i} museums"} for i in range(3)
+                ]
+            }
+        )
+    if name == "CandidateVenueList":
+        return schema.model_validate(
+            {
+                "venues": [
+                    {
+                        "name": "Museum A",
+                        "activity_type": "museum_gallery",
+                        "address": "10 Main St",
+                        "opening_hours": "10-18",
+                        "price": None,
+                        "tips": None,
+                    },
+                    {
+                        "name": "Cafe B",
+                        "activity_type": "meal",
+                        "address": "20 High St",
+                        "opening_hours": None,
+                        "price": None,
+                        "tips": None,
+                    },
+                ]
+            }
+        )
+    if name == "GenerateSearchQueryLoopResponse":
+        return schema.model_validate(
+            {"actions": [], "is_current_queries_good_enough": True}
+        )
+    if name == "FillScheduleResponse":
+        if "TRANSPORT type schedule items" in text:
+            arrival = re.search(r"Arrival: (\S+ \S+),", text).group(1)
+            departure = re.search(r"Departure: (\S+ \S+)\.", text).group(1)
+            items = [
+                (arrival, arrival[:-5] + "11:00", "A to B", "Go to accommodation"),
+                (
+                    departure[:-5] + "16:00",
+                    departure[:-5] + "17:00",
+                    "B to A",
+                    "Go to terminal",
+                ),
+            ]
+            return schema.model_validate(
+                {
+                    "actions": [
+                        {
+                            "reasoning": "stub",
+                            "schedule_item": {
+                                "id": 0,
+                                "activity_type": "transport",
+                                "time": {"start_time": start, "end_time": end},
+                                "location": location,
+                                "title": title,
+                                "description": None,
+                                "suggestion": None,
+                            },
+                        }
+                        for start, end, location, title in items
+                    ]
+                }
+            )
+        return schema.model_validate(
+            {
+                "actions": [
+                    {
+                        "reasoning": "stub",
+                        "schedule_item": {
+                            "id": 0,
+                            "activity_type": "meal",
+                            "time": {
+                                "start_time": f"{date} {start}",
+                                "end_time": f"{date} {end}",
+                            },
+                            "location": "Cafe B",
+                            "title": f"Meal {date} {start}",
+                            "description": "stub",
+                            "suggestion": "stub",
+                        },
+                    }
+                    for date, start, end in _empty_slots(text)[:4]
+                ]
+            }
+        )
+    # Reflection and validation: nothing to change
+    response = {field: "ok" for field in schema.model_fields if field.startswith("reasoning")}
+    response["actions"] = []
+    return schema.model_validate(response)
+
+
+class StubChatModel(Runnable):
+    """Answers after latency seconds, without blocking the event loop. Counts its calls."""
+
+    def __init__(self, name: str, latency: float):
+        self.name = name
+        self.latency = latency
+        self.calls = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        raise RuntimeError(f"{self.name} was called synchronously")
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return AIMessage(
+            f"Results for {_prompt_text(input)[-80:]}\n"
+            "1. Museum A - 10 Main St\n2. Cafe B - 20 High St"
+        )
+
+    def with_structured_output(self, schema, **kwargs):
+        async def respond(input):
+            self.calls += 1
+            await asyncio.sleep(self.latency)
+            return _structured_response(schema, _prompt_text(input))
+
+        return RunnableLambda(respond)
+
+
+def install(latency: float = 0.05) -> list[StubChatModel]:
+    """Replace the models of app.llms and of the generate_schedule graph with stubs."""
+    import app.llms as llms
+    import app.workflows.generate_schedule_graph as generate_schedule_graph
+
+    stubs = []
+    for name in STUB_MODEL_NAMES:
+        stub = StubChatModel(name, latency)
+        setattr(llms, name, stub)
+        if hasattr(generate_schedule_graph, name):
+            setattr(generate_schedule_graph, name, stub)
+        stubs.append(stub)
+    return stubs
@@ -0,0 +1,280 @@
+"""Checkpoint retention: the aget_state benchmark of /graph_state, sweeping the blobs of pruned checkpoints, and
+keeping the checkpoints a failed write didn't store.
+
+Run from backend/ with `python -m unittest discover -s tests -t .`. Mongo is replaced with the in-memory stand-in of
+tests/memory_mongo.py.
+"""
+
+import os
+import time
+import unittest
+
+from tests import stub_models
+from tests.memory_mongo import MemoryMongoClient
+
+from langgraph.checkpoint.base import empty_checkpoint
+from langgraph.checkpoint.mongodb.aio import AsyncMongoDBSaver
+
+from app.state import Stage
+from app.utils.compile_graph import (
+    CHECKPOINT_BLOB_COLLECTION_NAME,
+    CHECKPOINT_DB_NAME,
+    BLOB_REF_KEY,
+    CoalescingCheckpointSaver,
+    create_checkpoint_serializer,
+)
+from app.workflows.entry_graph import g as entry_graph
+
+GENERATIONS = int(os.getenv("CHECKPOINT_BENCHMARK_GENERATIONS", 4))
+# Threads in the collections. The others are copies of the measured one.
+USERS = int(os.getenv("CHECKPOINT_BENCHMARK_USERS", 10))
+READS = 20
+
+
+class AgetStateBenchmarkTest(unittest.IsolatedAsyncioTestCase):
+    """aget_state(subgraphs=True) of a thread after several generations, as /graph_state reads it.
+
+    Before: the plain Mongo saver, which keeps every checkpoint. After: write coalescing, blobs, zstd, and
+    pruning after each generation. Every read goes through a new saver, like on a worker that didn't run the thread.
+    The stand-in scans the collections on every query, so the reads get slower with the checkpoints of every user.
+    """
+
+    async def asyncSetUp(self):
+        stub_models.install(latency=0)
+
+    async def measure(self, retention: bool) -> dict:
+        client = MemoryMongoClient()
+        mongodb_saver = AsyncMongoDBSaver(client, db_name=CHECKPOINT_DB_NAME)
+        blob_collection = client[CHECKPOINT_DB_NAME][CHECKPOINT_BLOB_COLLECTION_NAME]
+        if retention:
+            mongodb_saver.serde = create_checkpoint_serializer(
+                mongodb_saver.serde, "zstd"
+            )
+            # Model calls take seconds, so nearly every checkpoint is written in a real generation
+            checkpointer = CoalescingCheckpointSaver(
+                mongodb_saver, blob_collection, flush_interval=0
+            )
+        else:
+            checkpointer = mongodb_saver
+        graph = entry_graph.compile(checkpointer=checkpointer)
+
+        config = {"configurable": {"thread_id": "test_user"}, "recursion_limit": 200}
+        for _ in range(GENERATIONS):
+            output = await graph.ainvoke(
+                {**stub_models.TRIP, "current_stage": Stage.FIRST_GENERATION}, config
+            )
+            if retention:
+                # As the generation runner does
+                await checkpointer.amark_final("test_user")
+                await checkpointer.aprune("test_user")
+        for collection in [
+            mongodb_saver.checkpoint_collection,
+            mongodb_saver.writes_collection,
+        ]:
+            collection.docs += [
+                {**doc, "thread_id": f"other_user_{i}"}
+                for i in range(1, USERS)
+                for doc in collection.docs
+            ]
+
+        durations = []
+        for _ in range(READS):
+            reader = (
+                CoalescingCheckpointSaver(mongodb_saver, blob_collection)
+                if retention
+                else mongodb_saver
+            )
+            started_at = time.perf_counter()
+            state = await entry_graph.compile(checkpointer=reader).aget_state(
+                config, subgraphs=True
+            )
+            durations.append(time.perf_counter() - started_at)
+            self.assertEqual(
+                [item.id for item in state.values["schedule_list"]],
+                [item.id for item in output["schedule_list"]],
+            )
+
+        return {
+            "checkpoints": len(mongodb_saver.checkpoint_collection.docs),
+            "stored_bytes": sum(
+                collection.stored_bytes()
+                for collection in [
+                    mongodb_saver.checkpoint_collection,
+                    mongodb_saver.writes_collection,
+                    blob_collection,
+                ]
+            ),
+            "median_milliseconds": sorted(durations)[READS // 2] * 1000,
+        }
+
+    async def test_aget_state_latency(self):
+        before = await self.measure(retention=False)
+        after = await self.measure(retention=True)
+
+        for name, result in [("before", before), ("after", after)]:
+            print(
+                f"\naget_state after {GENERATIONS} generations of {USERS} users, {name}: "
+                f"{result['median_milliseconds']:.1f}ms, {result['checkpoints']} checkpoints, "
+                f"{result['stored_bytes'] / 1e6:.2f}MB stored",
+                end="",
+            )
+        print()
+        self.assertLess(after["checkpoints"], before["checkpoints"])
+        self.assertLess(after["stored_bytes"], before["stored_bytes"])
+        self.assertLess(after["median_milliseconds"], before["median_milliseconds"])
+
+
+class BlobSweepTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        client = MemoryMongoClient()
+        self.mongodb_saver = AsyncMongoDBSaver(client, db_name=CHECKPOINT_DB_NAME)
+        self.blob_collection = client[CHECKPOINT_DB_NAME][
+            CHECKPOINT_BLOB_COLLECTION_NAME
+        ]
+        self.checkpointer = CoalescingCheckpointSaver(
+            self.mongodb_saver, self.blob_collection, flush_interval=0, blob_min_bytes=16
+        )
+
+    async def put(self, thread_id: str, value: str, step: int):
+        checkpoint = empty_checkpoint()
+        checkpoint["channel_values"] = {"value": value}
+        checkpoint["channel_versions"] = {"value": step}
+        await self.checkpointer.aput(
+            {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}},
+            checkpoint,
+            {"source": "loop", "step": step, "writes": None},
+            {"value": step},
+        )
+
+    def blobs(self) -> dict[str, list[str]]:
+        return {doc["_id"]: doc["thread_ids"] for doc in self.blob_collection.docs}
+
+    async def test_sweep_keeps_blobs_in_use(self):
+        shared, pruned, latest = "shared " * 10, "pruned " * 10, "latest " * 10
+        await self.put("thread_1", shared, 1)
+        await self.put("thread_1", pruned, 2)
+        await self.put("thread_1", latest, 3)
+        await self.put("thread_2", shared, 1)
+        self.assertEqual(len(self.blobs()), 3)
+
+        self.assertEqual(await self.checkpointer.aprune("thread_1", keep_last=1), 2)
+        # Within the grace period, nothing is swept
+        self.assertEqual(await self.checkpointer.asweep_blobs("thread_1"), 0)
+        self.assertEqual(len(self.blobs()), 3)
+
+        self.assertEqual(
+            await self.checkpointer.asweep_blobs("thread_1", grace_seconds=0), 1
+        )
+        blobs = self.blobs()
+        self.assertEqual(sorted(blobs.values()), [["thread_1"], ["thread_2"]])
+
+        # The blob of the shared value goes once thread_2 no longer refers to it either
+        await self.mongodb_saver.checkpoint_collection.delete_many(
+            {"thread_id": "thread_2"}
+        )
+        self.assertEqual(await self.checkpointer.asweep_blobs(grace_seconds=0), 1)
+        self.assertEqual(list(self.blobs().values()), [["thread_1"]])
+
+        checkpoint_tuple = await CoalescingCheckpointSaver(
+            self.mongodb_saver, self.blob_collection
+        ).aget_tuple({"configurable": {"thread_id": "thread_1"}})
+        self.assertEqual(checkpoint_tuple.checkpoint["channel_values"]["value"], latest)
+        stored = await self.mongodb_saver.aget_tuple(
+            {"configurable": {"thread_id": "thread_1"}}
+        )
+        self.assertIn(BLOB_REF_KEY, stored.checkpoint["channel_values"]["value"])
+
+    async def test_prune_keeps_final_checkpoints(self):
+        for step in range(1, 4):
+            await self.put("thread_1", f"generation {step}", step)
+            await self.checkpointer.amark_final("thread_1")
+        # Updates after the generations, like from /reset_state and the chat
+        for step in range(4, 10):
+            await self.put("thread_1", f"update {step}", step)
+
+        self.assertEqual(await self.checkpointer.aprune("thread_1", keep_last=2), 4)
+        values = [
+            checkpoint_tuple.checkpoint["channel_values"]["value"]
+            async for checkpoint_tuple in self.checkpointer.alist(
+                {"configurable": {"thread_id": "thread_1"}}
+            )
+        ]
+        self.assertEqual(
+            values,
+            ["update 9", "update 8", "generation 3", "generation 2", "generation 1"],
+        )
+
+
+class FailedFlushTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        client = MemoryMongoClient()
+        self.mongodb_saver = AsyncMongoDBSaver(client, db_name=CHECKPOINT_DB_NAME)
+        self.checkpointer = CoalescingCheckpointSaver(
+            self.mongodb_saver,
+            client[CHECKPOINT_DB_NAME][CHECKPOINT_BLOB_COLLECTION_NAME],
+            flush_interval=0,
+        )
+        self.failures = 0
+        aput = self.mongodb_saver.aput
+
+        async def failing_aput(*args):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("Mongo is down")
+            return await aput(*args)
+
+        self.mongodb_saver.aput = failing_aput
+
+    async def put(self, step: int, parent_id: str | None = None) -> str:
+        checkpoint = empty_checkpoint()
+        checkpoint["channel_values"] = {"value": step}
+        checkpoint["channel_versions"] = {"value": step}
+        self.last_checkpoint_id = checkpoint["id"]
+        configurable = {"thread_id": "thread_1", "checkpoint_ns": ""}
+        if parent_id:
+            configurable["checkpoint_id"] = parent_id
+        await self.checkpointer.aput(
+            {"configurable": configurable},
+            checkpoint,
+            {"source": "loop", "step": step, "writes": None},
+            {"value": step},
+        )
+        return checkpoint["id"]
+
+    async def stored(self) -> list[dict]:
+        return [
+            checkpoint_tuple
+            async for checkpoint_tuple in self.mongodb_saver.alist(
+                {"configurable": {"thread_id": "thread_1"}}
+            )
+        ]
+
+    async def test_failed_checkpoint_is_written_by_the_next_flush(self):
+        first_id = await self.put(1)
+        self.failures = 1
+        with self.assertRaises(ConnectionError):
+            await self.put(2, first_id)
+        self.assertEqual(len(await self.stored()), 1)
+
+        await self.checkpointer.aflush()
+        stored = await self.stored()
+        self.assertEqual(len(stored), 2)
+        self.assertEqual(stored[0].checkpoint["channel_values"]["value"], 2)
+        self.assertEqual(stored[0].parent_config["configurable"]["checkpoint_id"], first_id)
+
+    async def test_newer_checkpoint_takes_over_the_parent_of_the_failed_one(self):
+        first_id = await self.put(1)
+        self.failures = 1
+        with self.assertRaises(ConnectionError):
+            await self.put(2, first_id)
+        # The graph carries on from the checkpoint that wasn't written
+        await self.put(3, self.last_checkpoint_id)
+
+        stored = await self.stored()
+        self.assertEqual(len(stored), 2)
+        self.assertEqual(stored[0].checkpoint["channel_values"]["value"], 3)
+        self.assertEqual(stored[0].parent_config["configurable"]["checkpoint_id"], first_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+"""Load test: concurrent schedule generations against stubbed models.
+
+Run from backend/ with `python -m unittest discover -s tests -t .`. The websocket test also needs REDIS_URL and
+MONGODB_URI_LANGGRAPH_CHECKPOINTER, and is skipped without them.
+"""
+
+import os
+import time
+import asyncio
+import unittest
+
+from tests import stub_models
+
+from langgraph.checkpoint.memory import MemorySaver
+
+from app.state import Stage
+from app.workflows.generate_schedule_graph import g as generate_schedule_graph
+
+CONCURRENT_SESSIONS = int(os.getenv("LOAD_TEST_CONCURRENT_SESSIONS", 20))
+# Model latency dominates a generation, as with the real providers
+STUB_LATENCY_SECONDS = 0.3
+# Longest the event loop may go without running a timer. With every session runnable at once, one loop iteration
+# runs a step of each, so this grows with the sessions even without a blocking call.
+MAX_EVENT_LOOP_LAG_SECONDS = float(os.getenv("LOAD_TEST_MAX_EVENT_LOOP_LAG_SECONDS", 1.5))
+
+
+class EventLoopLagMonitor:
+    """Measures how late a periodic timer fires, i.e. how long the loop was blocked."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.max_lag = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started_at - self.interval
+            self.max_lag = max(self.max_lag, lag)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+class StubWebSocket:
+    """Client side of /ws/generate_schedule that records what it's sent."""
+
+    def __init__(self, user_id: str):
+        self.query_params = {"user_id": user_id}
+        self.messages = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, data):
+        self.messages.append(data)
+
+    async def close(self):
+        self.closed = True
+
+
+class ConcurrentGenerationsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        stub_models.install(latency=STUB_LATENCY_SECONDS)
+        self.graph = generate_schedule_graph.compile(checkpointer=MemorySaver())
+
+    async def generate(self, thread_id: str):
+        return await self.graph.ainvoke(
+            dict(stub_models.TRIP),
+            {"configurable": {"thread_id": thread_id}, "recursion_limit": 200},
+        )
+
+    async def test_concurrent_generations_overlap(self):
+        started_at = time.perf_counter()
+        await self.generate("single")
+        single_seconds = time.perf_counter() - started_at
+
+        monitor = EventLoopLagMonitor()
+        monitor.start()
+        started_at = time.perf_counter()
+        states = await asyncio.gather(
+            *[self.generate(f"load_{i}") for i in range(CONCURRENT_SESSIONS)]
+        )
+        concurrent_seconds = time.perf_counter() - started_at
+        await monitor.stop()
+
+        print(
+            f"\n{CONCURRENT_SESSIONS} generations: {concurrent_seconds:.2f}s "
+            f"(one alone: {single_seconds:.2f}s), max event loop lag {monitor.max_lag * 1000:.1f}ms"
+        )
+        for state in states:
+            self.assertTrue(state["schedule_list"])
+        # The model calls of the sessions overlap instead of running one after another.
+        # A synchronous model call would fail the generation, since the stubs only implement ainvoke.
+        self.assertLess(concurrent_seconds, CONCURRENT_SESSIONS * single_seconds / 4)
+        # Nothing else blocks the loop either, like a synchronous request to a database
+        self.assertLess(monitor.max_lag, MAX_EVENT_LOOP_LAG_SECONDS)
+
+
+@unittest.skipUnless(
+    os.getenv("REDIS_URL") and os.getenv("MONGODB_URI_LANGGRAPH_CHECKPOINTER"),
+    "needs REDIS_URL and MONGODB_URI_LANGGRAPH_CHECKPOINTER",
+)
+class ConcurrentWebSocketSessionsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_websocket_sessions(self):
+        stub_models.install(latency=STUB_LATENCY_SECONDS)
+        import main
+
+        async with main.lifespan(main.app):
+            graph = main.graph_registry.get("entry")
+            user_ids = [f"load_test_{i}" for i in range(CONCURRENT_SESSIONS)]
+            for user_id in user_ids:
+                config = {"configurable": {"thread_id": user_id}}
+                await graph.ainvoke(
+                    {**stub_models.TRIP, "user_id": user_id, "current_stage": Stage.END},
+                    config,
+                )
+                await graph.aupdate_state(
+                    config, {"current_stage": Stage.FIRST_GENERATION}
+                )
+
+            websockets = [StubWebSocket(user_id) for user_id in user_ids]
+            started_at = time.perf_counter()
+            await asyncio.gather(
+                *[main.generate_schedule_ws(websocket) for websocket in websockets]
+            )
+            print(
+                f"\n{CONCURRENT_SESSIONS} websocket sessions: {time.perf_counter() - started_at:.2f}s"
+            )
+
+            for websocket in websockets:
+                self.assertTrue(websocket.closed)
+                self.assertFalse(
+                    [message for message in websocket.messages if "error" in message]
+                )
+                self.assertTrue(
+                    [
+                        message
+                        for message in websocket.messages
+                        if message.get("data_type") == "schedule"
+                    ]
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,321 @@
+"""calculate_empty_slots against the 30-minute slot scan it replaced, and its benchmark on a 30-day trip.
+
+Run from backend/ with `python -m unittest discover -s tests -t .`. The benchmark only asserts the speedup over the
+slot scan. Set EMPTY_SLOTS_BENCHMARK_MAX_MS to also assert the time of a call, on a machine where it's meaningful.
+"""
+
+import io
+import os
+import time
+import random
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+from tests import stub_models  # noqa: F401 (API keys for app.llms)
+
+from app.state import ScheduleItem, ScheduleItemTime, ScheduleItemType, ScheduleList
+from app.utils.utils import (
+    _free_intervals_in_window,
+    _render_free_slots_of_date,
+    calculate_empty_slots,
+)
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M"
+# Least speedup over the slot scan on a 30-day trip with hundreds of items, on a cold cache
+BENCHMARK_MIN_SPEEDUP = float(os.getenv("EMPTY_SLOTS_BENCHMARK_MIN_SPEEDUP", 10))
+# Most time of a call on the same trip. Not asserted unless set, since it depends on the machine.
+BENCHMARK_MAX_MILLISECONDS = os.getenv("EMPTY_SLOTS_BENCHMARK_MAX_MS")
+
+
+def make_item(item_id, activity_type, start, end=None) -> ScheduleItem:
+    return ScheduleItem(
+        id=item_id,
+        activity_type=activity_type,
+        time=ScheduleItemTime(
+            start_time=start.strftime(DATETIME_FORMAT),
+            end_time=end.strftime(DATETIME_FORMAT) if end else None,
+        ),
+        location="somewhere",
+        title=f"Item {item_id}",
+        description=None,
+        suggestion=None,
+    )
+
+
+# calculate_empty_slots and parse_datetime of app/utils/utils.py before the sweep replaced the 30-minute slot scan,
+# copied as they were apart from the names
+def baseline_parse_datetime(dt_str):
+    formats = [
+        "%Y-%m-%d %H:%M",  # Localized Time
+        "%H:%M",
+    ]
+
+    for fmt in formats:
+        try:
+            return datetime.strptime(dt_str, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"Unable to parse datetime string: {dt_str}")
+
+
+def baseline_calculate_empty_slots(
+    schedule_items: list[ScheduleItem],
+    trip_start_of_day_at: str,
+    trip_end_of_day_at: str,
+) -> str:
+    if not schedule_items:
+        print("\n\nWarning: Schedule_items is not provided.\n\n")
+        return None
+
+    start_of_day_hour, start_of_day_minute = [
+        int(x) for x in trip_start_of_day_at.split(":")
+    ]
+    end_of_day_hour, end_of_day_minute = [int(x) for x in trip_end_of_day_at.split(":")]
+
+    schedule_items.sort(key=lambda x: (x.time.start_time))
+
+    if (
+        schedule_items[0].activity_type != ScheduleItemType.TERMINAL
+        or schedule_items[-1].activity_type != ScheduleItemType.TERMINAL
+    ):
+        print("\n\nWarning: First and last items must be terminals.\n\n")
+        return None
+
+    intervals = []
+
+    for item in schedule_items:
+        # Parse the start_time string.
+        start = baseline_parse_datetime(item.time.start_time)
+        # If end_time is not provided, set it to the same as start_time.
+        if item.time.end_time is None:
+            end = start
+        else:
+            end = baseline_parse_datetime(item.time.end_time)
+
+        intervals.append((start, end))
+
+    # Now create a list of all 30-minute slots between overall_start and overall_end.
+    free_slots = []
+    overall_start, overall_end = intervals[0][0], intervals[-1][1]
+    slot_duration = timedelta(minutes=30)
+
+    # Round up to the next half hour for the start time
+    minutes = overall_start.minute
+    if minutes > 30:
+        adjusted_start = overall_start.replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(hours=1)
+    elif minutes > 0 and minutes <= 30:
+        adjusted_start = overall_start.replace(minute=30, second=0, microsecond=0)
+    else:
+        adjusted_start = overall_start.replace(minute=0, second=0, microsecond=0)
+
+    current_slot: list[datetime, datetime] = [
+        adjusted_start,
+        adjusted_start + slot_duration,
+    ]
+
+    while current_slot[1] <= overall_end:
+        current_slot_start: datetime = current_slot[0]
+        current_slot_end: datetime = current_slot[1]
+
+        # Need an adjusted end hour if it's past midnight. Only used for the third comparision in the if statement below.
+        current_slot_end_hour_adjusted = (
+            current_slot_end.hour + 24
+            if current_slot_end.hour < start_of_day_hour
+            else current_slot_end.hour
+        )
+
+        # Users have set when to start the day and when to end the day. If the current slot is not in that range, skip it.
+        if (
+            not start_of_day_hour <= current_slot_start.hour
+            or (
+                start_of_day_hour == current_slot_start.hour
+                and not start_of_day_minute <= current_slot_start.minute
+            )
+            or not current_slot_end_hour_adjusted <= end_of_day_hour
+            or (
+                current_slot_end.hour == end_of_day_hour
+                and not current_slot_end.minute <= end_of_day_minute
+            )
+        ):
+            current_slot = [
+                current_slot[0] + slot_duration,
+                current_slot[1] + slot_duration,
+            ]
+            continue
+
+        is_free = True
+        for start, end in intervals:
+            if current_slot[0] < end and current_slot[1] > start:
+                is_free = False
+                break
+
+        if is_free:
+            # Append the slot's starting time as a tuple.
+            free_slots.append(current_slot)
+
+        # Move to the next 30-minute slot.
+        current_slot = [
+            current_slot[0] + slot_duration,
+            current_slot[1] + slot_duration,
+        ]
+    if not free_slots:
+        print("calculate_empty_slots: No free slots are available.")
+        return None
+
+    # lump together free slots that are next to each other
+    free_slots.sort(key=lambda x: x[0])
+    merged_slots = [free_slots[0]]
+    for current_slot in free_slots[1:]:
+        last_slot = merged_slots[-1]
+        if current_slot[0] <= last_slot[1]:
+            last_slot[1] = current_slot[1]
+        else:
+            merged_slots.append(current_slot)
+
+    # group to the same date
+    dates = sorted(
+        set([f"{start.year}-{start.month}-{start.day}" for start, end in merged_slots])
+    )
+
+    free_slots_grouped_by_date = {}
+    for date in dates:
+        free_slots_grouped_by_date[date] = []
+
+    for start, end in merged_slots:
+        free_slots_grouped_by_date[f"{start.year}-{start.month}-{start.day}"].append(
+            f"{str(start.hour).zfill(2)}:{str(start.minute).zfill(2)} ~ {str(end.hour).zfill(2)}:{str(end.minute).zfill(2)}"
+        )
+
+    free_slots_string = ""
+
+    for date, slots in free_slots_grouped_by_date.items():
+        free_slots_string += (
+            f"- {date}: " + ", ".join([(f"{slot}") for slot in slots]) + "\n"
+        )
+
+    return free_slots_string
+
+
+def random_schedule(rng: random.Random, days: int, item_count: int) -> list[ScheduleItem]:
+    arrival = datetime(2025, 3, 1, rng.randint(0, 23), rng.choice([0, 15, 30, 45]))
+    departure = arrival + timedelta(
+        days=days, hours=rng.randint(0, 20), minutes=rng.choice([0, 10, 30])
+    )
+    items = [
+        make_item(1, ScheduleItemType.TERMINAL, arrival),
+        make_item(2, ScheduleItemType.TERMINAL, departure),
+    ]
+    span_minutes = max(3, int((departure - arrival).total_seconds() // 60))
+    for i in range(item_count):
+        start = arrival + timedelta(minutes=rng.randint(1, span_minutes - 1))
+        end = min(
+            start + timedelta(minutes=rng.choice([0, 15, 30, 45, 60, 90, 120, 200])),
+            departure - timedelta(minutes=1),
+        )
+        if end < start:
+            continue
+        items.append(
+            make_item(
+                3 + i, ScheduleItemType.MEAL, start, end if rng.random() < 0.9 else None
+            )
+        )
+    return items
+
+
+def thirty_day_schedule() -> ScheduleList:
+    """A 30-day trip with 14 items on each full day."""
+    arrival = datetime(2025, 3, 1, 10)
+    departure = arrival + timedelta(days=30, hours=8)
+    items = [
+        make_item(1, ScheduleItemType.TERMINAL, arrival),
+        make_item(2, ScheduleItemType.TERMINAL, departure),
+    ]
+    for day in range(1, 30):
+        start = datetime(2025, 3, 1, 9) + timedelta(days=day)
+        for i in range(14):
+            items.append(
+                make_item(
+                    len(items) + 1,
+                    ScheduleItemType.MEAL,
+                    start,
+                    start + timedelta(minutes=45),
+                )
+            )
+            start += timedelta(minutes=60 if i % 3 else 50)
+    return ScheduleList(items)
+
+
+def slot_lines(free_slots_string: str | None) -> list[str] | None:
+    # The slot scan orders the dates as strings ("2025-3-10" before "2025-3-2"), the sweep chronologically
+    return sorted(free_slots_string.splitlines()) if free_slots_string else None
+
+
+def scan_empty_slots(schedule_items, trip_start_of_day_at, trip_end_of_day_at):
+    return baseline_calculate_empty_slots(
+        list(schedule_items), trip_start_of_day_at, trip_end_of_day_at
+    )
+
+
+def median_milliseconds(function, repeat: int) -> float:
+    durations = []
+    for _ in range(repeat):
+        # Cold: the per-day caches would otherwise answer every call after the first
+        _free_intervals_in_window.cache_clear()
+        _render_free_slots_of_date.cache_clear()
+        started_at = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started_at)
+    return sorted(durations)[len(durations) // 2] * 1000
+
+
+class EmptySlotsEquivalenceTest(unittest.TestCase):
+    def test_matches_slot_scan(self):
+        rng = random.Random(1)
+        # Both print when there are no free slots
+        with redirect_stdout(io.StringIO()):
+            self.check_random_schedules(rng, 2000)
+
+    def check_random_schedules(self, rng: random.Random, count: int):
+        for _ in range(count):
+            items = random_schedule(rng, rng.randint(0, 4), rng.randint(0, 15))
+            start_of_day, end_of_day = rng.choice(
+                [("09:00", "21:00"), ("07:30", "22:15"), ("10:10", "18:40")]
+            )
+            with self.subTest(items=items, day=(start_of_day, end_of_day)):
+                self.assertEqual(
+                    slot_lines(calculate_empty_slots(list(items), start_of_day, end_of_day)),
+                    slot_lines(scan_empty_slots(items, start_of_day, end_of_day)),
+                )
+
+    def test_thirty_day_trip_matches_slot_scan(self):
+        schedule_list = thirty_day_schedule()
+        self.assertEqual(
+            slot_lines(calculate_empty_slots(schedule_list, "09:00", "21:00")),
+            slot_lines(scan_empty_slots(schedule_list, "09:00", "21:00")),
+        )
+
+
+class EmptySlotsBenchmarkTest(unittest.TestCase):
+    def test_thirty_day_trip(self):
+        schedule_list = thirty_day_schedule()
+        sweep = median_milliseconds(
+            lambda: calculate_empty_slots(schedule_list, "09:00", "21:00"), 300
+        )
+        scan = median_milliseconds(
+            lambda: scan_empty_slots(schedule_list, "09:00", "21:00"), 20
+        )
+
+        print(
+            f"\ncalculate_empty_slots, 30 days, {len(schedule_list)} items: {sweep:.3f}ms, "
+            f"slot scan {scan:.3f}ms ({scan / sweep:.0f}x)"
+        )
+        self.assertGreater(scan / sweep, BENCHMARK_MIN_SPEEDUP)
+        if BENCHMARK_MAX_MILLISECONDS:
+            self.assertLess(sweep, float(BENCHMARK_MAX_MILLISECONDS))
+
+
+if __name__ == "__main__":
+    unittest.main()
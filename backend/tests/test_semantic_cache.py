@@ -0,0 +1,61 @@
+"""SemanticQueryCache: reworded queries reuse a stored result, queries narrowed down differently don't.
+
+Run from backend/ with `python -m unittest discover -s tests -t .`.
+"""
+
+import unittest
+
+from tests import stub_models  # noqa: F401 (API keys for app.llms)
+
+from app.utils.semantic_cache import SemanticQueryCache
+
+SCOPE = "seoul|2025-03-01|2025-03-03"
+
+
+class SemanticQueryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = SemanticQueryCache(persist_path=None)
+
+    def add(self, query: str, scope: str = SCOPE):
+        self.cache.add(query, scope, {"query": query, "query_result": f"result of {query}"})
+
+    def test_reworded_query_hits(self):
+        self.add("street food in Myeongdong")
+        self.add("art galleries in Seoul")
+
+        for query, stored_query in [
+            ("Myeongdong street food stalls", "street food in Myeongdong"),
+            ("Seoul art gallery", "art galleries in Seoul"),
+            ("best Seoul art galleries to visit", "art galleries in Seoul"),
+        ]:
+            with self.subTest(query=query):
+                entry = self.cache.lookup(query, SCOPE)
+                self.assertIsNotNone(entry)
+                self.assertEqual(entry["query"], stored_query)
+
+    def test_different_qualifier_misses(self):
+        self.add("restaurants in Myeongdong")
+        self.add("festivals in Seoul in March")
+
+        for query in [
+            "cheap restaurants in Myeongdong",
+            "halal restaurants in Myeongdong",
+            "restaurants in Hongdae",
+            "festivals in Seoul in April",
+        ]:
+            with self.subTest(query=query):
+                self.assertIsNone(self.cache.lookup(query, SCOPE))
+
+        # The other way around: the stored query is the narrower one
+        self.add("vegan restaurants in Gangnam")
+        self.assertIsNone(self.cache.lookup("restaurants in Gangnam", SCOPE))
+
+    def test_other_scope_misses(self):
+        self.add("street food in Myeongdong")
+        self.assertIsNone(
+            self.cache.lookup("street food in Myeongdong", "seoul|2025-04-01|2025-04-03")
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,18 @@
+import asyncio
+import logging
+
+from main import app, lifespan, generation_workers
+
+logger = logging.getLogger(__name__)
+
+
+async def run_workers():
+    # Same startup as the API, without serving it. Run with GENERATION_WORKERS > 0,
+    # and the API nodes with GENERATION_WORKERS=0 to scale them separately.
+    async with lifespan(app):
+        logger.critical(f"Running {generation_workers.num_workers} generation workers")
+        await generation_workers.wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_workers())
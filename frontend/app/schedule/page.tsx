@@ -22,6 +22,7 @@ interface ReasoningStep {
 }
 
 const DELAY_TIME = 1500;
+const MAX_RECONNECT_ATTEMPTS = 3;
 
 export default function SchedulePage() {
   const router = useRouter();
@@ -37,6 +38,9 @@ export default function SchedulePage() {
   // const [delaySeconds, setDelaySeconds] = useState(-DELAY_TIME);
 
   const stepsContainerRef = useRef<HTMLDivElement>(null);
+  // Id of the last event received, so that a reconnection gets only the events it missed
+  const lastEventIdRef = useRef<string | null>(null);
+  const reconnectAttemptsRef = useRef(0);
 
   const [isLoading, setIsLoading] = useState(true);
   const [isEditMode, setIsEditMode] = useState(false);
@@ -44,6 +48,8 @@ export default function SchedulePage() {
   const [isGenerating, setIsGenerating] = useState(false);
   const [connectionClosed, setConnectionClosed] = useState(false);
   const [timeLeft, setTimeLeft] = useState(5 * 60); // 5 minutes in seconds
+  // A generation is running or was cut off on the server. It's resumed instead of started again.
+  const [generationInProgress, setGenerationInProgress] = useState(false);
 
   useEffect(() => {
     const savedSteps = localStorage.getItem("reasoningSteps");
@@ -112,7 +118,7 @@ export default function SchedulePage() {
 
       if (state) {
         if (state.connection_closed) {
-          setConnectionClosed(true);
+          setGenerationInProgress(true);
           return;
         }
         if (!state.trip_location) {
@@ -131,9 +137,17 @@ export default function SchedulePage() {
     fetchInitialSchedules().finally(() => setIsLoading(false));
   }, []);
 
+  useEffect(() => {
+    if (!generationInProgress || !session?.user?.id) {
+      return;
+    }
+    setGenerationInProgress(false);
+    startGeneration(true);
+  }, [generationInProgress, session?.user?.id]);
+
   const { toast } = useToast();
 
-  const connectWebSocket = async () => {
+  const connectWebSocket = async (resume: boolean) => {
     let websocket: WebSocket;
     try {
       if (!session?.user?.id) {
@@ -141,6 +155,11 @@ export default function SchedulePage() {
       }
       const wsUrl = returnWebSockerURL("generate_schedule");
       wsUrl.searchParams.set("user_id", session?.user?.id);
+      if (lastEventIdRef.current) {
+        wsUrl.searchParams.set("last_event_id", lastEventIdRef.current);
+      } else if (resume) {
+        wsUrl.searchParams.set("resume", "true");
+      }
 
       websocket = new WebSocket(wsUrl.toString());
 
@@ -168,15 +187,22 @@ export default function SchedulePage() {
     return websocket;
   };
 
-  const startGeneration = async () => {
+  const startGeneration = async (resume: boolean = false) => {
     setIsLoading(true);
-    await resetAgentStateAction();
-    setReasoningSteps([]);
-    setReasoningStepShortMSG(["Start planning your trip!"]);
-    setSchedules([]);
+    if (!resume) {
+      await resetAgentStateAction();
+      lastEventIdRef.current = null;
+      reconnectAttemptsRef.current = 0;
+    }
+    if (!lastEventIdRef.current) {
+      // All the events of the generation are sent
+      setReasoningSteps([]);
+      setReasoningStepShortMSG(["Start planning your trip!"]);
+      setSchedules([]);
+    }
     setIsGenerating(true);
 
-    const websocket = await connectWebSocket();
+    const websocket = await connectWebSocket(resume);
     if (!websocket) {
       return;
     }
@@ -200,6 +226,10 @@ export default function SchedulePage() {
         // console.log("WebSocket response: ", response);
 
         if (!response) return;
+        if (response.event_id) {
+          lastEventIdRef.current = response.event_id;
+          delete response.event_id;
+        }
         if (response.error) {
           console.error("Error:", response.error);
           toast({
@@ -250,7 +280,16 @@ export default function SchedulePage() {
         }
       };
 
-      websocket.onclose = async () => {
+      websocket.onclose = async (event) => {
+        if (
+          !event.wasClean &&
+          reconnectAttemptsRef.current < MAX_RECONNECT_ATTEMPTS
+        ) {
+          // Dropped mid-generation. The server goes on with it, so get the rest of the events.
+          reconnectAttemptsRef.current += 1;
+          startGeneration(true);
+          return;
+        }
         await revalidateSchedule(session?.user?.id ?? "");
         setConnectionClosed(true);
         setIsLoading(false);